@@ -9,8 +9,10 @@
 ## Copyright (c) 2012, 9Rivers.NET, LLC.  All rights reserved.
 
 import re
+from functools import total_ordering
 
 delims = re.compile("[^0-9a-f]")
+nonhex = str.maketrans('', '', '0123456789abcdef')      # To delete hex digits
 
 
 class InvalidMACAddress(Exception):
@@ -23,19 +25,123 @@ class InvalidMACAddress(Exception):
         return 'Invalid MAC address: {0}'.format(self.value)
 
 
+def hexdigits(mac):
+    '''Return the 12 hex digits, in lower case, of the given MAC address.
+
+    MAC addresses in the common layouts, e.g. "112233445566", "1122.3344.5566" or
+    "11:22:33:44:55:66", are checked by position; Others are split at delimiters,
+    with missing leading 0's added to each segment.
+
+    Raises InvalidMACAddress if the MAC address is invalid.
+    '''
+    x = mac.lower()
+    size = len(x)
+    if size == 17:
+        digits, seps = x[0:2]+x[3:5]+x[6:8]+x[9:11]+x[12:14]+x[15:17], x[2:17:3]
+    elif size == 14:
+        digits, seps = x[0:4]+x[5:9]+x[10:14], x[4:14:5]
+    elif size == 12:
+        digits, seps = x, ''
+    else:
+        digits = None
+    if digits is not None and not digits.translate(nonhex) and len(seps.translate(nonhex)) == len(seps):
+        return digits
+    x = delims.split(x)
+    if len(x) == 6:
+        return ''.join([('00'+xe)[-2:] for xe in x])
+    if len(x) == 3:
+        return ''.join([('0000'+xe)[-4:] for xe in x ])
+    if len(x) == 1:
+        return ('0'*12+x[0])[-12:]
+    raise InvalidMACAddress(mac)
+
 def split(mac, seg=2):
     '''To handle missing leading 0's in the given MAC address.
     '''
-    x = MACFormat.none(mac)
+    x = hexdigits(mac)
     return [ x[i:i+seg] for i in range(0, 12, seg) ]
 
 
+@total_ordering
+class MAC(object):
+    '''A MAC address stored as a 48-bit integer, which may be hashed, compared, and
+    formatted in any of the MACFormat styles:
+
+    >>> mac = MAC('1122.3344.5566')
+    >>> mac.format('ieee'), int(mac) == 0x112233445566, mac == MAC('11-22-33-44-55-66')
+    ('11:22:33:44:55:66', True, True)
+    '''
+    __slots__ = ('value',)
+
+    @classmethod
+    def parse(cls, mac):
+        '''Return the integer value of the given MAC address string.
+        '''
+        return int(hexdigits(mac), 16)
+
+    def format(self, style='none'):
+        '''Return this MAC address as a string in given /style/, one of "cisco",
+        "dash", "ieee" or "none".
+        '''
+        return getattr(MACFormat, style)('{0:012x}'.format(self.value))
+
+    def __eq__(self, other):
+        if not isinstance(other, MAC):
+            return NotImplemented
+        return self.value == other.value
+
+    def __lt__(self, other):
+        if not isinstance(other, MAC):
+            return NotImplemented
+        return self.value < other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __int__(self):
+        return self.value
+
+    def __repr__(self):
+        return "MAC('{0}')".format(self.format('ieee'))
+
+    def __str__(self):
+        return self.format('ieee')
+
+    def __init__(self, mac):
+        '''/mac/ may be a string, an integer, or a MAC.
+        '''
+        if isinstance(mac, MAC):
+            mac = mac.value
+        elif not isinstance(mac, int):
+            mac = self.parse(mac)
+        elif not 0 <= mac < 1<<48:
+            raise InvalidMACAddress(mac)
+        self.value = mac
+
+
 class MACFormat:
     """
     Convert a given string, assumed to be a valid MAC address, to specific format.
 
     Raises a ValueError exception if the MAC address is invalid.
     """
+    @staticmethod
+    def bulk(values, style='none'):
+        '''Convert a list or column of MAC addresses in given /style/, e.g. "ieee".
+        Each distinct address is converted once.
+
+        Returns a list of converted MAC addresses.
+        '''
+        func = getattr(MACFormat, style)
+        done = {}
+        result = []
+        for mac in values:
+            try:
+                result.append(done[mac])
+            except KeyError:
+                result.append(done.setdefault(mac, func(mac)))
+        return result
+
     @staticmethod
     def asis(mac):
         ''' Default: No format change. '''
@@ -59,14 +165,7 @@ class MACFormat:
     @staticmethod
     def none(mac):
         ''' 112233445566 '''
-        x = delims.split(mac.lower())
-        if len(x) == 6:
-            return ''.join([('00'+xe)[-2:] for xe in x])
-        if len(x) == 3:
-            return ''.join([('0000'+xe)[-4:] for xe in x ])
-        if len(x) == 1:
-            return ('0'*12+x[0])[-12:]
-        raise InvalidMACAddress(mac)
+        return hexdigits(mac)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,13 @@
+'''
+| This file is part of the c9r package
+| Copyrighted by Wei Wang <ww@9rivers.com>
+| License: https://github.com/ww9rivers/c9r/wiki/License
+
+Benchmarks of csvfix on synthetic Cisco Prime Infrastructure reports:
+
+    generate    Generate client and AP inventory reports, plain or in .zip archives,
+                like those exported from Prime, in any number of rows;
+    run         Run csvfix tasks on them, and report the rows/sec and peak RSS of
+                each, and the rows/sec of reading, each filter, and writing, compared
+                with those in baseline.json.
+'''
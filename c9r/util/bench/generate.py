@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+'''
+| This file is part of the c9r package
+| Copyrighted by Wei Wang <ww@9rivers.com>
+| License: https://github.com/ww9rivers/c9r/wiki/License
+
+Generate synthetic Cisco Prime Infrastructure reports, for benchmarks of csvfix:
+
+    clients     A "Unique clients" report, of wired and wireless clients;
+    inventory   An "AP Inventory" report.
+
+Each report has a preamble before the header, for "skip-till" or "skip-pass", and
+a trailing section after the data, for "end-at", as exported from Prime. Values
+repeat as they do in real reports: A client shows up a number of times, with the
+same MAC address and vendor; MAC addresses are in a mix of formats.
+
+Usage: generate.py [options] <clients|inventory> <file>
+
+Options:
+    -m | --members=<N>  Write a .zip archive of <N> reports, as Prime exports them.
+                        Defaults to 0, for a plain report.
+    -r | --rows=<N>     Number of rows in each report. Defaults to 100000.
+    -s | --seed=<N>     Seed of the random data. Defaults to 0.
+'''
+
+import csv, getopt, io, os, random, sys, zipfile
+
+client_header = [
+    'Last Seen', 'User', 'MAC Address', 'Vendor', 'IP Address', 'Device IP Address',
+    'Port', 'VLAN ID', '802.11 State', 'Endpoint Type', 'Last Session Length',
+    'AP Name', 'AP MAC Address', 'AP Map Location', 'SSID', 'Profile', 'Protocol',
+    'Host Name', 'CCX', 'E2E', 'Authentication Method', 'Global Unique', 'Local Unique',
+    'Link Local', 'AP IP Address', 'Connection Type', 'Connected Interface',
+    'Access Technology Type' ]
+inventory_header = [
+    'AP Name', 'Ethernet MAC', 'Base Radio MAC', 'AP IP Address', 'Controller Name',
+    'Model', 'Serial Number', 'Map Location' ]
+vendors = [ 'Apple,Inc', 'Apple, Inc.', 'Hewlett-Packard', 'Intel Corporate', 'Dell Inc.',
+            'Samsung Electronics Co.,Ltd', 'Cisco Systems, Inc', 'Unknown', 'Not Supported' ]
+ssids = [ 'UMHS-8021X', 'UMHS-8021X', 'UMHS-8021X', 'MWireless-UMHS', 'MGuest-UMHS' ]
+buildings = [ 'MIB', 'Mott', 'UHS', 'CVC', 'KEC', 'BSRB' ]
+mac_formats = [
+    lambda mac: ':'.join(mac[xn:xn+2] for xn in range(0, 12, 2)),
+    lambda mac: '.'.join(mac[xn:xn+4] for xn in range(0, 12, 4)),
+    lambda mac: '-'.join(mac[xn:xn+2] for xn in range(0, 12, 2)).upper(),
+    lambda mac: mac ]
+
+
+class Report(object):
+    '''Random values for a report: A pool of clients, of about /rows/ divided by
+    /repeats/, each with the same MAC address, vendor and user; And of access
+    points, that they connect to. /seed/ seeds the random data.
+    '''
+    def ap_name(self):
+        '''Return a random AP name, in one of the naming conventions of
+        CiscoInventory.parse_apname().
+        '''
+        rand = self.rand
+        site = rand.choice(buildings)
+        room = '{0}{1}{2}'.format(rand.choice('BCFZ'), rand.randint(1, 9), rand.randint(100, 999))
+        room += rand.choice([ '', 'A', 'C', 'E', 'X', 'Z' ])
+        if rand.random() < 0.3:
+            return 'AP-{0}-{1}-{2}-01A'.format(site, rand.randint(1, 3), room)
+        return 'AP-{0}-{1}-{2:02d}A'.format(site, room, rand.randint(1, 4))
+
+    def mac(self):
+        '''Return a random MAC address, in hex digits only.
+        '''
+        return '{0:012x}'.format(self.rand.getrandbits(48))
+
+    def clients(self, rows):
+        '''Generate /rows/ of a client report, as lists of values.
+        '''
+        rand = self.rand
+        for xn in range(rows):
+            client = rand.choice(self.pool)
+            ap = rand.choice(self.aps)
+            wired = client['wired']
+            hh, mm, ss = rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59)
+            session = rand.choice([ '{0} min {1} sec', '{2} hrs {0} min {1} sec', '{2}hrs{0}min {1}sec',
+                                    '1 days {2} hrs {0} min {1} sec' ]).format(mm, ss, hh)
+            yield [ '{0} Mar {1:02d} {2:02d}:{3:02d}:{4:02d} UTC 2015'.format(
+                        rand.choice([ 'Mon', 'Tue', 'Wed' ]), rand.randint(10, 16), hh, mm, ss),
+                    client['user'], client['format'](client['mac']), client['vendor'],
+                    '10.{0}.{1}.{2}'.format(rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254)),
+                    '172.24.{0}.{1}'.format(rand.randint(0, 255), rand.randint(1, 254)),
+                    'Gi{0}/0/{1}'.format(rand.randint(1, 4), rand.randint(1, 48)) if wired else 'umhs-8021x',
+                    str(rand.randint(2, 4094)), '' if wired else rand.choice([ 'Associated', 'Disassociated' ]),
+                    '', session ]+([ '' ]*14 if wired else [
+                    ap['name'], ap['mac'], ap['location'], client['ssid'], client['ssid'], '802.11ac',
+                    '', '', '', 'wpa2', '', '', '', ap['ip'] ])+[
+                    'Wired' if wired else 'Wireless', '', 'Reserved' ]
+
+    def inventory(self, rows):
+        '''Generate /rows/ of an AP inventory report, as lists of values.
+        '''
+        rand = self.rand
+        for xn in range(rows):
+            ap = self.new_ap()
+            yield [ ap['name'], rand.choice(mac_formats)(ap['mac']), ap['radio'], ap['ip'],
+                    'WLC-{0}'.format(rand.randint(1, 8)), rand.choice([ 'AIR-CAP3702I-A-K9', 'AIR-AP2802I-B-K9' ]),
+                    'FTX{0:08d}'.format(rand.randint(0, 99999999)), ap['location'] ]
+
+    def new_ap(self):
+        '''Return a dict of the values of a new random access point.
+        '''
+        rand = self.rand
+        name = self.ap_name()
+        return dict(name=name, mac=self.mac(), radio=self.mac(),
+                    ip='10.50.{0}.{1}'.format(rand.randint(0, 255), rand.randint(1, 254)),
+                    location='{0} > {1} > Floor {2}'.format('Medical School', name.split('-')[1], rand.randint(1, 9)))
+
+    def new_client(self):
+        '''Return a dict of the values of a new random client.
+        '''
+        rand = self.rand
+        user = rand.choice([ 'UMHS\\user{0}', 'user{0}', 'HS/user{0}', '' ]).format(rand.randint(1, 99999))
+        return dict(mac=self.mac(), format=rand.choice(mac_formats), vendor=rand.choice(vendors), user=user,
+                    wired=rand.random() < 0.3, ssid=rand.choice(ssids))
+
+    def __init__(self, rows, repeats=5, seed=0):
+        self.rand = random.Random(seed)
+        self.aps = [ self.new_ap() for xn in range(max(1, rows//(repeats*20))) ]
+        self.pool = [ self.new_client() for xn in range(max(1, rows//repeats)) ]
+
+
+def clients(fout, rows, seed=0):
+    '''Write a client report of /rows/ rows to the text file /fout/.
+    '''
+    fout.write('Unique clients for Splunk\nGenerated: Mon Mar 16 06:58:12 UTC 2015\n'
+               'Time Frame: Past 24 Hours\n\n')
+    csvw = csv.writer(fout, lineterminator='\n')
+    csvw.writerow(client_header)
+    csvw.writerows(Report(rows, seed=seed).clients(rows))
+    fout.write('\nReport Summary\nTotal Clients,{0}\n'.format(rows))
+
+def inventory(fout, rows, seed=0):
+    '''Write an AP inventory report of /rows/ rows to the text file /fout/.
+    '''
+    fout.write('AP Inventory\n')
+    csvw = csv.writer(fout, lineterminator='\n')
+    csvw.writerow(inventory_header)
+    csvw.writerows(Report(rows, seed=seed).inventory(rows))
+    fout.write('\nDisassociated AP(s)\n')
+    csvw.writerow(inventory_header)
+    csvw.writerow([ 'AP-3', '001a308cb930', '', '', '', '', '', '' ])
+
+reports = { 'clients': clients, 'inventory': inventory }
+
+def generate(kind, fname, rows, seed=0, members=0):
+    '''Write a report of /kind/, "clients" or "inventory", of /rows/ rows, to file
+    /fname/; Or a .zip archive of a number of /members/, if not 0, each a report
+    named after /fname/ and its number in the archive. /seed/ seeds the random data.
+    '''
+    write = reports[kind]
+    if not members:
+        with open(fname, 'w', newline='') as fout:
+            write(fout, rows, seed)
+        return
+    base = os.path.splitext(os.path.basename(fname))[0]
+    with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for xn in range(members):
+            buf = io.StringIO(newline='')
+            write(buf, rows, seed+xn)
+            archive.writestr('{0}_{1}.csv'.format(base, xn), buf.getvalue())
+
+def main(argv=sys.argv[1:]):
+    opts, args = getopt.getopt(argv, 'm:r:s:', [ 'members=', 'rows=', 'seed=' ])
+    if len(args) != 2 or args[0] not in reports:
+        sys.exit(__doc__)
+    options = dict(members=0, rows=100000, seed=0)
+    for opt, val in opts:
+        options[{ '-m': 'members', '-r': 'rows', '-s': 'seed' }.get(opt, opt[2:])] = int(val)
+    generate(args[0], args[1], options['rows'], options['seed'], options['members'])
+
+
+if __name__ == '__main__':
+    main()
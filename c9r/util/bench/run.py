@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+'''
+| This file is part of the c9r package
+| Copyrighted by Wei Wang <ww@9rivers.com>
+| License: https://github.com/ww9rivers/c9r/wiki/License
+
+Benchmark csvfix tasks on synthetic Prime reports (see generate.py): Each task is
+run on the same input twice, in a worker process of its own each time: Once as
+configured, for its rows/sec and the peak RSS of the process; And once with its
+"profile" (see c9r.util.metrics), for the rows/sec of reading, each filter, and
+writing. The results are compared with those of a baseline, and regressions,
+slower or larger than the tolerance allows, are marked with "!".
+
+Usage: run.py [options] [case ...]
+
+Options:
+    -b | --baseline=<file>  Baseline to compare with. Defaults to baseline.json in
+                            this folder.
+    -c | --config=<json>    Options to add to the configuration of every task, e.g.
+                            '{"batch-size": 1000, "row-mode": "tuple"}'.
+    -r | --rows=<N>         Number of rows of input of each task. Defaults to 100000.
+    -s | --save=<file>      Save the results to <file>, e.g. as a new baseline.
+    -t | --tolerance=<pct>  Percentage that results may be worse than the baseline
+                            by, before they are regressions. Defaults to 20.
+    -x | --check            Exit with status 1 if there are regressions.
+
+Cases are run in the order given, or all of them by default: {0}.
+'''
+
+from c9r.util.csvfix import Task     # First, as it monkey patches threading for gevent
+import getopt, json, os, platform, resource, shutil, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+from c9r.util import metrics
+from c9r.util.bench.generate import generate
+
+client_config = {
+    'skip-till':        '^Last Seen,',
+    'end-at':           '^Report Summary',
+    'read-header':      True,
+    'write-header':     True,
+    'header-clean':     '\\W+',
+    'header-fix':       { '([^A-Z_a-z]+)(\\w+)': '{1}{0}' },
+    'header': [
+        'LastSeen', 'User', 'MACAddress', 'Vendor', 'IPAddress', 'DeviceIPAddress', 'Port',
+        'VLANID', 'State80211', 'EndpointType', 'LastSessionLength' ]
+    }
+wireless_header = client_config['header']+[
+    'APName', 'APMACAddress', 'APMapLocation', 'SSID', 'Profile', 'Protocol', 'HostName',
+    'CCX', 'E2E', 'AuthenticationMethod', 'GlobalUnique', 'LocalUnique', 'LinkLocal',
+    'APIPAddress', 'ConnectionType', 'ConnectedInterface', 'AccessTechnologyType' ]
+inventory_config = {
+    'skip-pass':        '^AP Inventory\\s*$',
+    'end-at':           '^Disassociated AP\\(s\\)',
+    'read-header':      True,
+    'write-header':     True,
+    'file-mode':        'a',
+    'header-fix':       { '([^A-Z_a-z]+)(\\w+)': '{1}{0}' },
+    'filters':          [ 'CiscoInventory.AP' ],
+    'header': [
+        'macAddress', 'isDhcp', 'ipAddress', 'commonName', 'Category', 'termID',
+        'operatingSystem', 'equipmentSupportGroup', 'manufacturer', 'assetTag', 'Model',
+        'SerialNumber', 'tier', 'containsSensitiveData', 'primaryFunctionType',
+        'devicebuilding', 'Ownership', 'equipmentOwner', 'equipmentBuilding',
+        'equipmentFloor', 'equipmentRoom', 'equipmentRoomType' ]
+    }
+
+# Benchmark cases: Name, kind of report, number of members in a .zip archive (0 for
+# a plain report), and task configuration, as in csvfix-conf.json.
+cases = [
+    ('trim', 'clients', 0, dict(client_config, filters=[ 'Trim.Trim' ], header=wireless_header)),
+    ('wired', 'clients', 0, dict(client_config, filters=[ 'CiscoPI.WiredSQL' ])),
+    ('wireless', 'clients', 0, dict(client_config, filters=[ 'CiscoPI.WirelessUMHS' ], header=wireless_header)),
+    ('guest', 'clients', 0, dict(client_config, filters=[ 'CiscoPI.WirelessGuest' ], header=wireless_header)),
+    ('normalizer', 'clients', 0, dict(client_config, filters=[ 'CiscoPI.Normalizer' ], header=wireless_header)),
+    ('clients-zip', 'clients', 4, dict(client_config, filters=[ 'CiscoPI.WiredSQL' ], **{ 'file-mode': 'a' })),
+    ('inventory-zip', 'inventory', 2, inventory_config),
+    ]
+
+
+def run_task(config, pattern, cwd):
+    '''Run a task with /config/ on files matching /pattern/, in a worker process.
+
+    Returns a dict of the rows processed, the wall and CPU seconds taken, the peak
+    RSS of the process in MB, the number of errors, and the profiles of the task.
+    '''
+    wall, cpu = time.perf_counter(), time.process_time()
+    tsk = Task(config, pattern, cwd)()
+    wall, cpu = time.perf_counter()-wall, time.process_time()-cpu
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(rows=tsk.lines, seconds=wall, cpu=cpu, errors=len(tsk.errors), profile=tsk.profiles,
+                rss_mb=rss/(1<<20 if sys.platform == 'darwin' else 1<<10))
+
+def rate(rows, seconds):
+    '''Return /rows/ per second, rounded; Or 0 if it took no time.
+    '''
+    return round(rows/seconds) if seconds > 0 else 0
+
+def run_case(name, kind, members, config, rows, extra, tmp):
+    '''Run a benchmark case /name/, on a report of /kind/ of /rows/ rows, in a .zip
+    archive of /members/ if not 0, with the task /config/ and /extra/ options, in
+    the temporary folder /tmp/.
+
+    Returns a dict of the results.
+    '''
+    folder = os.path.join(tmp, name)
+    os.makedirs(folder)
+    fname = os.path.join(folder, 'input.zip' if members else 'input.csv')
+    generate(kind, fname, rows//members if members else rows, 0, members)
+    config = dict(config, **extra)
+    results = []
+    for profile in (False, True):
+        dest = os.path.join(folder, 'profile' if profile else 'output')
+        with ProcessPoolExecutor(1) as pool:
+            results.append(pool.submit(run_task, dict(config, destination=dest, profile=profile), fname, folder).result())
+    result, profiled = results
+    total = metrics.merge(profiled['profile'])
+    filters = dict(read=rate(total['rows'], total['read']['wall']))
+    for stats in total['filters']:
+        filters[stats['name']] = rate(stats['in'], stats['wall'])
+    filters['write'] = rate(total['write'].get('in', 0), total['write'].get('wall', 0))
+    shutil.rmtree(folder)
+    return dict(rows=result['rows'], seconds=round(result['seconds'], 3), rows_per_sec=rate(result['rows'], result['seconds']),
+                peak_rss_mb=round(result['rss_mb'], 1), errors=result['errors'], filters=filters)
+
+def compare(value, base, larger_is_better, tolerance):
+    '''Return the change of /value/ from /base/, in percent, e.g. "+5.2%", and "!"
+    if it is worse by more than /tolerance/ percent; Or "" if there is no /base/.
+    '''
+    if not base:
+        return '', False
+    change = (value-base)*100.0/base
+    worse = (-change if larger_is_better else change) > tolerance
+    return '{0:+.1f}%{1}'.format(change, '!' if worse else ' '), worse
+
+def report(results, baseline, tolerance):
+    '''Print the /results/ of the cases, compared with those in /baseline/.
+
+    Returns the number of regressions.
+    '''
+    regressions = 0
+    print('{0:<16}{1:>10}{2:>10}{3:>12}{4:>10}{5:>10}{6:>10}'.format(
+            'case', 'rows', 'seconds', 'rows/sec', '', 'RSS MB', ''))
+    for name, result in results['cases'].items():
+        base = baseline.get('cases', {}).get(name, {})
+        speed, slower = compare(result['rows_per_sec'], base.get('rows_per_sec'), True, tolerance)
+        size, larger = compare(result['peak_rss_mb'], base.get('peak_rss_mb'), False, tolerance)
+        regressions += slower+larger
+        print('{0:<16}{1:>10,}{2:>10.3f}{3:>12,}{4:>10}{5:>10.1f}{6:>10}'.format(
+                name, result['rows'], result['seconds'], result['rows_per_sec'], speed, result['peak_rss_mb'], size))
+        if result['errors']:
+            print('    {0} errors'.format(result['errors']))
+        for stage, speed in result['filters'].items():
+            change, slower = compare(speed, base.get('filters', {}).get(stage), True, tolerance)
+            regressions += slower
+            print('    {0:<32}{1:>12,}{2:>10}'.format(stage, speed, change))
+    return regressions
+
+def main(argv=sys.argv[1:]):
+    names = [ case[0] for case in cases ]
+    try:
+        opts, args = getopt.getopt(argv, 'b:c:r:s:t:x', [ 'baseline=', 'config=', 'rows=', 'save=', 'tolerance=', 'check' ])
+    except getopt.GetoptError as ex:
+        sys.exit('{0}\n{1}'.format(ex, __doc__.format(', '.join(names))))
+    if any(name not in names for name in args):
+        sys.exit(__doc__.format(', '.join(names)))
+    options = { 'baseline': os.path.join(os.path.dirname(__file__), 'baseline.json'), 'config': '{}',
+                'rows': 100000, 'save': None, 'tolerance': 20, 'check': False }
+    for opt, val in opts:
+        key = { '-b': 'baseline', '-c': 'config', '-r': 'rows', '-s': 'save', '-t': 'tolerance', '-x': 'check' }.get(opt, opt[2:])
+        options[key] = True if key == 'check' else val
+    extra = json.loads(options['config'])
+    rows = int(options['rows'])
+    baseline = {}
+    if os.path.exists(options['baseline']):
+        with open(options['baseline']) as fin:
+            baseline = json.load(fin)
+        if baseline.get('rows') != rows or baseline.get('config', {}) != extra:
+            print('Baseline {0} is of {1} rows, with {2}'.format(options['baseline'], baseline.get('rows'), baseline.get('config', {})))
+    results = dict(rows=rows, config=extra, python=platform.python_version(), machine=platform.machine(),
+                   cpus=os.cpu_count(), cases={})
+    tmp = tempfile.mkdtemp(prefix='csvfix-bench-')
+    try:
+        for name, kind, members, config in cases:
+            if not args or name in args:
+                results['cases'][name] = run_case(name, kind, members, config, rows, extra, tmp)
+    finally:
+        shutil.rmtree(tmp)
+    regressions = report(results, baseline, float(options['tolerance']))
+    if options['save']:
+        with open(options['save'], 'w') as fout:
+            json.dump(results, fout, indent=2)
+            fout.write('\n')
+    if regressions:
+        print('{0} regressions from the baseline, by more than {1}%'.format(regressions, options['tolerance']))
+        if options['check']:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
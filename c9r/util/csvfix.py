@@ -12,23 +12,30 @@ A utility for CSV file fixing / manipulation.
 # http://stackoverflow.com/a/12639040/249173
 from gevent import monkey; monkey.patch_all()
 
-import atexit, glob, os, re
+import atexit, contextlib, fnmatch, functools, glob, io, itertools, mmap, os, re
 import csv, time
 import gevent
 import json
 from gevent.pool import Pool
-from gevent.queue import Empty, JoinableQueue
+from collections import Counter
+from operator import itemgetter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from zipfile import ZipFile, BadZipfile
 from c9r.app import Command
+from c9r.jsonpy import Null
 from c9r.file.util import forge_path
+import c9r.pylog
 from c9r.pylog import logger
+from c9r.util import fswatch, memo, metrics
+from c9r.util.daemon import createDaemon
+from c9r.util.fixstate import StateIndex
 import c9r.util.filter
 from c9r.util.filter import Filter, csvio
-import subprocess
+import shutil
 import sys
 import traceback
 
-jobqu = JoinableQueue()  # Queue of jobs (tasks)
+lone_cr = re.compile(b'\r(?!\n)')     # A CR not in CR-LF, e.g. ending a line
 
 
 class CSVFixer(Command):
@@ -36,12 +43,45 @@ class CSVFixer(Command):
     ==================
       -E | --Enabled-only       Only list enabled tasks.
       -L | --List               List the tasks configured.
+      -R | --rescan             Process all input files, even if unchanged since they
+                                were processed, per the "state-file".
+      -W | --watch              Run as a daemon, to watch for input files and process
+                                them as they are written.
+      -j | --jobs=<N>           Run tasks in <N> worker processes.
 
     Configuration options:
 
       dialects      A list of CSV dialects, keyed with textual names.
+      executor      How tasks are run: "gevent" (default) runs tasks in greenlets
+                    in one process; "process" runs each task in a worker process.
+      jobs          Number of worker processes for the "process" executor.
+                    Defaults to the number of CPUs.
+      max-bytes     Total size in bytes of the input files of tasks that may run at
+                    the same time, to limit memory use. A task larger than that runs
+                    alone. Defaults to 0, meaning no limit. Tasks are started largest
+                    first, by the size of their input files, in either executor.
+      memo-sizes    Optional dict of maximum numbers of values memoized by filters,
+                    keyed by memo name, e.g. "MAC", "Vendor", or "default" for all
+                    others. See c9r.util.memo.
       path          Working folder for the csvfix tool.
+      postprocess-workers   Number of worker processes to delete or postprocess input
+                    files in, as soon as tasks finish with them, while other tasks
+                    still run. Defaults to 0, meaning to do so at exit, one by one.
+      profile-report    File to write the profiles of tasks with "profile" to, at the
+                    end of a run, or of each round of files fixed in --watch mode:
+                    In the Prometheus text format if its name ends in ".prom", e.g.
+                    for the textfile collector of the node exporter; Or in JSON
+                    otherwise. See c9r.util.metrics.
+      state-file    Optional SQLite database file, relative to "path", to record
+                    input files processed, so unchanged files are skipped later by
+                    tasks that do not "delete" them. See c9r.util.fixstate.
       tasks         A list of tasks in dict, keyed with filename template.
+      threads       Number of greenlets for the "gevent" executor. Defaults to 10.
+      watch-interval    Seconds between polls of folders in --watch mode, if they
+                    are polled; And between globs of the folders of the tasks, to
+                    watch those new. Defaults to 60.
+      watch-poll    Set to true to poll folders in --watch mode, instead of using
+                    inotify, e.g. for folders on NFS. Defaults to false.
 
     Each task may be configured with:
 
@@ -51,6 +91,21 @@ class CSVFixer(Command):
         gzip            Compress using gzip;
         xz              Compress using xz;
         zip             Compress using zip.
+                    Files are compressed in-process, into a file with the suffix of
+                    the method, e.g. ".gz", which replaces the original.
+      checkpoint    Number of rows between checkpoints of processing an input file,
+                    saved next to the output file, so a run that is interrupted may
+                    be resumed from the last checkpoint. Defaults to 0 (none).
+      chunks        Number of worker processes to process a large, plain input file
+                    in chunks. Defaults to 0, meaning not to split input files.
+      chunk-min     Minimum size in bytes of an input file to be split into chunks.
+                    Defaults to 64MB.
+      compress      Compress the output files as they are written, with "bzip2",
+                    "gzip", "xz" or "zip", adding the suffix of the method, e.g.
+                    ".gz", to their names. A "zip" output may not be appended to.
+                    No "checkpoint" is taken for compressed outputs.
+      batch-size    Number of rows to read and pass through the filters at a time.
+                    Defaults to 0, meaning one row at a time.
       delete        Set to true to delete data files after processing.
       delete-empty  Delete output file if empty. Defaults to True.
       destination   Destination folder for fixed files. Defaults to /cwd/.
@@ -58,21 +113,52 @@ class CSVFixer(Command):
       disabled      Set to true to disable this task.
       end-at        Optional regex for end of input file.
       file-mode     Either "w" (overwrite) or "a" (append). Defaults to "w".
-      filters       A list of filters for CSV data manipulations.
+      filters       A list of filters for CSV data manipulations, which may end with
+                    a "tee" or "route" node, to branch to more outputs (see below).
+      follow        Set to true to follow plain input files that grow: New lines are
+                    processed and appended to the output each time, from the byte
+                    offset processed to before, as recorded in the "state-file". A
+                    file truncated or replaced, e.g. rotated, is processed anew.
+      fuse-filters  Set to false not to compile filters in "filters" into one function
+                    for each row of data. Defaults to true.
       header        CSV data column header for output.
       header-clean  Regex for removing special characters. Defaults to '\\W+'.
       header-fix    Optional dict used to fix the header.
       input-format  Format of input data: "csv" or "json". Defaults to "csv".
       link-folder   A folder for the "destination", in case files are removed there,
                     for example, by MiShare after files are transported.
+      member-workers    Number of worker processes to process the members of .zip
+                    archives, and plain input files, in parallel, across the files
+                    of the task. Outputs of members to one output, in "file-mode"
+                    "a", are merged in the order of the members, as if they were
+                    processed one by one. Defaults to 0, to process them in turn.
+                    Not used with "follow", "checkpoint", "profile" or branching
+                    filters.
+      memory-map    Set to false not to memory-map plain input files, to find the
+                    data part without checking each line. Defaults to true.
       pattern       Optional filename template - This overwrites the pattern in the
                     task key.
       read-header   True, if CSV column header is to be read from first line in data.
                     Defaults to false.
+      profile       Set to true to profile the task: Rows read, in and out of each
+                    filter, bytes read and written, and the wall and CPU time spent
+                    in reading, each filter, and writing, for each input file, are
+                    written to the "profile-report". Filters are then not fused, rows
+                    are dicts, and input files are not processed in "chunks".
       rename        Optional dict for renaming the output file(s).
+      row-mode      "dict" (default) to pass rows through filters as dicts; Or "tuple"
+                    to pass them as lists, with fields addressed by column. The
+                    filters are then fused, and rows are dicts if any filter does
+                    not support lists.
       skip-line     Skip a given number of lines.
       skip-pass     Skip pass a pattern.
       skip-till     Skip till a pattern.
+      stages        Set to true to format and write the output in a thread of its own,
+                    while rows are read and filtered. A "|" in "filters" also starts
+                    a stage, that runs the filters after it in a thread of its own.
+                    Rows are passed between stages in batches of "stage-batch" rows
+                    (1000 by default), through a queue of up to "stage-queue" (8 by
+                    default) batches, so a slow output holds up those before it.
       times         Set to true to keep time stamps on files. Defaults to false.
       write-header  True, if CSV column header is to be written to output (first line).
                     Defaults to false.
@@ -117,6 +203,37 @@ class CSVFixer(Command):
     More than one entries may be configured for "rename". The renaming process
     stops when the first match is found.
 
+    Branching filters:
+    ====================
+    The last of the "filters" may be a node that branches rows to a list of other
+    chains of filters, so one read of the input feeds a number of outputs:
+
+        { "tee": [ <branch>, ... ] }    Each row goes to all the branches;
+        { "route": [ <branch>, ... ] }  Each row goes to the first branch that it
+                                        matches, and is dropped if none matches.
+
+    Each branch is a dict that may have:
+
+      filters       A list of filters, which may again end with a node;
+      match         For a "route" node, a dict of regex by field name: A row matches
+                    if the value of each field matches its regex. A branch with no
+                    "match" matches all rows;
+      destination   Folder for the output of the branch. Defaults to that of its
+                    parent, i.e. the task or the branch before it;
+      rename        A dict for renaming the output file of its parent, as for the
+                    task, for the output of the branch;
+      header, write-header  As for the task, for the output of the branch.
+
+    A branch with no "destination" or "rename" writes to the output of its parent.
+    For example, to split a report of clients to files for wired and wireless ones:
+
+        "filters": [ "Trim.Trim", { "route": [
+            { "match": { "ConnectionType": "^Wired" }, "destination": "wired" },
+            { "destination": "wireless", "filters": [ "CiscoPI.WirelessClients" ] } ] } ]
+
+    Input files are not processed in "chunks", nor with a "checkpoint", if the
+    filters branch.
+
     Dialects:
     ====================
     Dialects is a collection of Python CSV dialect configurations, each with a name
@@ -154,25 +271,123 @@ class CSVFixer(Command):
     def __call__(self):
         '''Go through list of files to monitor and fix them.
 
-        Each configured task is started as "concurrently" in a greenlet.
+        Each configured task is started as "concurrently" in a greenlet, or in a
+        worker process if the "process" executor is configured, longest first, by
+        the size of its input files (see run_jobs()). The folders of the tasks are
+        scanned for input files once for all tasks, in scan_patterns().
+
+        Files found by more than one task, that read them the same way, are read
+        once for all of them by a group of the tasks, in another greenlet or worker
+        process (see share_inputs()).
         '''
         os.chdir(self.config('path', '.'))
         tasks = self.config('tasks', {})
-        for pat,cfg in tasks.items():
-            jobqu.put((cfg, pat))
-        tasks = min(self.config('threads', 10), jobqu.qsize())
+        if self.watching:
+            return self.watch(tasks)
+        tasks = [ (cfg, pat) for pat,cfg in tasks.items() if is_enabled(cfg, pat) ]
+        groups, found = share_inputs(tasks, scan_patterns([ cfg.get('pattern', pat) for cfg,pat in tasks ]))
+        shared = [ set() for job in tasks ]
+        for members, files in groups:
+            for xn in members:
+                shared[xn].update(zipfn for zipfn, stinfo in files)
+        post = Postprocessor(self.config('postprocess-workers', 0), held_files(found, groups))
         cwd = os.getcwd()
-        logger.debug('Spawning {0} task threads, CWD = {1}.'.format(tasks, cwd))
-        tasks = [ gevent.spawn(task, cwd) for x in range(0, tasks) ]
-        logger.debug('Waiting for {0} task threads to complete.'.format(len(tasks)))
-        #jobqu.join()
-        gevent.joinall(tasks)
+        memo_sizes = self.memo_sizes if self.executor == 'process' else None
+        jobs = [ (plain(cfg), pat) for cfg,pat in tasks ] if self.executor == 'process' else tasks
+        jobs = [ ([ jobs[xn][1] for xn in members ], input_size(files), run_group,
+                  ([ jobs[xn] for xn in members ], cwd, files, memo_sizes, self.state_file, self.rescan))
+                 for members, files in groups ]+\
+               [ (pat, input_size(files, pat), run_task,
+                  (cfg, pat, cwd, memo_sizes, self.state_file, self.rescan, files, names))
+                 for (cfg, pat), files, names in zip(jobs, found, shared) ]
+        try:
+            return self.run_jobs(jobs, post)
+        finally:
+            post.close()
+
+    def run_jobs(self, jobs, post):
+        '''Run /jobs/ of tasks with a Scheduler (see Scheduler.run()): In greenlets,
+        up to "threads" of them at a time; Or in a pool of worker processes if the
+        "process" executor is configured. The jobs are run longest first, within the
+        "max-bytes" of input, if configured.
+
+        Line counts and errors of each task are collected from the jobs, and their
+        delete/postprocess actions are passed to the Postprocessor /post/ as soon as
+        each is done. A timeline of the jobs is logged at the end, and the profiles
+        of the tasks are written to the "profile-report", if configured.
+
+        Returns a list of task statistics.
+        '''
+        process = self.executor == 'process'
+        if process:
+            workers = max(1, min(self.jobs or os.cpu_count() or 1, len(jobs)))
+        else:
+            workers = max(1, self.config('threads', 10))
+        sched = Scheduler(workers, self.config('max-bytes', 0))
+        logger.debug('Running {0} jobs of tasks in {1} {2}, CWD = {3}.'.format(
+                len(jobs), workers, 'worker processes' if process else 'greenlets', os.getcwd()))
+        results = []
+        with (ProcessPoolExecutor(workers) if process else contextlib.nullcontext()) as pool:
+            if process:
+                start = lambda func, args: pool.submit(func, *args)
+                done = lambda handles: wait(handles, return_when=FIRST_COMPLETED).done
+            else:
+                start = lambda func, args: gevent.spawn(func, *args)
+                done = lambda handles: gevent.wait(handles, count=1)
+            for job, handle in sched.run(jobs, start, done):
+                stats = handle.result() if process else handle.value
+                for stats in stats if isinstance(stats, list) else [ stats ]:
+                    post(stats['actions'])
+                    results.append(stats)
+        for stats in results:
+            logger.debug('Task "{0}": {1} files, {2} skipped, {3} lines, {4} errors'.format(
+                    stats['pattern'], stats['files'], stats['skipped'], stats['lines'], len(stats['errors'])))
+            logger.debug('Task "{0}": Memo statistics: {1}'.format(stats['pattern'], stats.get('memos')))
+            for err in stats['errors']:
+                logger.error('Task "{0}" failed: {1}'.format(stats['pattern'], err))
+        sched.log()
+        report = self.config('profile-report', None)
+        if report:
+            metrics.write_report(report, results)
+            logger.debug('Profiles of tasks written to "{0}"'.format(report))
+        return results
+
+    def watch(self, tasks):
+        '''Run as a daemon to watch for input files of the given /tasks/ in their
+        folders, and fix them as they are written. Files already there are fixed
+        first. The tasks, with their filters and memos, are kept between files.
+
+        Folders are watched with inotify if available; Or polled otherwise. Folders
+        that match the patterns of the tasks later are watched as they are found.
+        Errors are logged, and profiles written to the "profile-report", if
+        configured, after each round of files fixed (see report_watched()).
+        '''
+        cwd = os.getcwd()
+        createDaemon()
+        os.chdir(cwd)
+        c9r.pylog.config(self.config())        # Log files are closed in createDaemon()
+        tasks = [ Task(cfg, pat, cwd, self.state_file, self.rescan)
+                  for pat,cfg in tasks.items() if is_enabled(cfg, pat) ]
+        folders = sorted(watch_folders(tasks))
+        fwatch = fswatch.watcher(folders, self.config('watch-poll', False))
+        logger.debug('Watching folders {0} for {1} tasks'.format(folders, len(tasks)))
+        report = self.config('profile-report', None)
+        rescan(tasks)
+        report_watched(tasks, report)
+        watch(tasks, fwatch, self.config('watch-interval', 60), report=report)
 
     def __init__(self):
-        Command.short_opt += "EL"
-        Command.long_opt += ["Enabled-only", "List"]
-        self.enabled_only = self.to_list = False
+        Command.short_opt += "ELRWj:"
+        Command.long_opt += ["Enabled-only", "List", "rescan", "watch", "jobs="]
+        self.enabled_only = self.to_list = self.rescan = self.watching = False
+        self.jobs = None
         Command.__init__(self)
+        self.executor = 'process' if self.jobs else self.config('executor', 'gevent')
+        self.state_file = self.config('state-file')
+        if self.jobs is None:
+            self.jobs = self.config('jobs')
+        self.memo_sizes = plain(self.config('memo-sizes'))
+        memo.configure(self.memo_sizes)
         csvio.register_dialects(self.config('dialects'))
         if self.to_list:
             print('Tasks configured:')
@@ -195,6 +410,12 @@ class CSVFixer(Command):
             self.enabled_only = True
         elif opt in ("-L", "--List"):
             self.to_list = True
+        elif opt in ("-R", "--rescan"):
+            self.rescan = True
+        elif opt in ("-W", "--watch"):
+            self.watching = True
+        elif opt in ("-j", "--jobs"):
+            self.jobs = int(val)
         else:
             assert False, "unhandled option: "+opt
 
@@ -203,6 +424,10 @@ class InvalidInputFormat(Exception):
     '''Error for invalid input-format configuration.
     '''
 
+class InvalidCompression(Exception):
+    '''Error for invalid compress configuration.
+    '''
+
 
 class JSOReader(object):
     '''Read from the given in_file and parse each line into a dict as in JSON object.
@@ -222,6 +447,97 @@ class JSOReader(object):
         self.in_file = in_file
 
 
+class Checkpoint(object):
+    '''Checkpoints of processing an input into an output file, saved in JSON in a
+    file named after the output, with ".ckpt" appended, so processing may resume
+    there after it is interrupted.
+
+    A checkpoint has the name of the /input/, e.g. a member of a zip file, the number
+    of /rows/ read from it, the length of the /output/ in bytes, and the states of
+    the /filters/. With "file-mode" "a", inputs written to the output in full are
+    listed in /done/.
+    '''
+    def finish(self, size):
+        '''The input is processed in full into the output, now /size/ bytes long:
+        In "a" file mode, record the input as done; Otherwise, remove the checkpoint.
+        '''
+        if self.append:
+            self.done.append(self.input)
+            self.rows, self.filters = 0, None
+            self.write(size)
+        else:
+            self.clear()
+
+    def clear(self):
+        '''Remove the checkpoint file, if any.
+        '''
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def open(self, fnw):
+        '''Open the output file /fnw/ to resume writing it, truncated to the length
+        in the checkpoint; Or to write it anew, if it does not match the checkpoint.
+        '''
+        if self.output is not None:
+            try:
+                fout = open(fnw, 'r+')
+                if os.fstat(fout.fileno()).st_size >= self.output:
+                    fout.truncate(self.output)
+                    fout.seek(self.output)
+                    logger.debug('{0}: Resuming "{1}" at row {2}, byte {3}'.format(fnw, self.input, self.rows, self.output))
+                    return fout
+                fout.close()
+            except FileNotFoundError:
+                pass
+            logger.warning('{0}: Output does not match the checkpoint; starting over'.format(fnw))
+            self.rows, self.filters, self.done = 0, None, []
+        return open(fnw, 'a' if self.append else 'w')
+
+    def save(self, rows, writer, fout, head):
+        '''Save a checkpoint after /rows/ are read, and written with /writer/ to the
+        output file /fout/, through the chain of filters starting with /head/.
+        '''
+        c9r.util.filter.sync_chain(head)
+        writer.write_buffer()
+        fout.flush()
+        self.rows = rows
+        self.filters = c9r.util.filter.chain_state(head)
+        self.write(fout.tell())
+
+    def write(self, size):
+        '''Write the checkpoint, with output length /size/, to the checkpoint file.
+        '''
+        self.output = size
+        data = dict(input=self.input, rows=self.rows, output=size,
+                    filters=self.filters, done=self.done)
+        with open(self.path+'.tmp', 'w') as fck:
+            json.dump(data, fck)
+        os.replace(self.path+'.tmp', self.path)
+
+    def __init__(self, fnw, input_name, every, append=False):
+        '''Load the checkpoint, if any, of processing input /input_name/ into output
+        file /fnw/, to be saved /every/ number of rows.
+
+        /append/    True if the output is appended to, in "file-mode" "a".
+        '''
+        self.path = fnw+'.ckpt'
+        self.input = input_name
+        self.every = every
+        self.append = append
+        try:
+            with open(self.path) as fck:
+                data = json.load(fck)
+        except (IOError, ValueError):
+            data = {}
+        same = data.get('input') == input_name
+        self.output = data.get('output')
+        self.rows = data.get('rows', 0) if same else 0
+        self.filters = data.get('filters') if same else None
+        self.done = data.get('done', [])
+
+
 class Pipeline(object):
     '''A Pipeline is an object that creates a Reader and a Writer, and
     connect them to an optional list of filters.
@@ -244,24 +560,593 @@ class Pipeline(object):
         a JSOReader object if explicitly configured so.
         -- May need to revise to allow handling of CSV format variations.
 
+        If "chunks" is configured and both /fnr/ and /fnw/ are file names, a
+        large enough input file is processed in chunks by worker processes.
+
+        Otherwise, if "checkpoint" is configured and /fnw/ is a file name, the
+        processing is checkpointed, and resumed from the last checkpoint if it was
+        interrupted (see Checkpoint).
+
+        Neither is done if the filters branch (see branch()); Nor chunks if it is
+        profiled; Nor checkpoints if the output is compressed.
+
         Returns number of rows (records) processed in the CSV file.
         '''
+        if self.branching:
+            return self.process(fnr, fnw)
+        if self.chunks > 1 and self.profile is None and isinstance(fnr, str) and isinstance(fnw, str)\
+           and os.path.getsize(fnr) >= self.chunk_min:
+            return self.run_chunks(fnr, fnw)
+        if not (self.ckpt_rows and isinstance(fnw, str)) or self.compress:
+            return self.process(fnr, fnw)
+        self.ckpt = Checkpoint(fnw, getattr(fnr, 'name', fnr), self.ckpt_rows, self.file_mode == 'a')
+        if self.ckpt.input in self.ckpt.done:
+            logger.debug('{0}: Input "{1}" is done, per the checkpoint'.format(fnw, self.ckpt.input))
+            self.ckpt = None
+            return 0
+        try:
+            lineno = self.process(fnr, fnw)
+            self.ckpt.finish(os.path.getsize(fnw))
+        finally:
+            self.ckpt = None
+        return lineno
+
+    def clear_checkpoint(self, fnw):
+        '''Remove the checkpoint of output file /fnw/, if any, e.g. after all its
+        inputs are processed in "file-mode" "a".
+        '''
+        Checkpoint(fnw, None, 0).clear()
+
+    def open_output(self, fnw):
+        '''Open the output file /fnw/, to resume from a checkpoint if there is one;
+        Or return /fnw/ if it is not a file name.
+        '''
+        if not isinstance(fnw, str):
+            return fnw
+        if self.ckpt is not None:
+            return self.ckpt.open(fnw)
+        return self.open_file(fnw, self.file_mode)
+
+    def merge_parts(self, fnw, parts):
+        '''Append the output /parts/ of members of an input, processed in parallel
+        (see run_member()), to the output file /fnw/ in order, and remove them: The
+        header, if any, is written only before the first rows, if /fnw/ is empty.
+        '''
+        with self.open_file(fnw, 'a', True) as fout:
+            write_header = self.write_header and (fout.tell() == 0)
+            for part in parts:
+                with open(part, 'rb') as fpart:
+                    if self.write_header:
+                        header = fpart.readline()
+                        if header and write_header:
+                            fout.write(header)
+                            write_header = False
+                    shutil.copyfileobj(fpart, fout)
+                os.unlink(part)
+
+    def open_file(self, fnw, mode, binary=False):
+        '''Open the output file /fnw/ in /mode/, "w" or "a", compressed as it is
+        written if so configured (see csvio.Compressed). It is for text, unless it is
+        /binary/.
+        '''
+        if self.compress:
+            return csvio.Compressed(fnw, mode, self.compress, binary)
+        return open(fnw, mode+'b' if binary else mode)
+
+    def process(self, fnr, fnw):
+        '''Process /fnr/ into /fnw/ as in __call__(), but with no chunks.
+        '''
+        if self.mmap and isinstance(fnr, str):
+            lineno = self.run_mapped(fnr, fnw)
+            if lineno is not None:
+                return lineno
         # Open files if they are given as file names:
         fin = csvio.Reader(open(fnr, 'r') if isinstance(fnr, str) else fnr, self.ends)
-        fout = open(fnw, self.file_mode) if isinstance(fnw, str) else fnw
+        fout = self.open_output(fnw)
         write_header = self.write_header and (fout.tell() == 0)
-        # Skip non-data if so configured:
+        if not self.skip_to_data(fin, fnr):
+            return 0
+        rheader = self.get_header(fin, fnr)
+        if rheader is False:
+            return 0
+        logger.debug('{0}: {1}to output CSV header: {2}'.format(fnw, '' if write_header else 'not ', self.header))
+        return self.run(fin, fout, self.header or rheader, rheader or self.header, write_header)
+
+    def branch(self, node, fw, leaf, fnw):
+        '''Return a filter for a /node/ in the filters, that branches to a list of
+        chains of filters: A c9r.util.filter.Tee for a "tee" node; Or a Route for a
+        "route" node (see CSVFixer).
+
+        /fw/, /fnw/ The csvio.Writer and the name of the output file of the parent;
+        /leaf/      As for chain().
+        '''
+        kind = 'route' if 'route' in node else 'tee'
+        branches = node.get(kind)
+        if not branches:
+            raise ValueError('Invalid node in filters: {0}'.format(node))
+        heads = []
+        for br in branches:
+            fwb, fnb = fw, fnw
+            if leaf is not None:
+                fnb = self.branch_output(fnw, br)
+                if fnb is None:
+                    fnb = fnw
+                else:
+                    fwb = leaf(br, fnb)
+            heads.append(self.chain(fwb, leaf, br.get('filters', []), fnb))
+        if kind == 'tee':
+            return c9r.util.filter.Tee(heads)
+        return c9r.util.filter.Route(heads, [ br.get('match') for br in branches ])
+
+    def branch_output(self, fnw, branch):
+        '''Return the name of the output file of a /branch/ (see branch()), given
+        that of its parent, /fnw/: In the "destination" of the branch, or the folder
+        of /fnw/, per the "rename" of the branch. Or None if the branch has neither,
+        to write to /fnw/.
+        '''
+        if not ('destination' in branch or 'rename' in branch):
+            return None
+        if not isinstance(fnw, str):
+            raise ValueError('Output of branch {0} needs an output file name'.format(branch))
+        name = rename_file(os.path.basename(fnw), [ (re.compile(xk),xv) for xk,xv
+                                                    in branch.get('rename', {}).items() ])
+        return os.path.join(branch.get('destination', os.path.dirname(fnw)), name)
+
+    def branch_outputs(self, fnw, filters=None):
+        '''Return a list of the names of the output files of the branches in the
+        /filters/, the configured ones by default, other than /fnw/, the output
+        file of their parent.
+        '''
+        outputs = []
+        for fltr in self.filters if filters is None else filters:
+            if isinstance(fltr, str):
+                continue
+            for br in fltr.get('route' if 'route' in fltr else 'tee', []):
+                fnb = self.branch_output(fnw, br) or fnw
+                for xp in [ fnb ]+self.branch_outputs(fnb, br.get('filters', [])):
+                    if xp != fnw and xp not in outputs:
+                        outputs.append(xp)
+        return outputs
+
+    def chain(self, fw, leaf=None, filters=None, fnw=None):
+        '''Return the head of a chain of /filters/, the configured ones by default,
+        that writes to the csvio.Writer /fw/, for output file /fnw/.
+
+        The last of the /filters/ may be a node that branches (see branch()): The
+        output of each branch is written with a csvio.Writer from /leaf/, a function
+        given the branch and the name of its output file; Or with /fw/ if /leaf/ is
+        None, or the branch has no output of its own.
+
+        The filters after a "|" in /filters/ run in another thread, as do /fw/ and
+        the output if "stages" is configured (see c9r.util.filter.Stage).
+
+        If "profile" is configured, each filter, and /fw/, is probed (see probe()).
+        '''
+        filter1 = tail = self.probe(fw, metrics.WRITE)
+        if self.stages and filters is None and not self.branching:
+            filter1 = tail = self.stage(filter1)
+        try:
+            for fltr in reversed(self.filters if filters is None else filters):
+                if not isinstance(fltr, str):
+                    if filter1 is not tail:
+                        raise ValueError('A "tee" or "route" node must be the last of filters: {0}'.format(fltr))
+                    filter1 = self.probe(self.branch(fltr, fw, leaf, fnw), 'route' if 'route' in fltr else 'tee')
+                    continue
+                if fltr == '|':
+                    filter1 = self.stage(filter1)
+                    continue
+                modname, cname = fltr.rsplit('.')
+                mod = __import__('c9r.util.filter.'+modname, fromlist=[cname])
+                klass = getattr(mod, cname)
+                filter1 = self.probe(klass(filter1).open(), fltr)
+        except ImportError:
+            logger.warning('ImportError for filter {0}'.format(fltr))
+            raise
+        return filter1
+
+    def probe(self, filter1, name):
+        '''Return a c9r.util.filter.Probe of /filter1/, named /name/ in the profile,
+        if "profile" is configured; Or /filter1/ otherwise.
+        '''
+        if self.profile is None:
+            return filter1
+        return c9r.util.filter.Probe(filter1, name)
+
+    def stage(self, filter1):
+        '''Return a c9r.util.filter.Stage, as configured, to run the chain of filters
+        from /filter1/ in another thread.
+        '''
+        return c9r.util.filter.Stage(filter1, self.stage_batch, self.stage_queue)
+
+    def prepare_chain(self, filter1, rheader, fields=None):
+        '''Prepare the chain of filters from /filter1/ for input with field names in
+        /rheader/, and compile it if so configured: For rows that are lists, with
+        /fields/ in columns, if given (see row_fields()); Or dicts otherwise.
+
+        Returns the head of the chain prepared.
+        '''
+        if fields is not None:
+            filter1.prepare(rheader, { xk: xn for xn,xk in enumerate(fields) })
+            return c9r.util.filter.compile_chain(filter1)
+        if self.ireader is csv.DictReader:
+            filter1.prepare(rheader)
+        if self.fuse and self.profile is None:
+            filter1 = c9r.util.filter.compile_chain(filter1)
+        return filter1
+
+    def open_branch(self, stack, leaves, header, write_header, mode, branch, fnw):
+        '''Open the output file /fnw/ of a /branch/ (see branch()) in /mode/, and
+        return a csvio.Writer for it, entered into the contextlib.ExitStack /stack/;
+        Or the one in /leaves/, a dict of those opened by file name, if it is there.
+
+        /header/, /write_header/    As configured for the task.
+        '''
+        fw = leaves.get(fnw)
+        if fw is None:
+            forge_path(os.path.dirname(fnw) or '.')
+            fout = stack.enter_context(self.open_file(fnw, mode))
+            write_header = branch.get('write-header', write_header) and (fout.tell() == 0)
+            fw = leaves[fnw] = stack.enter_context(csvio.Writer(
+                    fout, branch.get('header', header), write_header, self.dialect))
+            logger.debug('Opened branch output "{0}"'.format(fnw))
+        return fw
+
+    def run_shared(self, fnr, outputs):
+        '''Process /fnr/ in one read for a number of /outputs/: A list of tuples of a
+        Pipeline, that reads input the same way as this one (see read_key()), and
+        (the name of) its output file.
+
+        Returns number of rows (records) processed.
+        '''
+        fin = csvio.Reader(open(fnr, 'r') if isinstance(fnr, str) else fnr, self.ends)
+        fouts = [ pipe.open_output(fnw) for pipe, fnw in outputs ]
+        outputs = [ (pipe, fout, pipe.header, pipe.write_header and (fout.tell() == 0))
+                    for (pipe, fnw), fout in zip(outputs, fouts) ]
+        if not self.skip_to_data(fin, fnr):
+            return 0
+        rheader = self.get_header(fin, fnr)
+        if rheader is False:
+            return 0
+        outputs = [ (pipe, fout, header or rheader, write_header) for pipe, fout, header, write_header in outputs ]
+        return self.run_many(fin, rheader or self.header, outputs)
+
+    def run(self, fin, fout, header, rheader, write_header):
+        '''Read through the input /fin/ and write out to /fout/: Read error(s) are
+        logged but ignored.
+
+        /header/        Header for the output;
+        /rheader/       Field names for reading the input;
+        /write_header/  True to write /header/ to the output.
+
+        Returns number of rows (records) processed.
+        '''
+        return self.run_many(fin, rheader, [ (self, fout, header, write_header) ])
+
+    def run_many(self, fin, rheader, outputs):
+        '''Read through the input /fin/, with field names /rheader/, once for a
+        number of /outputs/: A list of tuples of a Pipeline, with the filters and
+        output configuration, an output file, its header, and True to write the
+        header. The rows are fanned out to the filters of each with a Tee.
+
+        Rows are lists if all the outputs are able to take them (see row_fields()),
+        and none of them is profiled.
+
+        The profile of the run is added to the /profile/ of each Pipeline that has
+        one: The time spent in reading is that not spent in the filters, and is
+        shared by all the outputs.
+
+        Returns number of rows (records) processed.
+        '''
+        wall, cpu = time.perf_counter(), time.thread_time()
+        lineno = 0
+        ckpt = self.ckpt if len(outputs) == 1 else None
+        with contextlib.ExitStack() as stack:
+            writers = [ stack.enter_context(csvio.Writer(fout, header, write_header, pipe.dialect))
+                        for pipe, fout, header, write_header in outputs ]
+            # filters: Filters to pass data through. If missing, then straight thru.
+            leaves = {}
+            heads = [ pipe.chain(fw, functools.partial(pipe.open_branch, stack, leaves, header, pipe.write_header,
+                                                       getattr(fout, 'mode', pipe.file_mode)),
+                                 fnw=getattr(fout, 'name', None)) if pipe.branching else pipe.chain(fw)
+                      for (pipe, fout, header, write_header), fw in zip(outputs, writers) ]
+            fields = [ pipe.row_fields(head, rheader) if pipe.tuples and pipe.profile is None else None
+                       for (pipe, fout, header, write_header), head in zip(outputs, heads) ]
+            if None in fields:
+                fields = [ None for head in heads ]
+            heads = [ pipe.prepare_chain(head, rheader, xf)
+                      for (pipe, fout, header, write_header), head, xf in zip(outputs, heads, fields) ]
+            filter1 = heads[0] if len(heads) == 1 else c9r.util.filter.Tee(heads)
+            if fields[0] is not None:
+                csvreader = csvio.ListReader(fin.lines(), len(rheader), max(map(len, fields)))
+            else:
+                csvreader = self.ireader(fin.lines(), fieldnames=rheader)
+            saved = 0
+            if ckpt is not None:
+                lineno = saved = self.resume(ckpt, csvreader, filter1)
+            batch = []
+            while True:
+                try:
+                    line = next(csvreader)
+                    lineno += 1
+                    if not self.batch_size:
+                        filter1.write(line)
+                    else:
+                        batch.append(line)
+                        if len(batch) < self.batch_size:
+                            continue
+                        rows, batch = batch, []
+                        filter1.write_batch(rows)
+                    if ckpt is not None and lineno - saved >= ckpt.every:
+                        ckpt.save(lineno, writers[0], outputs[0][1], filter1)
+                        saved = lineno
+                except StopIteration:
+                    break
+                except Exception as ex:
+                    self.log_error(ex, lineno, line)
+            try:
+                if batch:
+                    filter1.write_batch(batch)
+            except Exception as ex:
+                self.log_error(ex, lineno, line)
+            if True:
+                logger.debug('Closing filter 1: {0}, lines = {1}, fout size = {2}'.format(
+                        type(filter1).__name__, lineno, [ fout.tell() for pipe, fout, header, write_header in outputs ]))
+                filter1.close()
+        profiled = [ (pipe, head) for (pipe, fout, header, write_header), head in zip(outputs, heads)
+                     if pipe.profile is not None ]
+        if profiled:
+            wall, cpu = time.perf_counter()-wall, time.thread_time()-cpu
+            for probe in c9r.util.filter.next_probes(filter1):
+                wall -= probe.wall
+                cpu -= probe.cpu
+            for pipe, head in profiled:
+                pipe.profile.append(dict(rows=lineno, read=dict(wall=wall, cpu=cpu),
+                                         filters=c9r.util.filter.probe_stats(head)))
+        return lineno
+
+    def resume(self, ckpt, csvreader, head):
+        '''Resume from checkpoint /ckpt/: Skip the rows read before in /csvreader/,
+        and restore the states of the filters in the chain starting with /head/.
+
+        Returns the number of rows skipped.
+        '''
+        lineno = 0
+        while lineno < ckpt.rows:
+            try:
+                next(csvreader)
+                lineno += 1
+            except StopIteration:
+                break
+            except Exception as ex:
+                logger.debug('{0} skipping row {1}: {2}'.format(type(ex).__name__, lineno, ex))
+        if ckpt.filters:
+            c9r.util.filter.restore_chain(head, ckpt.filters)
+        logger.debug('Resumed after {0} rows'.format(lineno))
+        return lineno
+
+    def get_header(self, fin, fnr):
+        '''If no header is configured, or "read-header" is configured, read the
+        next line in /fin/ as header.
+
+        Returns the header read and fixed; None if the header is not to be read;
+        Or False in case of an error.
+        '''
+        # TBD: Make output header different than input header, optionally.
+        if not (self.read_header or self.header is None):
+            return None
+        try:
+            rheader = [ self.header_clean.sub('', x) for x in next(fin).split(',') ]
+        except Exception as ex:
+            logger.debug('{1}: {0}'.format(ex, type(ex).__name__))
+            logger.warning('Unexpected error when reading CSV header in {0}'.format(fnr))
+            return False
+        logger.debug('Read header: {0}'.format(rheader))
+        for rex, fmt in self.header_fix:
+            nhdr = []
+            for col in rheader:
+                mx = rex.match(col)
+                if mx:
+                    try:
+                        col = fmt.format(*mx.groups())
+                    except Exception as ex:
+                        logger.warning('Exception fixing "{0}" with "{1}" and groups = {2}'.format(col, fmt, mx.groups()))
+                nhdr.append(col)
+            rheader = nhdr
+        logger.debug('Header fixed: {0}'.format(rheader))
+        return rheader
+
+    def log_error(self, ex, lineno, line):
+        '''Log an exception /ex/ from processing input /line/ at /lineno/.
+        '''
+        logger.warning('{2}: {0} (lineno = {1})'.format(ex, lineno, type(ex).__name__))
+        logger.debug('\tline = {0})'.format(line))
+        print('-'*60)
+        traceback.print_exc(file=sys.stdout)
+        print('-'*60)
+        #logger.debug(traceback.format_tb(sys.exc_info()))
+
+    def row_fields(self, filter1, rheader):
+        '''Find if data rows may be lists in the chain of filters from /filter1/ to the
+        csvio.Writer, for the "tuple" row mode: Every filter must be able to handle
+        them with compiled steps.
+
+        Returns the list of fields in the rows, with those added by the filters
+        after the /rheader/; Or None if rows are to be dicts.
+        '''
+        if self.ireader is not csv.DictReader:
+            return None
+        fields = rheader
+        node = filter1
+        while not isinstance(node, csvio.Writer):
+            if isinstance(node, c9r.util.filter.Stage):
+                node = node.next_filter
+                continue
+            if not node.tuple_rows or node.compile() is None:
+                logger.debug('Rows are dicts for filter {0}'.format(type(node).__name__))
+                return None
+            fields = node.fields(fields)
+            node = node.next_filter
+        return fields
+
+    def run_chunks(self, fnr, fnw):
+        '''Process the input file /fnr/ in chunks with worker processes.
+
+        The data part of /fnr/, after the skipped lines and the header, is split
+        into byte ranges at record boundaries. Each range is run through the filters
+        in a worker process, and the outputs are concatenated in input order into
+        /fnw/, so that it is the same as processing /fnr/ serially.
+
+        Returns number of rows (records) processed.
+        '''
+        lines = csvio.ByteLines(open(fnr, 'rb'))
+        fin = csvio.Reader(lines, self.ends)
+        if not self.skip_to_data(fin, fnr):
+            return 0
+        rheader = self.get_header(fin, fnr)
+        if rheader is False:
+            return 0
+        start = lines.offset if fin.read else lines.start
+        bounds = csvio.split_records(lines.input, start, os.path.getsize(fnr), self.chunks)
+        lines.input.close()
+        header = self.header or rheader
+        parts = [ '{0}.part{1}'.format(fnw, xn) for xn in range(len(bounds)-1) ]
+        logger.debug('Processing "{0}" in {1} chunks: {2}'.format(fnr, len(parts), bounds))
+        config = plain(self.config)
+        with ProcessPoolExecutor(min(self.chunks, len(parts))) as pool:
+            futures = [ pool.submit(run_chunk, config, fnr, bounds[xn], bounds[xn+1],
+                                    header, rheader or self.header, parts[xn])
+                        for xn in range(len(parts)) ]
+            results = [ fut.result() for fut in futures ]
+        lineno = 0
+        ended = False
+        with self.open_file(fnw, self.file_mode, True) as fout:
+            write_header = self.write_header and (fout.tell() == 0)
+            for part, (count, part_ended) in zip(parts, results):
+                # Chunks after the one with the "end-at" line are discarded:
+                if not ended:
+                    lineno += count
+                    ended = part_ended
+                    with open(part, 'rb') as fpart:
+                        if write_header and os.fstat(fpart.fileno()).st_size > 0:
+                            fout.write((','.join(header)+'\r\n').encode('utf-8'))
+                            write_header = False
+                        shutil.copyfileobj(fpart, fout)
+                os.unlink(part)
+        return lineno
+
+    def find_data(self, mapped, fnr):
+        '''Skip non-data and read the header, if so configured, in /mapped/, the
+        memory-mapped plain input file /fnr/.
+
+        Returns a tuple of the byte offset of the data and the header read; Or None
+        if no data is found.
+        '''
+        lines = csvio.ByteLines(mapped)
+        fin = csvio.Reader(lines, self.ends)
+        if not self.skip_to_data(fin, fnr):
+            return None
+        rheader = self.get_header(fin, fnr)
+        if rheader is False:
+            return None
+        return (lines.offset if fin.read else lines.start), rheader
+
+    def follow(self, fnr, fnw, offset=0, rheader=None):
+        '''Process the plain input file /fnr/, which may be growing, from byte
+        /offset/ with header /rheader/ read before; Or from the start if /offset/
+        is 0. Only complete lines, ending in a line feed, are processed, and the
+        output is appended to /fnw/ after the start.
+
+        Returns a tuple of the number of rows processed, the byte offset to follow
+        /fnr/ from later, and the header read. The offset is -1 if an "end-at" line
+        is met, meaning there is nothing more to follow; Or 0 if /fnr/ has lines
+        ending in CR only, which is then processed as a whole each time.
+        '''
+        with open(fnr, 'rb') as fbin:
+            size = os.fstat(fbin.fileno()).st_size
+            if size <= offset:
+                return 0, offset, rheader
+            with mmap.mmap(fbin.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if lone_cr.search(mapped, offset):
+                    logger.warning('{0}: Lines ending in CR may not be followed'.format(fnr))
+                    return self(fnr, fnw), 0, None
+                tail = mapped.rfind(b'\n', offset) + 1
+                if tail <= offset:
+                    return 0, offset, rheader
+                if offset == 0:
+                    data = self.find_data(mapped, fnr)
+                    if data is None or data[0] > tail:
+                        return 0, 0, None
+                    start, rheader = data
+                else:
+                    start = offset
+                ends = self.ends
+                end = tail
+                if ends and csvio.searchable(ends):
+                    ends = None
+                    end = min(tail, csvio.find_line(mapped, start, self.ends))
+                    if end < tail:
+                        tail = -1       # Ended: Nothing more to follow
+                count = csvio.count_lines(mapped, start, end)
+        fout = self.open_file(fnw, 'a' if offset else self.file_mode)
+        write_header = self.write_header and (fout.tell() == 0)
+        logger.debug('{0}: Following {1} lines from byte {2} to {3}'.format(fnr, count, start, end))
+        with open(fnr, 'r') as text:
+            text.seek(start)
+            fin = csvio.Reader(itertools.islice(text, count), ends, text=True)
+            lineno = self.run(fin, fout, self.header or rheader, rheader or self.header, write_header)
+        return lineno, (-1 if fin.ended else tail), rheader
+
+    def run_mapped(self, fnr, fnw):
+        '''Process the plain input file /fnr/ memory-mapped: The data part, after the
+        skipped lines and the header, and before any "end-at" line found in the
+        mapping, is read as counted lines of the file, with no checks line by line.
+
+        Returns number of rows (records) processed; Or None if /fnr/ is to be read
+        line by line, e.g. if it is empty, has lines ending in CR only, or the
+        "end-at" pattern may not be searched for as bytes.
+        '''
+        if self.ends and not csvio.searchable(self.ends):
+            return None
+        with open(fnr, 'rb') as fbin:
+            try:
+                mapped = mmap.mmap(fbin.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None     # Empty file
+            with mapped:
+                if lone_cr.search(mapped):
+                    return None
+                fout = self.open_output(fnw)
+                write_header = self.write_header and (fout.tell() == 0)
+                data = self.find_data(mapped, fnr)
+                if data is None:
+                    return 0
+                start, rheader = data
+                end = csvio.find_line(mapped, start, self.ends) if self.ends else len(mapped)
+                count = csvio.count_lines(mapped, start, end)
+                if end == len(mapped) and end > start and mapped[end-1] != 0x0a:
+                    count += 1  # Last line with no line feed
+        logger.debug('{0}: {1} lines of data from byte {2} to {3}'.format(fnr, count, start, end))
+        logger.debug('{0}: {1}to output CSV header: {2}'.format(fnw, '' if write_header else 'not ', self.header))
+        with open(fnr, 'r') as text:
+            text.seek(start)
+            fin = csvio.Reader(itertools.islice(text, count), text=True)
+            return self.run(fin, fout, self.header or rheader, rheader or self.header, write_header)
+
+    def skip_to_data(self, fin, fnr):
+        '''Skip non-data in /fin/ if so configured.
+
+        Returns True if /fin/ is at the start of data (or header), False if the
+        end of /fin/ is reached.
+        '''
         skip = dict({'line': 0, 'pass': 0, 'till': 0})
         skip.update(self.skip)
         lineno = 0
         while skip['more']:
             try:
                 line = next(fin)
-                if isinstance(line, bytes):
-                    line = line.decode('utf-8')
             except StopIteration:
                 logger.warning('Unexpected end-of-file when skiping to data in {0}:{1}'.format(fnr, lineno))
-                return 0
+                return False
             if skip['till'] and skip['till'].match(line):
                 logger.debug('Skip-till matching line {0}: {1}'.format(lineno+1, line))
                 fin.backup()
@@ -271,67 +1156,7 @@ class Pipeline(object):
                (skip['line'] and skip['line'] <= lineno):
                 break
             logger.debug('Skipping line {0}: {1}'.format(lineno, line))
-        # If no header is configured, assuming the next line in /fin/ is it:
-        # TBD: Make output header different than input header, optionally.
-        rheader = None
-        header = self.header
-        logger.debug('{0}: {1}to output CSV header: {2}'.format(fnw, '' if write_header else 'not ', header))
-        if self.read_header or header is None:
-            try:
-                rheader = [ self.header_clean.sub('', x) for x in next(fin).split(',') ]
-            except Exception as ex:
-                logger.debug('{2}: {0} (lineno = {1})'.format(ex, lineno, type(ex).__name__))
-                logger.warning('Unexpected error when reading CSV header in {0}:{1}'.format(fnr, lineno))
-                return 0
-            lineno += 1
-            logger.debug('Read header: {0}'.format(rheader))
-            for rex, fmt in self.header_fix:
-                nhdr = []
-                for col in rheader:
-                    mx = rex.match(col)
-                    if mx:
-                        try:
-                            col = fmt.format(*mx.groups())
-                        except Exception as ex:
-                            logger.warning('Exception fixing "{0}" with "{1}" and groups = {2}'.format(col, fmt, mx.groups()))
-                    nhdr.append(col)
-                rheader = nhdr
-            logger.debug('Header fixed: {0}'.format(rheader))
-        #
-        # Read through the input file and write out: Read error(s) are logged but ignored.
-        #
-        lineno = 0
-        with csvio.Writer(fout, header or rheader, write_header, self.dialect) as fw:
-            # filters: Filters to pass data through. If missing, then straight thru.
-            filter1 = fw
-            try:
-                for fltr in reversed(self.filters):
-                    modname, cname = fltr.rsplit('.')
-                    mod = __import__('c9r.util.filter.'+modname, fromlist=[cname])
-                    klass = getattr(mod, cname)
-                    filter1 = klass(filter1).open()
-            except ImportError:
-                logger.warning('ImportError for filter {0}'.format(fltr))
-                raise
-            csvreader = self.ireader(fin, fieldnames=(rheader or header))
-            while True:
-                try:
-                    line = next(csvreader)
-                    lineno += 1
-                    filter1.write(line)
-                except StopIteration:
-                    break
-                except Exception as ex:
-                    logger.warning('{2}: {0} (lineno = {1})'.format(ex, lineno, type(ex).__name__))
-                    logger.debug('\tline = {0})'.format(line))
-                    print('-'*60)
-                    traceback.print_exc(file=sys.stdout)
-                    print('-'*60)
-                    #logger.debug(traceback.format_tb(sys.exc_info()))
-            if True:
-                logger.debug('Closing filter 1: {0}, lines = {1}, fout size = {2}'.format(type(filter1).__name__, lineno, fout.tell()))
-                filter1.close()
-        return lineno
+        return True
 
     def __init__(self, config={}, cwd='.'):
         '''Initialize this CSV IO.
@@ -342,8 +1167,47 @@ class Pipeline(object):
         skip-line       Skip number of lines in the beginning of the input.
         skip-pass       Skip pass a line matching the skip-pass pattern.
         skip-till       Skip till a line matching the skip-till pattern.
-        filters         An optional sequential list of filters.
+        filters         An optional sequential list of filters, which may end with
+                        a node that branches (see branch()), or have "|" between
+                        stages that run in their own threads (see chain()).
+        stages          True to format and write the output in a thread of its own.
+        stage-batch     Number of rows passed between stages at a time. Defaults to
+                        1000.
+        stage-queue     Maximum number of batches queued for a stage. Defaults to 8.
+        chunks          Number of worker processes to process a large input file
+                        in chunks. Defaults to 0, meaning not to split input files.
+        chunk-min       Minimum size in bytes for an input file to be split. Defaults
+                        to 64MB.
+        checkpoint      Number of rows to process between checkpoints, to resume from
+                        if interrupted; Defaults to 0, meaning no checkpoints.
+        batch-size      Number of rows to read and pass to the filters as a batch.
+                        Defaults to 0, meaning one row at a time.
+        fuse-filters    True to compile the filters into one function per row, where
+                        the filters allow it. Defaults to true.
+        memory-map      True to memory-map a plain input file to find its data part.
+                        Defaults to true.
+        compress        Optional method to compress the output with as it is written:
+                        One of "bzip2", "gzip", "xz" or "zip" (see csvio.compressors).
+        row-mode        "dict" (default) for rows as dicts; Or "tuple" for rows as lists
+                        with fields by column, if all the filters allow it.
+        profile         True to profile reading, each filter, and writing, into
+                        /profile/, a list of the profiles of runs (see c9r.util.metrics).
+                        Filters are then not fused, and rows are dicts.
         '''
+        self.config = config
+        self.batch_size = config.get('batch-size', 0)
+        self.fuse = config.get('fuse-filters', True)
+        self.tuples = config.get('row-mode', 'dict') == 'tuple'
+        self.mmap = config.get('memory-map', True)
+        self.compress = config.get('compress', None)
+        if self.compress and self.compress not in csvio.compressors:
+            raise InvalidCompression(self.compress)
+        self.suffix = csvio.compressors[self.compress][1] if self.compress else ''
+        self.profile = [] if config.get('profile', False) else None
+        self.ckpt_rows = config.get('checkpoint', 0)
+        self.ckpt = None        # Checkpoint of the file being processed
+        self.chunks = config.get('chunks', 0)
+        self.chunk_min = config.get('chunk-min', 1<<26)
         self.dest = config.get('destination', cwd)
         ends = config.get('end-at', False)
         self.ends = re.compile(ends) if ends else ends
@@ -357,6 +1221,10 @@ class Pipeline(object):
                 skip[sk] = re.compile(skipping) if isinstance(skipping, str) else skipping
         self.skip = skip
         self.filters = config.get('filters', [])
+        self.branching = any(not isinstance(fltr, str) for fltr in self.filters)
+        self.stages = config.get('stages', False)
+        self.stage_batch = config.get('stage-batch', 1000)
+        self.stage_queue = config.get('stage-queue', 8)
         self.header = config.get('header', None)
         self.header_clean = re.compile(config.get('header-clean', r'\W+'))
         self.header_fix = [ (re.compile(xk),xv) for xk,xv
@@ -375,6 +1243,132 @@ class Pipeline(object):
         self.dialect = config.get('dialect', None)
 
 
+def run_chunk(config, fnr, start, end, header, rheader, fnw):
+    '''Process a chunk of input file /fnr/, from byte offset /start/ to /end/, in a
+    worker process. The output is written to /fnw/ without a header.
+
+    Returns a tuple of the number of rows processed, and if the "end-at" line is met.
+    '''
+    pipe = Pipeline(config)
+    with open(fnr, 'rb') as fin:
+        fin = csvio.Reader(io.TextIOWrapper(io.BufferedReader(csvio.Slice(fin, start, end)),
+                                            encoding='utf-8'), pipe.ends)
+        lineno = pipe.run(fin, open(fnw, 'w'), header, rheader, False)
+    return lineno, fin.ended
+
+def run_member(config, zipfn, fn, fnw, part=False):
+    '''Process the member /fn/ of the .zip archive /zipfn/, or the plain input file
+    /zipfn/, into /fnw/ in a worker process: As a part of an output, to be merged by
+    Pipeline.merge_parts(), if /part/, which is not compressed, and has the header
+    before its rows if "write-header" is configured.
+
+    Returns the number of rows processed.
+    '''
+    if part:
+        config = dict(config, compress=None, **{ 'file-mode': 'w' })
+    pipe = Pipeline(config)
+    if zipfn[-4:] != '.zip':
+        return pipe(zipfn, fnw)
+    with ZipFile(zipfn) as zipf, zipf.open(fn, 'r') as fin:
+        return pipe(fin, fnw)
+
+read_items = [ 'end-at', 'header', 'header-clean', 'header-fix', 'input-format',
+               'read-header', 'skip-line', 'skip-pass', 'skip-till' ]
+
+def read_key(config):
+    '''Return a key of the configuration for reading input in task /config/, so
+    tasks that read the same input files the same way may share a read of them.
+    Or None if the task is not to share, e.g. to "follow" files, or with "chunks"
+    or "checkpoint".
+    '''
+    if config.get('follow', False) or config.get('chunks', 0) > 1 or config.get('checkpoint', 0):
+        return None
+    return json.dumps([ plain(config.get(xk)) for xk in read_items ], sort_keys=True)
+
+def share_inputs(tasks, found):
+    '''Find input files /found/ by more than one of the given /tasks/, a list of
+    (config, pattern) tuples, that read them the same way (see read_key()).
+
+    /found/     A dict of lists of files found, with os.stat() results, by pattern,
+                from scan_patterns().
+
+    Returns a tuple of a list of groups, each a tuple of a list of the indices in
+    /tasks/ of those in the group, and a list of the files they share; And a list
+    of the rest of the files found for each of the /tasks/, or None if not found.
+    '''
+    files = [ found.get(cfg.get('pattern', pat)) for cfg, pat in tasks ]
+    keys = {}
+    for xn, (cfg, pat) in enumerate(tasks):
+        key = read_key(cfg)
+        if key is not None and files[xn] is not None:
+            keys.setdefault(key, []).append(xn)
+    groups = {}
+    shared = set()
+    for members in keys.values():
+        owners = {}
+        for xn in members:
+            for item in files[xn]:
+                owners.setdefault(item[0], (item, []))[1].append(xn)
+        for item, owned in owners.values():
+            if len(owned) > 1:
+                groups.setdefault(tuple(owned), []).append(item)
+                shared.update((xn, item[0]) for xn in owned)
+    rest = [ None if found is None else [ item for item in found if (xn, item[0]) not in shared ]
+             for xn, found in enumerate(files) ]
+    return [ (list(owned), items) for owned, items in groups.items() ], rest
+
+def rename_file(fn, rename):
+    '''Return the file name /fn/ renamed per the first of the /rename/ rules that
+    matches it: A list of tuples of a compiled regex and a format for its groups.
+    '''
+    fwname = fn
+    for rex, fmt in rename:
+        mx = rex.search(fwname)
+        if mx:
+            try:
+                fwname = fmt.format(*mx.groups())
+            except Exception as ex:
+                logger.warning('Exception fixing "{0}" with "{1}" and groups = {2}'.format(fn, fmt, mx.groups()))
+            break
+    return fwname
+
+def input_size(files, pattern=None):
+    '''Return the total size in bytes of input /files/: A list of tuples of a file
+    name and its os.stat() result, or None; Or, if /files/ is None, those matching
+    /pattern/.
+    '''
+    if files is None:
+        files = [ (fn, None) for fn in glob.glob(pattern or '') ]
+    size = 0
+    for fn, stinfo in files:
+        try:
+            size += (stinfo or os.stat(fn)).st_size
+        except OSError:
+            pass
+    return size
+
+def held_files(found, groups):
+    '''Return a set of the names of the input files that are /found/ for more than
+    one task, or in more than one of /groups/ of them, from share_inputs(): Their
+    actions are held until all tasks are done. Or None if the files of any task are
+    not found, but globbed.
+    '''
+    if None in found:
+        return None
+    counts = Counter(zipfn for files in found for zipfn, stinfo in files)
+    counts.update(zipfn for members, files in groups for zipfn, stinfo in files)
+    return set(zipfn for zipfn, count in counts.items() if count > 1)
+
+def plain(config):
+    '''Convert a configuration object, e.g. a c9r.jsonpy.Thingy, to plain dicts
+    and lists, so it may be passed to a worker process.
+    '''
+    if isinstance(config, (Null, dict)):
+        return { xk: plain(xv) for xk,xv in config.items() }
+    if isinstance(config, list):
+        return [ plain(xv) for xv in config ]
+    return config
+
 def atexit_delete(filename):
     '''A utility function for threaded jobs started in CSVFixer to delete a given file.
 
@@ -390,101 +1384,700 @@ def atexit_process(filename, act):
     '''
     if act == 'delete':
         return atexit_delete(filename)
-    if act in set([
-        'bzip2',        # Compress the file using bzip2;
-        'gzip',         # Compress using gzip;
-        'xz',           # Compress using xz;
-        'zip'           # Compress using zip.
-        ]):
-        cmd = (act if isinstance(act, list) else [act])+[filename]
+    if act in csvio.compressors:
+        # bzip2, gzip, xz or zip: Compress the file, in-process.
         try:
-            subprocess.check_call(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as err:
-            logger.error('Error from command {0}\n{1}'.format(cmd, err.output))
+            csvio.compress_file(filename, act)
+        except Exception as err:
+            logger.error('Error compressing "{0}" with {1}: {2}'.format(filename, act, err))
         return
     logger.debug('Unknown postprocess action: "{0}" "{1}"'.format(act, filename))
 
-def task(cwd):
-    '''Task as a gevent Greenlet that processes one file name pattern.
+class Scheduler(object):
+    '''Run jobs of tasks longest first, by the size of their input, so a task with a
+    large input does not start last and hold up the end: Up to /workers/ jobs at a
+    time; And, if /budget/ is not 0, only as many as fit in it by the total size of
+    their inputs, so that large tasks do not run together and exhaust memory. A job
+    larger than the budget runs alone.
 
-    /cwd/       Current working directory.
+    /timeline/  A list of tuples of the name, input size, start and end times of the
+                jobs run, in seconds from the start of run().
     '''
-    while True:
-        # config  = A dict containing configuration for the task;
-        # pattern = Pattern to match for input file names.
-        try:
-            config, pattern = jobqu.get(timeout=10)
-        except Empty:
-            break
-        if pattern == '' or config.get('disabled', False):
-            logger.debug('CSVFixer: Ignore empty pattern or disabled task')
-            continue
-        pattern = config.get('pattern', pattern) # 'pattern' may be configured inside task
-        dest = config.get('destination', cwd)
-        linkfolder = config.get('link-folder')
-        forge_path(dest)
-        process = Pipeline(config)
-        keep_times = config.get('times', False)
-        rename = [ (re.compile(xk),xv) for xk,xv in config.get('rename', {}).items() ]
-        logger.debug('CSVFixer: task = %s, destination = "%s"' % (pattern, dest))
-        for zipfn in glob.glob(pattern):
-            stinfo = os.stat(zipfn)
-            logger.debug('CSVFixer: Fixing file "{0}", mtime = {1}'.format(
-                    zipfn, time.strftime('%c', time.localtime(stinfo.st_mtime))))
-            if zipfn[-4:] != '.zip':
-                ## Assume that it is a text CSV file if file name does not end with .zip:
-                zipf = None
-                ziplist = [zipfn]
-            else:
-                try:
-                    zipf = ZipFile(zipfn)
-                    ziplist = zipf.namelist()
-                    logger.debug('CSVFixer: Found list in zip file = %s' % (format(ziplist)))
-                except BadZipfile:
-                    logger.warning('CSVFixer: zip file "%s" is bad.' % (zipfn))
-                    continue
-            fbasename = fwpath = ''
-            for fn in ziplist:
-                if fwpath == '' or config.get('file-mode') != 'a':
-                    fwname = fn
-                    for rex, fmt in rename:
-                        mx = rex.search(fwname)
-                        if mx:
-                            try:
-                                fwname = fmt.format(*mx.groups())
-                            except Exception as ex:
-                                logger.warning('Exception fixing "{0}" with "{1}" and groups = {2}'.format(fn, fmt, mx.groups()))
-                            break
-                    fbasename = os.path.basename(fwname)
-                    fwpath = os.path.join(dest, fbasename)
-                logger.debug('Processing file "{0}" to "{1}"'.format(fn, fwname))
-                lines = process(open(fn, 'r') if zipf is None else zipf.open(fn, 'r'), fwpath)
-                logger.debug('{0} lines processed in file "{1}"'.format(lines, fn))
-                # Set fixed file's timestamps if so configured:
-                if keep_times:
-                    os.utime(fwpath, (stinfo.st_mtime, stinfo.st_mtime))
-                    logger.debug('Set file "{0}" atime and mtime to {1}'.format(
-                            fwpath, time.strftime('%c', time.localtime(stinfo.st_mtime))))
-            # Archive the .zip file if configured so
-            if config.get('delete', False):
-                logger.debug('File "%s" registered to be deleted' % (zipfn))
-                atexit.register(atexit_delete, zipfn)
+    def fits(self, size):
+        '''Test if a job with input /size/ may start now.
+        '''
+        return len(self.running) < self.workers and (
+            not self.running or not self.budget or self.inflight+size <= self.budget)
+
+    def log(self):
+        '''Log the timeline of the jobs run.
+        '''
+        for name, size, begin, end in sorted(self.timeline, key=itemgetter(2)):
+            logger.info('Timeline: {0:8.2f}s - {1:8.2f}s ({2:8.2f}s), {3} bytes, task {4}'.format(
+                    begin, end, end-begin, size, name))
+
+    def run(self, jobs, start, done):
+        '''Run /jobs/: A list of tuples of a name, the size of the input, a function
+        and its arguments. A job is started with /start/(function, arguments), which
+        returns a handle for it; And /done/(handles) waits for some of the handles of
+        the jobs running to be done, and returns them.
+
+        Jobs are started in the order of their sizes, largest first, but a smaller
+        one is started ahead of those that do not fit in the budget.
+
+        Yields a tuple of each job and its handle, as it is done.
+        '''
+        pending = sorted(jobs, key=itemgetter(1), reverse=True)
+        begin = time.time()
+        self.running = {}
+        self.inflight = 0
+        while pending or self.running:
+            for job in list(pending):
+                if len(self.running) >= self.workers:
+                    break
+                if self.fits(job[1]):
+                    pending.remove(job)
+                    logger.debug('Starting task {0}, {1} bytes, {2} bytes in flight'.format(job[0], job[1], self.inflight))
+                    self.running[start(job[2], job[3])] = (job, time.time()-begin)
+                    self.inflight += job[1]
+            for handle in done(list(self.running)):
+                job, started = self.running.pop(handle)
+                self.inflight -= job[1]
+                self.timeline.append((job[0], job[1], started, time.time()-begin))
+                yield job, handle
+
+    def __init__(self, workers, budget=0):
+        self.workers = workers
+        self.budget = budget
+        self.running = {}
+        self.inflight = 0
+        self.timeline = []
+
+
+class Postprocessor(object):
+    '''Take the actions on input files collected by tasks (see Task): At exit, by
+    default; Or in a pool of /workers/ processes, as soon as the tasks are done,
+    while other tasks still run.
+
+    Actions on files /held/, e.g. those found by more than one task, are taken
+    only after all tasks are done, in close().
+    '''
+    def __call__(self, actions):
+        '''Take, or register at exit, the given /actions/: A list of (function,
+        arguments) tuples, where the first argument is the input file name.
+        '''
+        for act, args in actions:
+            if self.pool is None:
+                atexit.register(act, *args)
+            elif self.held is None or args[0] in self.held:
+                self.later.append((act, args))
             else:
-                act = config.get('postprocess')
-                if act != None:
-                    logger.debug('File "%s" registered to be postprocessed with "%s"' % (zipfn, act))
-                    atexit.register(atexit_process, zipfn, act)
+                self.futures.append(self.pool.submit(act, *args))
+
+    def close(self):
+        '''Take the actions held, and wait for all the actions to be done.
+        '''
+        if self.pool is None:
+            return
+        self.futures += [ self.pool.submit(act, *args) for act, args in self.later ]
+        logger.debug('Waiting for {0} postprocess actions'.format(len(self.futures)))
+        for fut in self.futures:
+            try:
+                fut.result()
+            except Exception as ex:
+                logger.error('Postprocess action failed: {0}: {1}'.format(type(ex).__name__, ex))
+        self.pool.shutdown()
+        self.pool = None
+        self.futures, self.later = [], []
+
+    def __init__(self, workers=0, held=()):
+        '''/workers/    Number of worker processes, or 0 to take actions at exit;
+        /held/      A set of input file names, or None to hold all of them.
+        '''
+        self.pool = ProcessPoolExecutor(workers) if workers else None
+        self.held = held
+        self.futures = []
+        self.later = []
+
+
+class Task(object):
+    '''A task that fixes files matching one file name pattern.
+
+    Actions to be taken on the input files after they are processed, i.e. delete
+    or postprocess, are collected in /actions/ as (function, arguments) tuples,
+    so the caller may decide when to perform them.
+
+    If "profile" is configured, the profiles of the input files processed are
+    collected in /profiles/ (see c9r.util.metrics); Otherwise, it is None.
+    '''
+    def finish(self, zipfn, outputs):
+        '''Finish fixing the input file /zipfn/ into /outputs/, a list of output files:
+        Collect the actions on /zipfn/, and delete or link the last output file, and
+        those of the branches of the filters, as configured. The latter are added to
+        /outputs/.
+        '''
+        config = self.config
+        self.files += 1
+        if self.process.ckpt_rows:
+            for fwp in outputs:
+                self.process.clear_checkpoint(fwp)
+        # Archive the .zip file if configured so
+        if config.get('delete', False):
+            logger.debug('File "%s" registered to be deleted' % (zipfn))
+            self.actions.append((atexit_delete, (zipfn,)))
+        else:
+            act = config.get('postprocess')
+            if act != None:
+                logger.debug('File "%s" registered to be postprocessed with "%s"' % (zipfn, act))
+                self.actions.append((atexit_process, (zipfn, act)))
+        if not outputs:
+            return
+        fwlast = outputs.pop()
+        for fwpath in [ fwlast ]+self.process.branch_outputs(fwlast):
+            if not os.path.exists(fwpath):
+                continue        # A branch not run, e.g. with no data in the input
             # Delete empty file if so configured:
-            if fwpath != '' and config.get('delete-empty', True) and os.stat(fwpath).st_size < 1:
+            if config.get('delete-empty', True) and csvio.is_empty(fwpath, self.process.compress):
                 os.unlink(fwpath)
                 logger.debug('Deleted empty output file "{0}"'.format(fwpath))
-            elif linkfolder:
+                continue
+            outputs.append(fwpath)
+            if self.linkfolder:
                 try:
-                    os.link(fwpath, os.path.join(linkfolder, fbasename))
+                    os.link(fwpath, os.path.join(self.linkfolder, os.path.basename(fwpath)))
                 except Exception as err:
-                    logger.error('Error link file "{0}" to folder {1}: {2}'.format(fwpath, linkfolder, err))
-        jobqu.task_done()
-        logger.debug('Task "{0}" completed'.format(pattern))
+                    logger.error('Error link file "{0}" to folder {1}: {2}'.format(fwpath, self.linkfolder, err))
+
+    def fix(self, zipfn, stinfo=None):
+        '''Fix one input file, which may be a .zip archive.
+
+        /zipfn/     Name of the input file.
+        /stinfo/    Optional os.stat() result for /zipfn/.
+
+        Returns a list of the output files; Or None if /zipfn/ is not processed.
+        '''
+        fixed = self.fix_with(zipfn, stinfo)
+        return None if fixed is None else fixed[0]
+
+    def fix_with(self, zipfn, stinfo=None, peers=[]):
+        '''Fix one input file, which may be a .zip archive, for this task and the
+        tasks in /peers/, that read it the same way (see read_key()), in one read.
+
+        Returns a list of the lists of output files of this task and the /peers/;
+        Or None if /zipfn/ is not processed.
+        '''
+        if stinfo is None:
+            stinfo = os.stat(zipfn)
+        logger.debug('CSVFixer: Fixing file "{0}", mtime = {1}'.format(
+                zipfn, time.strftime('%c', time.localtime(stinfo.st_mtime))))
+        if zipfn[-4:] != '.zip':
+            ## Assume that it is a text CSV file if file name does not end with .zip:
+            zipf = None
+            ziplist = [zipfn]
+        else:
+            try:
+                zipf = ZipFile(zipfn)
+                ziplist = zipf.namelist()
+                logger.debug('CSVFixer: Found list in zip file = %s' % (format(ziplist)))
+            except BadZipfile:
+                logger.warning('CSVFixer: zip file "%s" is bad.' % (zipfn))
+                self.errors.append('{0}: bad zip file'.format(zipfn))
+                return
+        tasks = [ self ]+peers
+        outputs = [ [] for tsk in tasks ]
+        written = [ tsk.output_size(ziplist, tsk.config.get('file-mode') == 'a')
+                    for tsk in tasks if tsk.profiles is not None ]
+        for fn in ziplist:
+            for tsk, fwlist in zip(tasks, outputs):
+                if not fwlist or tsk.config.get('file-mode') != 'a':
+                    fwlist.append(tsk.output_name(fn))
+            logger.debug('Processing file "{0}" to {1}'.format(fn, [ fwlist[-1] for fwlist in outputs ]))
+            fin = fn if zipf is None else zipf.open(fn, 'r')
+            if peers:
+                lines = self.process.run_shared(fin, [ (tsk.process, fwlist[-1]) for tsk, fwlist in zip(tasks, outputs) ])
+            else:
+                lines = self.process(fin, outputs[0][-1])
+            logger.debug('{0} lines processed in file "{1}"'.format(lines, fn))
+            for tsk, fwlist in zip(tasks, outputs):
+                tsk.lines += lines
+                tsk.set_times(fwlist[-1], stinfo)
+        for tsk, fwlist in zip(tasks, outputs):
+            tsk.finish(zipfn, fwlist)
+        for tsk, size in zip([ tsk for tsk in tasks if tsk.profiles is not None ], written):
+            tsk.profile_input(zipfn, stinfo.st_size, tsk.output_size(ziplist)-size)
+        return outputs
+
+    def fix_parallel(self, files, state=None):
+        '''Fix the input /files/, as in fix_files(), with the members of .zip archives,
+        and plain files, processed in parallel by a pool of "member-workers" worker
+        processes, across the files. The outputs of members written to one output in
+        "file-mode" "a" are merged into it in the order of the members, with the
+        header, if any, only before the first rows, as if processed one by one.
+
+        /state/     Optional StateIndex of input files, as in visit().
+        '''
+        config = plain(self.config)
+        append = config.get('file-mode') == 'a'
+        inputs = []
+        with ProcessPoolExecutor(self.workers) as pool:
+            for zipfn, stinfo in files:
+                if stinfo is None:
+                    stinfo = os.stat(zipfn)
+                if state is not None and not self.rescan and state.unchanged(zipfn, stinfo):
+                    logger.debug('CSVFixer: Skipping unchanged file "{0}"'.format(zipfn))
+                    self.skipped += 1
+                    continue
+                if zipfn[-4:] != '.zip':
+                    ziplist = [ zipfn ]
+                else:
+                    try:
+                        with ZipFile(zipfn) as zipf:
+                            ziplist = zipf.namelist()
+                    except BadZipfile:
+                        logger.warning('CSVFixer: zip file "%s" is bad.' % (zipfn))
+                        self.errors.append('{0}: bad zip file'.format(zipfn))
+                        continue
+                fwlist = []
+                parts = []
+                for fn in ziplist:
+                    if not fwlist or not append:
+                        fwlist.append(self.output_name(fn))
+                    fnw = '{0}.part{1}'.format(fwlist[-1], len(parts)) if append else fwlist[-1]
+                    parts.append((fn, fwlist[-1], fnw, pool.submit(run_member, config, zipfn, fn, fnw, append)))
+                inputs.append((zipfn, stinfo, fwlist, parts))
+            logger.debug('Task "{0}": Processing {1} members of {2} files in {3} workers'.format(
+                    self.pattern, sum(len(parts) for zipfn, stinfo, fwlist, parts in inputs), len(inputs), self.workers))
+            for zipfn, stinfo, fwlist, parts in inputs:
+                try:
+                    for fn, fwpath, fnw, fut in parts:
+                        lines = fut.result()
+                        logger.debug('{0} lines processed in file "{1}"'.format(lines, fn))
+                        self.lines += lines
+                    if append:
+                        self.process.merge_parts(fwlist[0], [ fnw for fn, fwpath, fnw, fut in parts ])
+                except Exception as ex:
+                    logger.error('Task "{0}": Error fixing "{1}": {2}: {3}'.format(self.pattern, zipfn, type(ex).__name__, ex))
+                    self.errors.append('{0}: {1}: {2}'.format(zipfn, type(ex).__name__, ex))
+                    self.discard(parts)
+                    continue
+                for fwpath in fwlist:
+                    self.set_times(fwpath, stinfo)
+                self.finish(zipfn, fwlist)
+                if state is not None:
+                    state.record(zipfn, stinfo, fwlist)
+
+    def discard(self, parts):
+        '''Discard the outputs of the members of an input that failed, in /parts/ as
+        in fix_parallel(): Wait for the runs of all of them to end, and remove the
+        files they wrote, the parts to merge in "file-mode" "a", or the outputs of the
+        members otherwise, so none is left in the destination to be transported.
+        '''
+        wait([ fut for fn, fwpath, fnw, fut in parts ])
+        for fn, fwpath, fnw, fut in parts:
+            try:
+                os.unlink(fnw)
+                logger.debug('Task "{0}": Removed "{1}" of failed input'.format(self.pattern, fnw))
+            except FileNotFoundError:
+                pass
+
+    def output_size(self, names, append=True):
+        '''Return the total size in bytes of the output files for input /names/, and
+        those of the branches of the filters, that exist; Or 0 if they are not to be
+        /append/ed to, but overwritten.
+        '''
+        if not append:
+            return 0
+        paths = set()
+        for fwpath in set(self.output_name(fn) for fn in names):
+            paths.update([ fwpath ]+self.process.branch_outputs(fwpath))
+        return sum(os.path.getsize(fwpath) for fwpath in paths if os.path.exists(fwpath))
+
+    def profile_input(self, zipfn, size, written):
+        '''Merge the profiles of the runs of the pipeline for input file /zipfn/, of
+        /size/ bytes, with /written/ bytes of output, into one in /profiles/.
+        '''
+        prof = metrics.merge(self.process.profile)
+        del self.process.profile[:]
+        prof.update(input=zipfn, bytes=size, written=written)
+        self.profiles.append(prof)
+
+    def output_name(self, fn):
+        '''Return the name of the output file for input /fn/, in the destination.
+        '''
+        return os.path.join(self.dest, os.path.basename(self.rename_output(fn))+self.process.suffix)
+
+    def set_times(self, fwpath, stinfo):
+        '''Set the times of output file /fwpath/, and those of the branches of the
+        filters, to the mtime in /stinfo/ of the input, if so configured.
+        '''
+        if not self.keep_times:
+            return
+        for fwpath in [ fwpath ]+self.process.branch_outputs(fwpath):
+            if not os.path.exists(fwpath):
+                continue
+            os.utime(fwpath, (stinfo.st_mtime, stinfo.st_mtime))
+            logger.debug('Set file "{0}" atime and mtime to {1}'.format(
+                    fwpath, time.strftime('%c', time.localtime(stinfo.st_mtime))))
+
+    def follow_file(self, state, fn, stinfo):
+        '''Process new lines in the plain input file /fn/, with os.stat() result
+        /stinfo/, from the byte offset recorded in /state/, unless to /rescan/.
+        '''
+        offset, rheader = (0, None) if self.rescan else state.position(fn, stinfo)
+        if offset < 0 or (offset and offset >= stinfo.st_size):
+            logger.debug('CSVFixer: No new data to follow in file "{0}"'.format(fn))
+            self.skipped += 1
+            return
+        fwpath = self.output_name(fn)
+        logger.debug('Following file "{0}" from byte {1} to "{2}"'.format(fn, offset, fwpath))
+        if self.profiles is not None:
+            written = self.output_size([ fn ], offset > 0 or self.config.get('file-mode') == 'a')
+        size = stinfo.st_size-offset
+        lines, offset, rheader = self.process.follow(fn, fwpath, offset, rheader)
+        logger.debug('{0} lines processed in file "{1}"'.format(lines, fn))
+        if self.profiles is not None:
+            self.profile_input(fn, size, self.output_size([ fn ])-written)
+        self.lines += lines
+        self.files += 1
+        state.advance(fn, stinfo, offset, rheader, fwpath)
+
+    def rename_output(self, fn):
+        '''Return the output file name for input /fn/, per the "rename" configuration.
+        '''
+        return rename_file(fn, self.rename)
+
+    def stats(self):
+        '''Return a dict of statistics about this task, which may be passed between processes.
+        '''
+        return dict(pattern=self.pattern, files=self.files, lines=self.lines,
+                    skipped=self.skipped, checked=self.checked,
+                    errors=self.errors, actions=self.actions, profile=self.profiles)
+
+    def fix_files(self, files, known=None):
+        '''Fix the input /files/, that match the pattern of this task: A list of
+        tuples of a file name and its os.stat() result, or None.
+
+        With a state file, input files unchanged since they were processed are
+        skipped, unless to /rescan/, and files processed are recorded in it. If
+        /known/ is the set of all the files matching the pattern, those recorded
+        but no longer there are forgotten.
+        '''
+        if not self.state_file or self.config.get('delete', False):
+            if self.workers > 1:
+                return self.fix_parallel(files)
+            for zipfn, stinfo in files:
+                self.fix(zipfn, stinfo)
+            return
+        with StateIndex(self.state_file, self.pattern) as state:
+            if self.workers > 1 and not self.follow:
+                self.fix_parallel(files, state)
+            else:
+                for zipfn, stinfo in files:
+                    self.visit(state, zipfn, stinfo)
+            if known is not None:
+                state.forget(known)
+            self.checked += state.checked
+
+    def visit(self, state, zipfn, stinfo=None):
+        '''Fix input file /zipfn/, with optional os.stat() result /stinfo/, per the
+        /state/ index: Skip it if it is unchanged, or follow it if so configured.
+        '''
+        if stinfo is None:
+            stinfo = os.stat(zipfn)
+        if self.follow and zipfn[-4:] != '.zip':
+            return self.follow_file(state, zipfn, stinfo)
+        if not self.rescan and state.unchanged(zipfn, stinfo):
+            logger.debug('CSVFixer: Skipping unchanged file "{0}"'.format(zipfn))
+            self.skipped += 1
+            return
+        outputs = self.fix(zipfn, stinfo)
+        if outputs is not None:
+            state.record(zipfn, stinfo, outputs)
+
+    def __call__(self, found=None, shared=()):
+        '''Fix all files matching the pattern of this task.
+
+        /found/     Optional list of the files matching the pattern, with os.stat()
+                    results, from scan_patterns(); Otherwise, they are globbed.
+        /shared/    Names of other files matching the pattern, that are fixed with
+                    other tasks in fix_group().
+        '''
+        forge_path(self.dest)
+        logger.debug('CSVFixer: task = %s, destination = "%s"' % (self.pattern, self.dest))
+        if found is None:
+            found = [ (zipfn, None) for zipfn in glob.glob(self.pattern) ]
+        self.fix_files(found, set(zipfn for zipfn, stinfo in found).union(shared))
+        logger.debug('Task "{0}" completed: {1} files skipped, {2} checked for changes'.format(
+                self.pattern, self.skipped, self.checked))
+        return self
+
+    def __init__(self, config, pattern, cwd='.', state_file=None, rescan=False):
+        '''Initialize a task.
+
+        /config/    A dict containing configuration for the task;
+        /pattern/   Pattern to match for input file names, unless it is configured
+                    inside /config/;
+        /cwd/       Current working directory;
+        /state_file/    Optional state file of processed input files (fixstate);
+        /rescan/    True to process all input files, even if unchanged.
+        '''
+        self.config = config
+        self.pattern = config.get('pattern', pattern)
+        self.dest = config.get('destination', cwd)
+        self.linkfolder = config.get('link-folder')
+        self.process = Pipeline(config)
+        self.keep_times = config.get('times', False)
+        self.workers = config.get('member-workers', 0)
+        if self.workers > 1 and (self.process.ckpt_rows or self.process.branching or self.process.profile is not None):
+            logger.warning('Task "{0}": Members are not processed in parallel with "checkpoint", "profile" or branching filters'.format(self.pattern))
+            self.workers = 0
+        self.follow = config.get('follow', False)
+        if self.follow and not state_file:
+            logger.warning('Task "{0}": A "state-file" is required to "follow" files'.format(self.pattern))
+        self.rename = [ (re.compile(xk),xv) for xk,xv in config.get('rename', {}).items() ]
+        self.state_file = state_file
+        self.rescan = rescan
+        self.actions = []
+        self.errors = []
+        self.profiles = None if self.process.profile is None else []
+        self.files = self.lines = self.skipped = self.checked = 0
+
+
+def is_enabled(config, pattern):
+    '''Test if a task with given /config/ and /pattern/ is to be run.
+    '''
+    if pattern == '' or config.get('disabled', False):
+        logger.debug('CSVFixer: Ignore empty pattern or disabled task')
+        return False
+    return True
+
+def fix_group(tasks, files):
+    '''Fix the input /files/ shared by /tasks/, a list of Task objects that read them
+    the same way, in one read of each file for all of them. With a state file, each
+    task skips files unchanged since it fixed them.
+
+    /files/     A list of tuples of a file name and its os.stat() result, or None.
+    '''
+    states = {}
+    try:
+        for tsk in tasks:
+            forge_path(tsk.dest)
+            if tsk.state_file and not tsk.config.get('delete', False):
+                states[tsk] = StateIndex(tsk.state_file, tsk.pattern)
+        for zipfn, stinfo in files:
+            if stinfo is None:
+                stinfo = os.stat(zipfn)
+            todo = []
+            for tsk in tasks:
+                state = states.get(tsk)
+                if state is not None and not tsk.rescan and state.unchanged(zipfn, stinfo):
+                    logger.debug('CSVFixer: Task "{0}" skipping unchanged file "{1}"'.format(tsk.pattern, zipfn))
+                    tsk.skipped += 1
+                else:
+                    todo.append(tsk)
+            if not todo:
+                continue
+            logger.debug('CSVFixer: Fixing file "{0}" for tasks {1}'.format(zipfn, [ tsk.pattern for tsk in todo ]))
+            fixed = todo[0].fix_with(zipfn, stinfo, todo[1:])
+            for tsk, outputs in zip(todo, fixed or []):
+                if tsk in states:
+                    states[tsk].record(zipfn, stinfo, outputs)
+    finally:
+        for tsk, state in states.items():
+            tsk.checked += state.checked
+            state.close()
+
+def run_group(jobs, cwd, files, memo_sizes=None, state_file=None, rescan=False):
+    '''Run a group of tasks that share input /files/ with fix_group(), e.g. in a
+    worker process: Returns a list of the task statistics, with errors caught and
+    reported in them, instead of raised.
+
+    /jobs/      A list of (config, pattern) of the tasks;
+    Others      As for run_task().
+    '''
+    try:
+        os.chdir(cwd)
+        memo.configure(memo_sizes)
+        tasks = [ Task(config, pattern, cwd, state_file, rescan) for config, pattern in jobs ]
+        fix_group(tasks, files)
+        return [ tsk.stats() for tsk in tasks ]
+    except Exception as ex:
+        logger.error('Tasks {0}: {1}: {2}'.format([ pattern for config, pattern in jobs ], type(ex).__name__, ex))
+        return [ dict(pattern=pattern, files=0, lines=0, skipped=0, checked=0, actions=[],
+                      errors=[traceback.format_exc()]) for config, pattern in jobs ]
+
+def run_task(config, pattern, cwd, memo_sizes=None, state_file=None, rescan=False, found=None, shared=()):
+    '''Run a task in a worker process, or a greenlet: Returns the task statistics,
+    with errors caught and reported in it, instead of raised.
+
+    /memo_sizes/    Optional dict of memo sizes, for c9r.util.memo.configure();
+    /state_file/, /rescan/  As for Task;
+    /found/, /shared/   Optional input files, as for Task.__call__().
+    '''
+    try:
+        os.chdir(cwd)
+        memo.configure(memo_sizes)
+        stats = Task(config, pattern, cwd, state_file, rescan)(found, shared).stats()
+        stats['memos'] = memo.stats()
+        return stats
+    except Exception as ex:
+        logger.error('Task "{0}": {1}: {2}'.format(pattern, type(ex).__name__, ex))
+        return dict(pattern=pattern, files=0, lines=0, skipped=0, checked=0, actions=[],
+                    errors=[traceback.format_exc()])
+
+def name_regex(name):
+    '''Return a regular expression for the file name pattern /name/, that matches
+    names as glob.glob() does: A wildcard does not match a leading ".".
+    '''
+    return '{0}{1}'.format('' if name[:1] == '.' else r'(?!\.)', fnmatch.translate(name))
+
+def path_matcher(pattern):
+    '''Return a function that tests if a file path matches /pattern/, as glob.glob()
+    and scan_patterns() match it: By each of the names in it, so a wildcard does not
+    match a "/", nor a leading ".", after the paths are normalized.
+    '''
+    names = [ re.compile(name_regex(xn)).match for xn in os.path.normpath(pattern).split(os.sep) ]
+    def matches(path):
+        parts = os.path.normpath(path).split(os.sep)
+        return len(parts) == len(names) and all(match(xp) for match, xp in zip(names, parts))
+    return matches
+
+def scan_patterns(patterns):
+    '''Find the files matching the given file name /patterns/, as glob.glob() does,
+    scanning each folder once for all the patterns in it, with their fnmatch
+    patterns combined in one regex.
+
+    Returns a dict, by pattern, of lists of tuples of a file name matched and its
+    os.stat() result. Patterns with wildcards in the folder are left out.
+    '''
+    folders = {}
+    for pat in set(patterns):
+        folder, name = os.path.split(pat)
+        if name and not glob.has_magic(folder):
+            folders.setdefault(folder, []).append((pat, name))
+    found = {}
+    for folder, pats in folders.items():
+        # Each pattern is an optional lookahead, to find all the patterns a file
+        # name matches:
+        regex = re.compile(''.join('(?:(?=(?P<t{0}>{1})))?'.format(xn, name_regex(name))
+                                   for xn, (pat, name) in enumerate(pats)))
+        routes = [ (regex.groupindex['t{0}'.format(xn)]-1, found.setdefault(pat, []))
+                   for xn, (pat, name) in enumerate(pats) ]
+        try:
+            entries = os.scandir(folder or '.')
+        except OSError as ex:
+            logger.debug('Cannot scan folder "{0}": {1}'.format(folder, ex))
+            continue
+        with entries:
+            for entry in entries:
+                groups = regex.match(entry.name).groups()
+                matched = [ files for xn, files in routes if groups[xn] is not None ]
+                if not matched or not entry.is_file():
+                    continue
+                item = (os.path.join(folder, entry.name), entry.stat())
+                for files in matched:
+                    files.append(item)
+    return found
+
+def run_actions(tsk):
+    '''Perform the actions collected in task /tsk/, e.g. to delete input files, now
+    instead of at exit, as in --watch mode.
+    '''
+    actions, tsk.actions = tsk.actions, []
+    for act, args in actions:
+        act(*args)
+
+def run_watched(tsk, func, *args):
+    '''Call /func/ with /args/ to fix files with task /tsk/, and perform its actions,
+    in --watch mode: Errors are logged, so watching goes on.
+    '''
+    try:
+        func(*args)
+    except Exception as ex:
+        logger.error('Task "{0}": {1}: {2}'.format(tsk.pattern, type(ex).__name__, ex))
+    try:
+        run_actions(tsk)
+    except Exception as ex:
+        logger.error('Task "{0}": Actions failed: {1}: {2}'.format(tsk.pattern, type(ex).__name__, ex))
+
+def rescan(tasks):
+    '''Fix all the files matching the patterns of /tasks/, found by scan_patterns(),
+    in --watch mode: At the start, or when files written may have been missed.
+    '''
+    found = scan_patterns([ tsk.pattern for tsk in tasks ])
+    for tsk in tasks:
+        run_watched(tsk, tsk, found.get(tsk.pattern))
+
+def report_watched(tasks, report=None):
+    '''Log the errors of /tasks/ in a round of files fixed in --watch mode, and write
+    their profiles to /report/, the "profile-report", if any, as run_jobs() does at
+    the end of a run; Then clear them, as the tasks are kept for the next round.
+    '''
+    for tsk in tasks:
+        for err in tsk.errors:
+            logger.error('Task "{0}" failed: {1}'.format(tsk.pattern, err))
+    if report and any(tsk.profiles for tsk in tasks):
+        metrics.write_report(report, [ tsk.stats() for tsk in tasks ])
+        logger.debug('Profiles of tasks written to "{0}"'.format(report))
+    for tsk in tasks:
+        tsk.errors = []
+        if tsk.profiles is not None:
+            tsk.profiles = []
+
+def watch_folders(tasks):
+    '''Return the set of the folders, that exist, of the patterns of /tasks/, with
+    their paths normalized.
+    '''
+    folders = set()
+    for tsk in tasks:
+        folders.update(os.path.normpath(xf) for xf in glob.glob(os.path.dirname(tsk.pattern) or '.'))
+    return folders
+
+def watch(tasks, fwatch, interval, rounds=None, report=None):
+    '''Fix files reported by watcher /fwatch/ (see c9r.util.fswatch) with the
+    matching /tasks/, a list of Task objects, and perform their actions.
+
+    The folders of the patterns of the tasks are globbed after each wait: If they
+    have changed, /fwatch/ is replaced with one for them, and the files in those
+    new are fixed. If /fwatch/ has missed files, all are rescanned (see rescan()).
+
+    /interval/  Seconds to wait for files at a time;
+    /rounds/    Number of times to wait, or None to watch forever;
+    /report/    Optional "profile-report" to write after each round (see
+                report_watched()).
+    '''
+    matchers = [ path_matcher(tsk.pattern) for tsk in tasks ]
+    folders = set(os.path.normpath(xf) for xf in fwatch.folders)
+    try:
+        while rounds is None or rounds > 0:
+            if rounds is not None:
+                rounds -= 1
+            paths = set(os.path.normpath(xp) for xp in fwatch.wait(interval))
+            found = watch_folders(tasks)
+            if found != folders:
+                logger.debug('Watching folders {0}, instead of {1}'.format(sorted(found), sorted(folders)))
+                fwatch.close()
+                fwatch = fswatch.watcher(sorted(found), isinstance(fwatch, fswatch.PollWatcher))
+                for folder in found-folders:
+                    try:
+                        paths.update(os.path.join(folder, xn) for xn in os.listdir(folder))
+                    except OSError as ex:
+                        logger.debug('Cannot list folder "{0}": {1}'.format(folder, ex))
+                folders = found
+            if fwatch.missed:
+                logger.warning('Files written may have been missed: Rescanning {0}'.format(sorted(folders)))
+                fwatch.missed = False
+                rescan(tasks)
+                paths = set()
+            for tsk, matches in zip(tasks, matchers):
+                mine = sorted(xp for xp in paths if matches(xp) and os.path.isfile(xp))
+                if not mine:
+                    continue
+                logger.debug('Task "{0}": Files written: {1}'.format(tsk.pattern, mine))
+                run_watched(tsk, tsk.fix_files, [ (xp, None) for xp in mine ])
+            report_watched(tasks, report)
+    finally:
+        fwatch.close()
 
 def main():
     '''
@@ -3,6 +3,7 @@
 import re
 from time import strftime, strptime
 from c9r.net.mac import InvalidMACAddress, MACFormat
+from c9r.util import memo
 from c9r.util.filter import Filter
 from c9r.pylog import logger
 
@@ -35,6 +36,13 @@ class AP(Filter):
         "Ownership":		"MCIT",
         "equipmentOwner":	"ISO",
         }
+    def fields(self, header):
+        '''Return /header/ with the fields added by this filter.
+        '''
+        added = list(self.assigned_values) + [ 'macAddress' ] + list(self.map) + [
+            'equipmentBuilding', 'equipmentFloor', 'equipmentRoom', 'equipmentRoomType' ]
+        return header + [ xk for xk in added if not xk in header ]
+
     def write(self, data):
         '''Normalize given data before writing to the pipe.
 
@@ -46,10 +54,11 @@ class AP(Filter):
             emac = data.get("EthernetMAC")
             if not emac:
                 return 0
-            val['macAddress'] = MACFormat.none(emac)
+            mac = memo.get('MAC', MACFormat.none)
+            val['macAddress'] = mac(emac)
             rmac = data.get('BaseRadioMAC')
             if rmac:
-                data['BaseRadioMAC'] = MACFormat.none(rmac)
+                data['BaseRadioMAC'] = mac(rmac)
             apname = data.get("APName")
             val.update(parse_apname(apname))
             for kd, ks in self.map.items():
@@ -1,14 +1,62 @@
 #! /usr/bin/env python3
 
-import re
+import re, time
+from datetime import date
 from time import strftime, strptime
+from types import MethodType
 from c9r.net.mac import MACFormat
+from c9r.util import memo
 from c9r.util.filter import Filter
 from c9r.pylog import logger
 from c9r.cisco.cli.port import nickname
 
 pi_timeformat = '%a %b %d %H:%M:%S %Z %Y'
 sql_timeformat = "%b %d %Y %I:%M:%S%p"
+months = { xm: xn+1 for xn,xm in enumerate(
+        'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()) }
+weekdays = frozenset('Mon Tue Wed Thu Fri Sat Sun'.split())
+hours = [ ('{0:02d}'.format((xh+11)%12+1), ['AM', 'PM'][xh//12]) for xh in range(24) ]
+
+
+def pi_minute(key):
+    '''Convert the part of a PI timestamp without the seconds, for example,
+    "Tue Mar 10 08:12: EST 2015", into a tuple of the SQL time before and after the
+    seconds, e.g. ("Mar 10 2015 08:12:", "AM").
+
+    Returns None if /key/ is not in the exact format expected; Such timestamps are
+    left to strptime().
+    '''
+    try:
+        if (key[0:3] not in weekdays or key[3] != ' ' or key[7] != ' ' or key[10] != ' ' or
+            key[13] != ':' or key[16:18] != ': ' or key[-5] != ' '):
+            return None
+        mon = months[key[4:7]]
+        tz = key[18:-5]
+        if not (tz in ('UTC', 'GMT') or tz in time.tzname):
+            return None
+        dd, hh, mm, year = key[8:10], key[11:13], key[14:16], key[-4:]
+        if not (dd+hh+mm+year).isdigit() or year < '1000' or hh > '23' or mm > '59':
+            return None
+        date(int(year), mon, int(dd))
+    except (IndexError, KeyError, ValueError):
+        return None
+    hx, ampm = hours[int(hh)]
+    return (' '.join([key[4:7], dd, year, hx])+':'+mm+':', ampm)
+
+def pi_to_sql(ts):
+    '''Convert a PI timestamp, e.g. "Tue Mar 10 08:12:01 EST 2015", to SQL time
+    format, e.g. "Mar 10 2015 08:12:01AM".
+
+    The conversion of the timestamp without the seconds is memoized by minute. Any
+    timestamp not in the exact format expected is converted with strptime() and
+    strftime(), which raise ValueError for invalid ones.
+    '''
+    sec = ts[17:19]
+    if ts[16:17] == ':' and len(sec) == 2 and sec < '60' and sec.isdigit():
+        hm = memo.get('LastSeen', pi_minute)(ts[:17]+ts[19:])
+        if hm is not None:
+            return hm[0]+sec+hm[1]
+    return strftime(sql_timeformat, strptime(ts, pi_timeformat))
 
 
 class Normalizer(Filter):
@@ -33,6 +81,57 @@ class Normalizer(Filter):
         'unknown': ''
         }
 
+    plan = None         # Plan to normalize data of known fields: See prepare()
+    tuple_rows = True
+    user_escapes = [ [ '\n', '\\n' ], [ '\r', '\\r' ], ['\t', '\\t' ] ]
+    memo_funcs = {      # Functions to normalize values, memoized by field
+        'InterfaceName':        'nickname',
+        'LastSessionLength':    'session_length',
+        'MAC':                  'mac',
+        'User':                 'user',
+        'Vendor':               'vendor'
+        }
+    mac = staticmethod(MACFormat.none)
+    nickname = staticmethod(nickname)
+
+    def compile(self):
+        '''Compile this filter into steps for c9r.util.filter.compile_chain().
+        '''
+        if type(self).write is not Normalizer.write:
+            return None
+        maps = self.maps()
+        if self.index is not None and self.normalize in maps:
+            return None         # normalize() is overridden, for dicts only
+        return [ ('map', fn) for fn in maps ]
+
+    def fields(self, header):
+        '''Normalized data has a "User" field, and a "Port" if there is "InterfaceName".
+        '''
+        added = [ 'User' ]
+        if 'InterfaceName' in header:
+            added.append('Port')
+        return header + [ xk for xk in added if not xk in header ]
+
+    def maps(self):
+        '''Return a list of functions to normalize data, to be applied in order.
+        '''
+        if type(self).normalize is not Normalizer.normalize:
+            return [ self.normalize ]
+        return [ self.normalizer() ]
+
+    def memo(self, field):
+        '''Return the memo (c9r.util.memo) of normalized values for /field/, which is
+        shared by all objects of the class of this one, as the functions memoized are
+        class or static methods. Memo sizes may be configured by field name.
+        '''
+        return memo.get(field, getattr(self, self.memo_funcs[field]))
+
+    def normalizer(self):
+        '''Return the function for Normalizer.normalize() on this object: The plan,
+        if one is made for the fields in data.
+        '''
+        return MethodType(Normalizer.normalize if self.plan is None else Normalizer.planned, self)
+
     def normalize(self, data):
         '''Here the data fields will be normalized before returned:
 
@@ -42,10 +141,12 @@ class Normalizer(Filter):
         o       /User/ IDs are normalized to "domain/userid" format, also handing
                 (wrongly-)escaped special characters embedded.
         '''
+        if self.plan is not None:
+            return self.planned(data)
         for xk in [ 'APMACAddress', 'MACAddress' ]:
             xv = data.get(xk)
             if xv:
-                data[xk] = MACFormat.none(xv)
+                data[xk] = self.memo('MAC')(xv)
         for xk in [ 'EndpointType' ]:
             xv = data.get(xk, '')
             if xv == 'Unknown':
@@ -59,11 +160,115 @@ class Normalizer(Filter):
             if data.get(xk, '') == 'Not Supported':
                 data[xk] = ''
         try:
-            it = self.retime.findall(data['LastSessionLength'])
+            sec = self.memo('LastSessionLength')(data['LastSessionLength'])
         except Exception:
-            it = []
+            sec = 0
+        if sec > 0:
+            data['LastSessionLength'] = sec
+        #
+        # Normalize vendor names
+        #
+        vendor_name = data.get('Vendor', '')
+        vendor = self.memo('Vendor')(vendor_name)
+        if vendor != vendor_name:
+            data['Vendor'] = vendor
+        data['User'] = self.memo('User')(data.get('User', ''))
+        port = data.get('InterfaceName')
+        if port:
+            data['InterfaceName'] = port = self.memo('InterfaceName')(port)
+            if not 'Port' in data:
+                data['Port'] = port
+        return data
+
+    def planned(self, data):
+        '''Normalize given /data/ with the plan made in prepare().
+        '''
+        for step in self.plan:
+            step(data)
+        return data
+
+    def prepare(self, header, index=None):
+        '''Make a plan to normalize data with the fields in /header/, with only the
+        steps for fields present, in the same order as in normalize().
+
+        Fields are addressed by their columns in /index/ if data rows are lists.
+        '''
+        key = (lambda xk: xk) if index is None else index.__getitem__
+        plan = []
+        for xk in [ 'APMACAddress', 'MACAddress' ]:
+            if xk in header:
+                plan.append(self.plan_field(key(xk), self.memo('MAC')))
+        if 'EndpointType' in header:
+            ek = key('EndpointType')
+            def endpoint_type(data):
+                xv = data[ek]
+                if xv == 'Unknown':
+                    data[ek] = ''
+                elif len(xv) > 0:
+                    data[ek] = xv.strip()
+            plan.append(endpoint_type)
+        for xk in [ 'CCX', 'E2E' ]:
+            if xk in header:
+                plan.append(self.plan_field(key(xk), lambda xv: '' if xv == 'Not Supported' else xv))
+        if 'LastSessionLength' in header:
+            lk = key('LastSessionLength')
+            session_length = self.memo('LastSessionLength')
+            def last_session_length(data):
+                try:
+                    sec = session_length(data[lk])
+                except Exception:
+                    sec = 0
+                if sec > 0:
+                    data[lk] = sec
+            plan.append(last_session_length)
+        if 'Vendor' in header:
+            vk = key('Vendor')
+            vendor = self.memo('Vendor')
+            def vendor_field(data):
+                vendor_name = data[vk]
+                xv = vendor(vendor_name)
+                if xv != vendor_name:
+                    data[vk] = xv
+            plan.append(vendor_field)
+        uk = key('User')
+        if 'User' in header:
+            user = self.memo('User')
+            def user_field(data):
+                data[uk] = user(data[uk])
+            plan.append(user_field)
+        else:
+            def user_field(data):
+                data[uk] = ''
+            plan.append(user_field)
+        if 'InterfaceName' in header:
+            plan.append(self.plan_field(key('InterfaceName'), self.memo('InterfaceName'),
+                                        None if 'Port' in header else key('Port')))
+        self.plan = plan
+        Filter.prepare(self, header, index)
+
+    @staticmethod
+    def plan_field(xk, func, copy=None):
+        '''Make a step in a plan to normalize field /xk/ with /func/ if it has a value.
+        The result is also copied to field /copy/ if given.
+        '''
+        if copy is None:
+            def step(data):
+                xv = data[xk]
+                if xv:
+                    data[xk] = func(xv)
+        else:
+            def step(data):
+                xv = data[xk]
+                if xv:
+                    data[xk] = data[copy] = func(xv)
+        return step
+
+    @classmethod
+    def session_length(cls, value):
+        '''Convert a /Last Session Length/ value to number of seconds.
+        '''
         sec = 0
-        for x in it:
+        for x in cls.retime.findall(value):
             xsec = 0
             try:
                 ui, ut = x
@@ -75,33 +280,29 @@ class Normalizer(Filter):
             except StopIteration:
                 pass
             sec += xsec
-        if sec > 0:
-            data['LastSessionLength'] = sec
-        #
-        # Normalize vendor names
-        #
-        vendor_name = data.get('Vendor', '')
-        vendor = self.vendor_map.get(vendor_name.lower())
-        if vendor is None:
-            vendor = self.reclean.sub(self.cleansub, vendor_name)
-        if vendor != vendor_name:
-            data['Vendor'] = vendor
-        # Process 'User' ID:
+        return sec
+
+    @classmethod
+    def user(cls, uid):
+        '''Normalize a 'User' ID.
+        '''
         #-- Hacky but no better way: Must deal with '\n', '\t' individually so not to
         #   convert '\' to '\\'.
         #-- Normalize to "domain/userid" format
-        uid = data.get('User', '')
         if uid:
-            for xt in [ [ '\n', '\\n' ], [ '\r', '\\r' ], ['\t', '\\t' ] ]:
+            for xt in cls.user_escapes:
                 uid = uid.replace(xt[0], xt[1])
             uid = uid.replace('\\', '/', 1)
-        data['User'] = uid
-        port = data.get('InterfaceName')
-        if port:
-            data['InterfaceName'] = port = nickname(port)
-            if not 'Port' in data:
-                data['Port'] = port
-        return data
+        return uid
+
+    @classmethod
+    def vendor(cls, vendor_name):
+        '''Normalize a vendor name.
+        '''
+        vendor = cls.vendor_map.get(vendor_name.lower())
+        if vendor is None:
+            vendor = cls.reclean.sub(cls.cleansub, vendor_name)
+        return vendor
 
     def write(self, data):
         '''Normalize given data before writing to the pipe.
@@ -109,17 +310,45 @@ class Normalizer(Filter):
         data = self.normalize(data)
         return 0 if data is None else Filter.write(self, data)
 
+    def write_batch(self, rows):
+        '''Normalize a list of data /rows/ before writing them to the pipe.
+        '''
+        return self.send(self.map_rows(self.normalize, rows))
+
 
 class Wired(Normalizer):
     '''Cisco Prime Infrastructure (ciscopi) wired report selective filter.
 
     Exception: StopIteration is raised when data is exhausted.
     '''
+    def compile(self):
+        '''Compile this filter into steps for c9r.util.filter.compile_chain(), with
+        the test for data to be filtered out first.
+        '''
+        if type(self).write is not Wired.write:
+            return None
+        predicate = self.predicate()
+        maps = self.maps()
+        if self.index is not None and (predicate == self.is_filtered or self.normalize in maps):
+            return None         # is_filtered() or normalize() is overridden, for dicts only
+        return [ ('filter', predicate) ] + [ ('map', fn) for fn in maps ]
+
     def is_filtered(self, data):
         '''Test if given data set is not a wired connection.
         '''
         return data.get('ConnectionType') != 'Wired'
 
+    def predicate(self):
+        '''Return a function equivalent to self.is_filtered(), without the method
+        calls through the class hierarchy.
+        '''
+        if type(self).is_filtered is not Wired.is_filtered:
+            return self.is_filtered
+        connection = self.column('ConnectionType')
+        def is_filtered(data):
+            return connection(data) != 'Wired'
+        return is_filtered
+
     def write(self, data):
         '''Actually write the data if it is wired.
         '''
@@ -127,6 +356,12 @@ class Wired(Normalizer):
             return 0
         return Normalizer.write(self, data)
 
+    def write_batch(self, rows):
+        '''Write the list of data /rows/ that are wired.
+        '''
+        is_filtered = self.is_filtered
+        return Normalizer.write_batch(self, [ data for data in rows if not is_filtered(data) ])
+
 
 class Wireless(Wired):
     '''Cisco Prime Infrastructure (ciscopi) wireless report selective filter.
@@ -138,19 +373,47 @@ class Wireless(Wired):
         '''
         return not Wired.is_filtered(self, data)
 
+    def predicate(self):
+        if type(self).is_filtered is not Wireless.is_filtered:
+            return Wired.predicate(self)
+        connection = self.column('ConnectionType')
+        def is_filtered(data):
+            return connection(data) == 'Wired'
+        return is_filtered
+
 
 class TimeNormalizer(Normalizer):
     '''Convert time string from "Tue Mar 10 08:12:01 EST 2015"
     to "Mar 10 2015 8:12:01AM".
     '''
-    def normalize(self, data):
-        '''Normalize Cisco PI data, and convert "LastSeen" field to SQL time format.
+    time_key = 'LastSeen'       # Key of the time field: See prepare()
+
+    def maps(self):
+        '''Return the time conversion and Normalizer.normalize() as separate steps.
+        '''
+        if type(self).normalize is not TimeNormalizer.normalize:
+            return Normalizer.maps(self)
+        return [ self.convert_time, self.normalizer() ]
+
+    def convert_time(self, data):
+        '''Convert "LastSeen" field to SQL time format.
         '''
         try:
-            data['LastSeen'] = strftime(sql_timeformat, strptime(data['LastSeen'], pi_timeformat))
+            data[self.time_key] = pi_to_sql(data[self.time_key])
         except:
             pass
-        return Normalizer.normalize(self, data)
+        return data
+
+    def prepare(self, header, index=None):
+        '''Find the column of the time field, if data rows are lists.
+        '''
+        self.time_key = 'LastSeen' if index is None else index.get('LastSeen')
+        Normalizer.prepare(self, header, index)
+
+    def normalize(self, data):
+        '''Normalize Cisco PI data, and convert "LastSeen" field to SQL time format.
+        '''
+        return Normalizer.normalize(self, self.convert_time(data))
 
 
 class WiredSQL(TimeNormalizer, Wired):
@@ -172,6 +435,15 @@ class WirelessGuest(WirelessSQL):
         return Wireless.is_filtered(self, data)\
             or not data.get('SSID') in self.guest_SSIDs
 
+    def predicate(self):
+        if type(self).is_filtered is not WirelessGuest.is_filtered:
+            return WirelessSQL.predicate(self)
+        guest_SSIDs = self.guest_SSIDs
+        connection, ssid = self.column('ConnectionType'), self.column('SSID')
+        def is_filtered(data):
+            return connection(data) == 'Wired' or not ssid(data) in guest_SSIDs
+        return is_filtered
+
 
 class WirelessUMHS(WirelessGuest):
     '''Filter for wireless devices on none of the guest wireless networks.
@@ -180,6 +452,15 @@ class WirelessUMHS(WirelessGuest):
         return Wireless.is_filtered(self, data)\
             or data.get('SSID') in self.guest_SSIDs
 
+    def predicate(self):
+        if type(self).is_filtered is not WirelessUMHS.is_filtered:
+            return WirelessGuest.predicate(self)
+        guest_SSIDs = self.guest_SSIDs
+        connection, ssid = self.column('ConnectionType'), self.column('SSID')
+        def is_filtered(data):
+            return connection(data) == 'Wired' or ssid(data) in guest_SSIDs
+        return is_filtered
+
 
 def test():
     '''Unit test for this filter module.
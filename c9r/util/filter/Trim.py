@@ -6,14 +6,48 @@ from c9r.util.filter import Filter
 class Trim(Filter):
     ''' Filter to trim extra spaces in (before and after) a string.
     '''
+    tuple_rows = True
+
+    def compile(self):
+        '''Compile this filter into steps for c9r.util.filter.compile_chain().
+        '''
+        if type(self).write is not Trim.write:
+            return None
+        return [ ('map', self.trim if self.index is None else self.trim_columns) ]
+
+    def prepare(self, header, index=None):
+        '''Find the columns to trim for the fields in /header/, if data rows are lists.
+        '''
+        if index is not None:
+            self.columns = sorted(set([ index[xk] for xk in header ]))
+        Filter.prepare(self, header, index)
+
+    def trim(self, data):
+        '''Trim all values in given /data/, which is expected to be a dictionary-type
+        object.
+        '''
+        for xk,xv in data.items():
+            data[xk] = xv.strip()
+        return data
+
+    def trim_columns(self, data):
+        '''Trim values of the fields input in given /data/, which is a list.
+        '''
+        for xn in self.columns:
+            data[xn] = data[xn].strip()
+        return data
+
     def write(self, data):
         '''Normalize given data before writing to the pipe.
 
         /data/ is expected to be a dictionary-type object, with.
         '''
-        for xk,xv in data.items():
-            data[xk] = xv.strip()
-        return Filter.write(self, data)
+        return Filter.write(self, self.trim(data))
+
+    def write_batch(self, rows):
+        '''Trim a list of data /rows/ before writing them to the pipe.
+        '''
+        return self.send(self.map_rows(self.trim, rows))
 
 
 if __name__ == '__main__':
@@ -3,9 +3,16 @@
 # $Id: __init__.py,v 1.10 2015/04/01 19:57:17 weiwang Exp $
 #
 
+import re, time
 from collections import deque
+from operator import itemgetter, methodcaller
+from queue import Empty
+from gevent.monkey import get_original
+from gevent.threadpool import ThreadPool
 from c9r.pylog import logger
 
+SimpleQueue = get_original('queue', 'SimpleQueue')      # Native, for Stage
+
 
 class Queue(deque):
     '''Simulation of gevent.JoinableQueue.
@@ -26,13 +33,31 @@ class Queue(deque):
         pass
 
 
+def write_batch(target, rows):
+    '''Write a list of data /rows/ to /target/, which may be a filter, or any object
+    with a write() function.
+    '''
+    fwrite = getattr(target, 'write_batch', None)
+    if callable(fwrite):
+        return fwrite(rows)
+    for data in rows:
+        target.write(data)
+
+
 class Filter(object):
     '''A filter object reads from an input queue and output to another, acting as a filter
     for CSV record processing.
 
     A filter object may be specifically open()'ed, or used in a "with" statement. But
     that is optional unless it does not have an open() function.
+
+    Data rows are dicts, unless the filters are prepared with an index of columns
+    (see prepare()), when they are lists. A filter that is able to process lists
+    sets /tuple_rows/ to True, and handles them in the steps from its compile().
     '''
+    index = None                # Column index, by field name, for rows that are lists
+    tuple_rows = False          # True if compile() handles rows that are lists
+
     def close(self):
         '''To exit this filter thread.
 
@@ -45,17 +70,49 @@ class Filter(object):
         self.try_next('close')
         logger.debug('{0}: closed, que size = {1}, output count = {2}'.format(klass, None if qu is None else qu.qsize(), self.count))
 
+    def compile(self):
+        '''Compile the processing of a data row in this filter, to be fused with other
+        filters in a chain by compile_chain().
+
+        Returns a list of steps, each a tuple of (kind, function), where /kind/ is
+        "filter" for a function that returns True for data to be filtered out, or
+        "map" for a function that returns the data processed, or None to drop it.
+        Or None if this filter cannot be compiled, which is the default.
+        '''
+        return None
+
+    def column(self, field):
+        '''Return a function that gets the value of /field/ in a data row, or None if
+        it is missing, by index if rows are lists (see prepare()).
+        '''
+        index = self.index
+        if index is None:
+            return methodcaller('get', field)
+        if field in index:
+            return itemgetter(index[field])
+        return lambda data: None
+
+    def fields(self, header):
+        '''Return the list of fields in data output from this filter, given the list
+        of fields in data input in /header/. By default, they are the same.
+        '''
+        return header
+
     def flush(self):
-        '''Write everything to the next filter.
+        '''Write everything queued to the next filter.
+
+        Returns number of rows written.
         '''
-        len = 0
+        count = 0
         while True:
             try:
-                len += self.next_filter.write(next(self))
-                self.count += 1
-            finally:
+                data = next(self)
+            except StopIteration:
                 break
-        return len
+            self.next_filter.write(data)
+            count += 1
+        self.count += count
+        return count
 
     def join(self):
         '''Join therads on the que.
@@ -70,6 +127,23 @@ class Filter(object):
             raise StopIteration('No queue in this filter.')
         return self.que.get()
 
+    def map_rows(self, func, rows):
+        '''Apply /func/ to each of the given list of data /rows/.
+
+        Returns a list of the results, without those that are None, or for which an
+        exception is raised -- The exception is logged.
+        '''
+        result = []
+        for data in rows:
+            try:
+                data = func(data)
+            except Exception as ex:
+                logger.warning('{0}: {1}: {2}, data = {3}'.format(type(self).__name__, type(ex).__name__, ex, data))
+                continue
+            if data is not None:
+                result.append(data)
+        return result
+
     def open(self):
         '''To start a filter thread/greenlet.
         '''
@@ -80,13 +154,71 @@ class Filter(object):
                 logger.debug('{0}: open - Queue created'.format(type(self).__name__))
         return self
 
+    def prepare(self, header, index=None):
+        '''Prepare this filter for data with the fields in /header/, once for each
+        input file. The next filter in chain is prepared with the output fields of
+        this filter.
+
+        /index/     Column index by field name, if data rows are lists: It covers the
+                    fields output from the last filter, with fields added by filters
+                    in columns after those in the input.
+        '''
+        self.index = index
+        self.try_next('prepare', self.fields(header), index)
+
+    def restore(self, state):
+        '''Restore this filter to a /state/ saved with state(), e.g. to resume from a
+        checkpoint.
+        '''
+        self.count = state['count']
+
+    def state(self):
+        '''Return the state of this filter, to be saved in a checkpoint: A dict that
+        may be saved in JSON. A filter that keeps more state than the number of rows
+        output, /count/, should add it here and in restore().
+        '''
+        return dict(count=self.count)
+
     def try_next(self, act, *args, **kwargs):
         '''Perform /act/ on self.input if it exists.
         '''
         fact = getattr(self.next_filter, act, None)
         if callable(fact):
             return fact(*args, **kwargs)
-        return Empty
+        return None
+
+    def send(self, rows):
+        '''Send a list of data /rows/ to the next filter, as a batch if the next filter
+        is able to take it.
+
+        Returns number of rows sent.
+        '''
+        if rows:
+            self.count += len(rows)
+            write_batch(self.next_filter, rows)
+        return len(rows)
+
+    def write_batch(self, rows):
+        '''Interface for caller to write a list of data /rows/ to this filter.
+
+        Filters that process data one row at a time in write() need not know about
+        batches: Each row is written with write() by default. A filter that passes
+        data through unchanged sends the batch to the next filter as is.
+
+        As in writing one row at a time, an error in a row is logged, and the rest of
+        the rows are still written.
+
+        Returns number of rows passed on to the next filter.
+        '''
+        count = self.count
+        if self.que is not None:
+            for data in rows:
+                self.que.put(data)
+        elif type(self).write is Filter.write:
+            self.send(rows)
+        else:
+            self.map_rows(self.write, rows)
+        return self.count - count
 
     def write(self, data):
         '''Interface for caller to write to this filter.
@@ -130,3 +262,401 @@ class Filter(object):
         if callable(getattr(next_filter, 'open', None)):
             next_filter = next_filter.open()
         self.next_filter = next_filter
+
+
+class Fused(Filter):
+    '''A filter that runs the steps compiled from a number of filters with one function.
+    '''
+    def write(self, data):
+        data = self.func(data)
+        return 0 if data is None else Filter.write(self, data)
+
+    def write_batch(self, rows):
+        return self.send(self.map_rows(self.func, rows))
+
+    def __init__(self, next_filter, steps, names=[]):
+        '''Initialize this filter with a list of /steps/ (see Filter.compile()).
+
+        /names/     Names of the filters fused, for logging.
+        '''
+        Filter.__init__(self, next_filter)
+        self.func = fuse(steps)
+        self.names = names
+
+
+class Tee(Filter):
+    '''A filter that writes each data row to a number of next filters, e.g. the heads
+    of the chains of filters for several outputs of one input. All but the last of
+    them get a copy of each row, as filters may change rows in place.
+
+    An error in one chain is logged, and the row, or batch of rows, is still written
+    to the others.
+    '''
+    def close(self):
+        for head in self.next_filters:
+            head.close()
+
+    def prepare(self, header, index=None):
+        self.index = index
+        for head in self.next_filters:
+            head.prepare(header, index)
+
+    def write(self, data):
+        self.count += 1
+        for head in self.rest:
+            try:
+                head.write(data.copy())
+            except Exception as ex:
+                logger.warning('{0}: {1}: {2}, data = {3}'.format(type(head).__name__, type(ex).__name__, ex, data))
+        return self.last.write(data)
+
+    def write_batch(self, rows):
+        self.count += len(rows)
+        for head in self.rest:
+            try:
+                write_batch(head, [ data.copy() for data in rows ])
+            except Exception as ex:
+                logger.warning('{0}: {1}: {2}, {3} rows lost'.format(type(head).__name__, type(ex).__name__, ex, len(rows)))
+        return write_batch(self.last, rows)
+
+    def connect(self, next_filters):
+        '''Connect this filter to a list of /next_filters/, e.g. after they are
+        compiled.
+        '''
+        self.next_filters = next_filters
+        self.rest = next_filters[:-1]
+        self.last = next_filters[-1]
+
+    def __init__(self, next_filters):
+        '''Initialize this filter with a list of /next_filters/.
+        '''
+        Filter.__init__(self, None)
+        self.connect(next_filters)
+
+
+class Route(Tee):
+    '''A filter that writes each data row to the first of a number of next filters
+    whose match it matches, so it is not tested again by the others. A row that
+    matches none of them is dropped.
+
+    A match is a dict of regular expressions by field name: A row matches it if the
+    value of each of the fields matches its expression, searched for in the value
+    as a string, which is empty if the field is missing. An empty match, or None,
+    matches all rows.
+
+    An error in one of the next filters does not keep the rows of a batch from the
+    others: The first error is raised after they are all written.
+    '''
+    def matcher(self, match):
+        '''Return a function that tests if a data row matches /match/.
+        '''
+        tests = [ (self.column(field), re.compile(rex).search) for field, rex in (match or {}).items() ]
+        def matches(data):
+            for value, search in tests:
+                value = value(data)
+                if not search('' if value is None else str(value)):
+                    return False
+            return True
+        return matches
+
+    def prepare(self, header, index=None):
+        self.index = index
+        self.tests = [ self.matcher(match) for match in self.matches ]
+        for head in self.next_filters:
+            head.prepare(header, index)
+
+    def write(self, data):
+        for matches, head in zip(self.tests, self.next_filters):
+            if matches(data):
+                self.count += 1
+                return head.write(data)
+        return 0
+
+    def write_batch(self, rows):
+        parts = [ [] for head in self.next_filters ]
+        for data in rows:
+            for matches, part in zip(self.tests, parts):
+                if matches(data):
+                    part.append(data)
+                    break
+        error = None
+        for head, part in zip(self.next_filters, parts):
+            if part:
+                self.count += len(part)
+                try:
+                    write_batch(head, part)
+                except Exception as ex:
+                    logger.warning('{0}: {1}: {2}, {3} rows lost'.format(type(head).__name__, type(ex).__name__, ex, len(part)))
+                    error = error or ex
+        if error is not None:
+            raise error
+        return sum(map(len, parts))
+
+    def __init__(self, next_filters, matches):
+        '''Initialize this filter with a list of /next_filters/, and a list of the
+        /matches/ for them.
+        '''
+        Tee.__init__(self, next_filters)
+        self.matches = matches
+        self.tests = [ self.matcher(match) for match in matches ]
+
+
+class Stage(Filter):
+    '''A filter that runs the rest of the chain, from its next filter on, in another
+    thread, so the stages of a chain overlap, e.g. reading and normalizing data in
+    one, and formatting, compressing and writing it out in another.
+
+    Rows are passed on in batches of /batch_size/ rows, through a queue of up to
+    /depth/ batches: A stage that writes to a full queue waits, so memory use is
+    bounded when a slow output backs up the chain.
+
+    The thread is a native one, of a gevent.threadpool.ThreadPool, even where gevent
+    has monkey patched threading, e.g. in csvfix, as blocking reads and writes of
+    files, and compression, do not yield to other greenlets. The queue is a native
+    one too, and a stage that waits for room in it waits in the pool, so greenlets
+    in the thread writing to the stage still run. The rest of the chain is closed,
+    and synced (see sync()), in the thread of the stage, as it may have stages of
+    its own, whose pools belong to it.
+    '''
+    tuple_rows = True           # Rows are passed on as they are
+    SYNC = object()             # Marks a sync() in the queue
+
+    def close(self):
+        '''Pass on the rows left, and wait for the thread to close the next filter
+        and finish: The thread is started for the rows left, if it has not been.
+        '''
+        self.put()
+        if self.thread is None:
+            return Filter.close(self)
+        self.send(None)
+        try:
+            self.done.get()
+        finally:
+            self.thread.kill()
+            self.thread = None
+
+    def put(self):
+        '''Put the rows collected into the queue, if any.
+        '''
+        if self.rows:
+            self.send(self.rows)
+            self.rows = []
+
+    def run(self):
+        '''Write the batches of rows in the queue to the next filter, till the end
+        of them, marked with None, in the thread; Then close the next filter.
+        '''
+        while True:
+            rows = self.batches.get()
+            try:
+                if rows is None:
+                    return Filter.close(self)
+                if rows is self.SYNC:
+                    sync_chain(self.next_filter)
+                else:
+                    write_batch(self.next_filter, rows)
+            except Exception as ex:
+                if rows is None:
+                    raise
+                logger.warning('{0}: {1}: {2}, {3} rows lost'.format(
+                        type(self).__name__, type(ex).__name__, ex, 0 if rows is self.SYNC else len(rows)))
+            finally:
+                self.free.put(True)
+
+    def send(self, item):
+        '''Put /item/, a batch of rows, None or SYNC, into the queue, when there is
+        room for it, and start the thread if it has not started.
+        '''
+        if self.thread is None:
+            self.thread = ThreadPool(2)
+            self.done = self.thread.spawn(self.run)
+        self.take()
+        self.batches.put(item)
+
+    def sync(self):
+        '''Wait for the rows written to this stage to be written to the next filter,
+        and through the stages after it, e.g. before a checkpoint.
+        '''
+        self.put()
+        if self.thread is None:
+            return sync_chain(self.next_filter)
+        self.send(self.SYNC)
+        tokens = [ self.take() for xn in range(self.depth+1) ]
+        for token in tokens:
+            self.free.put(token)
+
+    def take(self):
+        '''Take a token for an item in the queue, or being written, waiting in the
+        pool for one if there is none.
+        '''
+        try:
+            return self.free.get(False)
+        except Empty:
+            return self.thread.apply(self.free.get)
+
+    def write(self, data):
+        self.count += 1
+        self.rows.append(data)
+        if len(self.rows) >= self.batch_size:
+            self.put()
+        return 0
+
+    def write_batch(self, rows):
+        self.count += len(rows)
+        self.rows += rows
+        if len(self.rows) >= self.batch_size:
+            self.put()
+        return len(rows)
+
+    def __init__(self, next_filter, batch_size=1000, depth=8):
+        Filter.__init__(self, next_filter)
+        self.batch_size = batch_size
+        self.depth = depth
+        self.batches = SimpleQueue()
+        self.free = SimpleQueue()       # Tokens for the items in the queue and written
+        for xn in range(depth+1):
+            self.free.put(True)
+        self.rows = []
+        self.thread = None
+
+
+class Probe(Filter):
+    '''A filter that counts the rows written to its next filter, and measures the
+    wall and CPU time spent in it and the rest of the chain after it, to profile
+    the filters in a chain (see probe_stats()).
+
+    /name/      Name of the next filter, in reports.
+    /wall/, /cpu/   Seconds spent in the next filter and the rest of the chain.
+    '''
+    def close(self):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            Filter.close(self)
+        finally:
+            self.wall += time.perf_counter()-wall
+            self.cpu += time.thread_time()-cpu
+
+    def write(self, data):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        self.count += 1
+        try:
+            return self.next_filter.write(data)
+        finally:
+            self.wall += time.perf_counter()-wall
+            self.cpu += time.thread_time()-cpu
+
+    def write_batch(self, rows):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        self.count += len(rows)
+        try:
+            return write_batch(self.next_filter, rows)
+        finally:
+            self.wall += time.perf_counter()-wall
+            self.cpu += time.thread_time()-cpu
+
+    def __init__(self, next_filter, name):
+        Filter.__init__(self, next_filter)
+        self.name = name
+        self.wall = self.cpu = 0.0
+
+
+def fuse(steps):
+    '''Fuse a list of /steps/ (see Filter.compile()) into one function, that takes a
+    data row, and returns it processed, or None if it is filtered out.
+    '''
+    code = [ 'def fused(data):' ]
+    funcs = {}
+    for xn, (kind, func) in enumerate(steps):
+        name = 'f{0}'.format(xn)
+        funcs[name] = func
+        if kind == 'filter':
+            code.append('    if {0}(data): return None'.format(name))
+        else:
+            code.append('    data = {0}(data)'.format(name))
+            code.append('    if data is None: return None')
+    code.append('    return data')
+    exec('\n'.join(code), funcs)
+    return funcs['fused']
+
+def chain_state(head):
+    '''Return a list of the states of the filters in the chain starting with /head/.
+    '''
+    states = []
+    while isinstance(head, Filter):
+        states.append(head.state())
+        head = head.next_filter
+    return states
+
+def sync_chain(head):
+    '''Wait for the stages in the chain starting with /head/ (see Stage) to write
+    out the rows written to them: The first stage syncs those after it.
+    '''
+    while isinstance(head, Filter):
+        if isinstance(head, Stage):
+            return head.sync()
+        head = head.next_filter
+
+def next_probes(node, threads=False):
+    '''Return a list of the first Probes in the chain starting with /node/, or in
+    each branch of a Tee in it: Only those in the same thread, unless /threads/ is
+    True to look past stages (see Stage).
+    '''
+    while isinstance(node, Filter) and not isinstance(node, Probe):
+        if isinstance(node, Stage) and not threads:
+            return []
+        if isinstance(node, Tee):
+            return [ xp for head in node.next_filters for xp in next_probes(head, threads) ]
+        node = node.next_filter
+    return [ node ] if isinstance(node, Probe) else []
+
+def probe_stats(head):
+    '''Return a list of the statistics of the Probes in the chain starting with
+    /head/ (see Probe), in order: Each a dict of the "name" of the filter probed,
+    the rows "in" and "out" of it, "dropped", and the "wall" and "cpu" seconds spent
+    in it, less those in the next probes in the same thread.
+    '''
+    stats = []
+    for probe in next_probes(head, True):
+        after = next_probes(probe.next_filter, True)
+        rows = sum(xp.count for xp in after) if after else probe.count
+        wall, cpu = probe.wall, probe.cpu
+        for xp in next_probes(probe.next_filter):
+            wall -= xp.wall
+            cpu -= xp.cpu
+        stats.append({ 'name': probe.name, 'in': probe.count, 'out': rows,
+                       'dropped': max(0, probe.count-rows), 'wall': wall, 'cpu': cpu })
+        stats += probe_stats(probe.next_filter)
+    return stats
+
+def restore_chain(head, states):
+    '''Restore the filters in the chain starting with /head/ to the /states/ saved
+    with chain_state().
+    '''
+    for state in states:
+        head.restore(state)
+        head = head.next_filter
+
+def compile_chain(head):
+    '''Compile a chain of filters starting with /head/: Filters in a row that can be
+    compiled are fused into one Fused filter, as are those in each branch of a Tee.
+
+    Returns the head of the compiled chain.
+    '''
+    steps = []
+    names = []
+    node = head
+    while isinstance(node, Filter):
+        xsteps = node.compile()
+        if xsteps is None:
+            break
+        steps += xsteps
+        names.append(type(node).__name__)
+        node = node.next_filter
+    if isinstance(node, Tee):
+        node.connect([ compile_chain(xf) for xf in node.next_filters ])
+    elif isinstance(node, Filter):
+        node.next_filter = compile_chain(node.next_filter)
+    if not names:
+        return node
+    logger.debug('Fused filters: {0}'.format(names))
+    return Fused(node, steps, names)
@@ -3,14 +3,20 @@
 # $Id: csvio.py,v 1.13 2015/12/11 15:16:47 weiwang Exp $
 #
 
+import bz2, gzip, lzma, os, shutil, time, zipfile
 import csv
+import io
+import itertools
 import re
+from operator import itemgetter
 from c9r.pylog import logger
 from c9r.util.filter import Filter
 
 
 class Reader(object):
     '''A buffered reader to allow rewinding a line, with optional /ends/.
+
+    A binary input, e.g. a member of a zip file, is read in blocks with BlockLines.
     '''
     def __next__(self):
         '''Return the last line if the input is backed up.
@@ -21,9 +27,12 @@ class Reader(object):
         else:
             self.read = True
         line = self.line
+        if self.blocks:
+            return line         # Decoded, and checked for /ends/ in BlockLines
         line = line.decode('utf-8') if isinstance(line, bytes) else line
         if self.ends and self.ends.match(line):
             logger.debug('Ends proessing at: {0})'.format(line))
+            self.end_met = True
             raise StopIteration
         return line
 
@@ -34,6 +43,28 @@ class Reader(object):
             raise StopIteration('This reader is already backed up')
         self.read = False
 
+    @property
+    def ended(self):
+        '''True if reading has ended at a line matching /ends/.
+        '''
+        return self.end_met or (self.blocks and self.input.ended)
+
+    def lines(self):
+        '''Return an iterator of the rest of the lines, e.g. for the data: Lines
+        are read in bulk from the input, with no per-line work in this reader, if
+        possible; Otherwise this reader itself is returned.
+        '''
+        if self.blocks:
+            rest = self.input.iter_lines()
+        elif self.ends or not self.text:
+            return self
+        else:
+            rest = self.input
+        if self.read:
+            return rest
+        self.read = True
+        return itertools.chain([ self.line ], rest)
+
     def open(self):
         '''To make this object ready for reading.
 
@@ -53,14 +84,20 @@ class Reader(object):
             return fact()
         return self.input
 
-    def __init__(self, input_file, ends=None):
+    def __init__(self, input_file, ends=None, text=None):
         '''Initial this reader with an input, which is requried to have a
         next() function.
+
+        /text/  True if /input_file/ yields lines as str, to be read in bulk with
+                lines(); Defaults to whether it is a text file.
         '''
-        self.input = input_file
         self.line = None
         self.read = True
+        self.end_met = False
         self.ends = re.compile(ends) if ends else ends
+        self.blocks = isinstance(input_file, (io.BufferedIOBase, io.RawIOBase))
+        self.input = BlockLines(input_file, self.ends) if self.blocks else input_file
+        self.text = isinstance(input_file, io.TextIOBase) if text is None else text
 
     __enter__ = open
     '''To allow this object to be used with "with".'''
@@ -74,13 +111,389 @@ class Reader(object):
         return self
 
 
+class BlockLines(object):
+    '''Read lines from a binary file in large blocks: Each block is cut after its
+    last newline and decoded in UTF-8 at once, then split into lines, which keep
+    their line endings as in iterating over the binary file.
+
+    /ends/      Optional regex for the line to end at: Lines are matched one by one
+                only in blocks where it is found, if it is safe to search for it
+                in a block (see ends_search).
+    /ended/     True if reading has ended at a line matching /ends/.
+    '''
+    block_size = 1<<20
+    unsafe = re.compile(r'\$|\\[AZ]|\(\?<?!')   # Anchors and lookarounds beyond a line
+
+    def __next__(self):
+        try:
+            line = self.lines[self.pos]
+        except IndexError:
+            self.fill()
+            line = self.lines[0]
+        self.pos += 1
+        return line
+
+    def close(self):
+        self.input.close()
+
+    def ends_search(self, ends):
+        '''Return a function to search a block of lines for any line that may match
+        /ends/, or None if it is not safe to: A line in the block may match /ends/
+        and yet not in the block, with the lines before and after it, in case of
+        start- or end-of-string anchors and negative lookarounds.
+        '''
+        if self.unsafe.search(ends.pattern):
+            return None
+        return re.compile('^(?:{0})'.format(ends.pattern), ends.flags | re.M).search
+
+    def fill(self):
+        '''Read and decode the next block of lines.
+
+        Raises StopIteration at the end of the input, or of the lines before /ends/;
+        Or UnicodeDecodeError for a line that is not in UTF-8, which is skipped.
+        '''
+        self.lines, self.pos = [], 0
+        if self.ended:
+            raise StopIteration
+        data = self.data
+        while not self.eof:
+            block = self.input.read(self.block_size)
+            if not block:
+                self.eof = True
+                break
+            data += block
+            if b'\n' in block:
+                break
+        cut = len(data) if self.eof else data.rfind(b'\n')+1
+        if cut == 0:
+            self.data = data
+            raise StopIteration
+        chunk, self.data = data[:cut], data[cut:]
+        try:
+            text = chunk.decode('utf-8')
+        except UnicodeDecodeError:
+            text = self.decode_lines(chunk)
+        lines = io.StringIO(text, newline='\n').readlines()
+        ends = self.ends
+        if ends and (self.search is None or self.search(text)):
+            for xn, line in enumerate(lines):
+                if ends.match(line):
+                    logger.debug('Ends proessing at: {0})'.format(line))
+                    self.ended = True
+                    del lines[xn:]
+                    break
+        if not lines:
+            raise StopIteration
+        self.lines = lines
+
+    def decode_lines(self, chunk):
+        '''Decode the lines in /chunk/ before the first one not in UTF-8, which is
+        skipped with the exception raised if it is the first. The rest of /chunk/ is
+        put back to be read next.
+        '''
+        try:
+            chunk.decode('utf-8')
+        except UnicodeDecodeError as ex:
+            bad = chunk.rfind(b'\n', 0, ex.start)+1
+            if bad == 0:
+                self.data = chunk[chunk.find(b'\n', ex.start)+1 or len(chunk):]+self.data
+                raise
+            self.data = chunk[bad:]+self.data
+            return chunk[:bad].decode('utf-8')
+
+    def iter_lines(self):
+        '''Return an iterator of the rest of the lines, read in blocks.
+        '''
+        return itertools.chain.from_iterable(self.iter_blocks())
+
+    def iter_blocks(self):
+        '''Generate the rest of the lines in lists, one for each block: Lines not
+        in UTF-8 are logged and skipped.
+        '''
+        lines = self.lines[self.pos:]
+        while True:
+            if lines:
+                yield lines
+            lines = []
+            try:
+                self.fill()
+            except StopIteration:
+                return
+            except UnicodeDecodeError as ex:
+                logger.warning('{0}: {1}'.format(type(ex).__name__, ex))
+                continue
+            lines, self.lines = self.lines, []
+
+    def __init__(self, input_file, ends=None):
+        self.input = input_file
+        self.ends = ends
+        self.search = ends and self.ends_search(ends)
+        self.ended = self.eof = False
+        self.data = b''
+        self.lines, self.pos = [], 0
+
+    def __iter__(self):
+        return self
+
+
+class ListReader(object):
+    '''A CSV reader that reads rows as lists, in place of a csv.DictReader that reads
+    them as dicts: As in csv.DictReader, empty rows are skipped, and missing values
+    are None. But values beyond the fields are dropped.
+
+    /input/     Lines of CSV data to read;
+    /size/      Number of fields in the input;
+    /width/     Number of columns in the lists read, with those after /size/ None,
+                for fields to be added by filters.
+    '''
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.reader)
+        while row == []:
+            row = next(self.reader)
+        size = self.size
+        if len(row) != size:
+            row = (row + [None]*size)[:size]
+        if self.pad:
+            row += self.pad
+        return row
+
+    def __init__(self, input, size, width, **kwargs):
+        self.reader = csv.reader(input, **kwargs)
+        self.size = size
+        self.pad = [None]*(width-size)
+
+
+class ByteLines(object):
+    '''Read lines from a binary file, decoded in UTF-8 with newlines translated as in
+    text mode, while keeping track of the byte offsets of the lines.
+
+    /offset/    Byte offset after the last line read;
+    /start/     Byte offset of the last line read.
+    '''
+    def __next__(self):
+        line = self.input.readline()
+        if not line:
+            raise StopIteration
+        self.start = self.offset
+        self.offset += len(line)
+        line = line.decode('utf-8')
+        return line[:-2]+'\n' if line[-2:] == '\r\n' else line
+
+    def close(self):
+        self.input.close()
+
+    def __init__(self, input_file):
+        self.input = input_file
+        self.start = self.offset = input_file.tell()
+
+    def __iter__(self):
+        return self
+
+
+class Slice(io.RawIOBase):
+    '''A read-only raw file object for the part of binary file /input_file/ from
+    byte offset /start/ to /end/.
+    '''
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        size = min(len(buf), self.end - self.pos)
+        if size <= 0:
+            return 0
+        self.input.seek(self.pos)
+        size = self.input.readinto(memoryview(buf)[:size])
+        self.pos += size
+        return size
+
+    def __init__(self, input_file, start, end):
+        io.RawIOBase.__init__(self)
+        self.input = input_file
+        self.pos = start
+        self.end = end
+
+
+# Patterns that may match differently as bytes: Non-ASCII, ".", negated or Unicode
+# classes, start- and end-of-string anchors, escapes of non-ASCII, negative
+# lookarounds and flags.
+bytes_unsafe = re.compile(r'[^\x00-\x7f]|\.|\[\^|\$|\\[wWsSdDbBAZxuUN0-9]|\(\?(?:[aiLmsux]+|<?!)')
+
+compressors = {                 # Open functions and file name suffixes, by method
+    'bzip2':    (bz2.open, '.bz2'),
+    'gzip':     (gzip.open, '.gz'),
+    'xz':       (lzma.open, '.xz'),
+    'zip':      (None, '.zip')
+    }
+
+
+class Compressed(object):
+    '''An output file that is compressed as it is written, with the given /method/,
+    one of those in /compressors/. The data is text, unless it is /binary/.
+
+    A file appended to gets another stream, e.g. a gzip member, which is read as
+    part of the same data. A zip file may not be appended to, as it would then have
+    two members of the same name.
+
+    /tell()/ is the size of data written, after the size of the file appended to,
+    so it is 0 only for a new and empty output, as for a plain file.
+    '''
+    def close(self):
+        self.output.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def flush(self):
+        self.output.flush()
+
+    def tell(self):
+        return self.start + self.size
+
+    def write(self, data):
+        self.size += len(data)
+        return self.output.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __init__(self, name, mode='w', method='gzip', binary=False):
+        '''Open file /name/ to write, or append to if /mode/ is "a".
+        '''
+        opener, suffix = compressors[method]
+        self.name = name
+        self.mode = mode
+        self.start = os.path.getsize(name) if mode == 'a' and os.path.exists(name) else 0
+        self.size = 0
+        self.archive = None
+        if opener is None:
+            if self.start:
+                raise ValueError('Zip file "{0}" may not be appended to'.format(name))
+            self.archive = zipfile.ZipFile(name, 'w', zipfile.ZIP_DEFLATED)
+            member = os.path.basename(name)
+            member = zipfile.ZipInfo(member[:-len(suffix)] if member.endswith(suffix) else member,
+                                     time.localtime()[:6])
+            member.compress_type = zipfile.ZIP_DEFLATED
+            output = self.archive.open(member, 'w', force_zip64=True)
+        else:
+            output = opener(name, mode+'b')
+        self.output = output if binary else io.TextIOWrapper(output)
+
+
+def compress_file(name, method):
+    '''Compress file /name/ with /method/, one of those in /compressors/, into a
+    file of the name with the suffix of the method, and remove it, as the gzip
+    command does.
+
+    Returns the name of the compressed file.
+    '''
+    fnz = name+compressors[method][1]
+    with open(name, 'rb') as fin, Compressed(fnz, 'w', method, True) as fout:
+        shutil.copyfileobj(fin, fout, 1<<20)
+    shutil.copystat(name, fnz)
+    os.unlink(name)
+    return fnz
+
+def is_empty(name, method=None):
+    '''Test if the output file /name/, compressed with /method/ if not None, has no
+    data in it.
+    '''
+    if method is None:
+        return os.path.getsize(name) < 1
+    opener = compressors[method][0]
+    if opener is None:
+        with zipfile.ZipFile(name) as archive:
+            return all(info.file_size == 0 for info in archive.infolist())
+    with opener(name, 'rb') as fin:
+        return not fin.read(1)
+
+def searchable(regex):
+    '''Return True if /regex/, compiled from a str pattern, finds the same in bytes
+    of text in UTF-8 as a bytes pattern, with no /bytes_unsafe/ parts or flags.
+    '''
+    return not (bytes_unsafe.search(regex.pattern) or regex.flags & re.IGNORECASE)
+
+def find_line(mapping, start, ends):
+    '''Find the first line in /mapping/, e.g. a mmap of a file in UTF-8, from byte
+    offset /start/ at the start of a line, that matches regex /ends/ as in Reader.
+    Lines are searched for as bytes, and then matched one by one as text.
+
+    Returns the byte offset of the line found, or the size of /mapping/ if none; Or
+    None if /ends/ may not be searched for as bytes.
+    '''
+    if not searchable(ends):
+        return None
+    search = re.compile(b'(?m)^(?:'+ends.pattern.encode('ascii')+b')').search
+    pos = start
+    while True:
+        mx = search(mapping, pos)
+        if mx is None:
+            return len(mapping)
+        pos = mx.start()
+        eol = mapping.find(b'\n', pos)
+        line = mapping[pos:len(mapping) if eol < 0 else eol+1]
+        try:
+            line = line.decode('utf-8')
+            if ends.match(line[:-2]+'\n' if line[-2:] == '\r\n' else line):
+                return pos
+        except UnicodeDecodeError:
+            pass
+        pos += 1
+
+def count_lines(mapping, start, end, bsize=1<<20):
+    '''Count the lines in /mapping/, e.g. a mmap of a file, from byte offset /start/
+    to /end/, as the number of line feeds in it, in blocks of /bsize/ bytes.
+    '''
+    return sum(mapping[pos:min(pos+bsize, end)].count(b'\n') for pos in range(start, end, bsize))
+
+def split_records(input_file, start, end, parts, quotechar=b'"', bsize=1<<20):
+    '''Split CSV data in binary /input_file/, from byte offset /start/ to /end/, into
+    up to /parts/ byte ranges of about the same size, at record boundaries.
+
+    A record boundary is a newline that is not inside a quoted field, so the data is
+    scanned once to keep track of the quotes.
+
+    Returns a list of byte offsets, from /start/ to /end/, of the boundaries.
+    '''
+    step = (end - start) // parts
+    bounds = [ start ]
+    target = start + step
+    quoted = 0
+    input_file.seek(start)
+    pos = start
+    while pos < end and len(bounds) < parts:
+        block = input_file.read(min(bsize, end - pos))
+        if not block:
+            break
+        xi = block.find(b'\n', max(0, target - pos))
+        while xi >= 0:
+            if (quoted + block.count(quotechar, 0, xi)) % 2 == 0:
+                bounds.append(pos + xi + 1)
+                target = max(bounds[-1], start + step*len(bounds))
+                if len(bounds) >= parts:
+                    break
+            xi = block.find(b'\n', max(xi + 1, target - pos))
+        quoted += block.count(quotechar)
+        pos += len(block)
+    if bounds[-1] < end:
+        bounds.append(end)
+    return bounds
+
+
 class Writer(Filter):
-    '''CSV writer: write data received in CSV format, using a csv.DictWriter
-    object, to the next filter.
+    '''CSV writer: write data received in CSV format, using a csv.writer object
+    with a projection of the fields in the header, to the next filter.
 
     A Writer is able to write out a CSV header if provided. But it does ntt to be
     explicitly provided.
 
+    If the next filter is not a Filter, e.g. a file, the CSV lines are written to it
+    in blocks of about /block_size/ characters.
+
     parameters:
 
     /next_filter/       The target for this writer to write to;
@@ -88,37 +501,148 @@ class Writer(Filter):
     /write_header/      True to write header (Defaults to true);
     /dialect/           CSV dialect, defaults to 'excel'.
     '''
+    block_size = 1<<16
+
+    class Projection(object):
+        '''In place of a csv.DictWriter, write rows with a csv.writer, projecting
+        the columns for the header: By key for rows that are dicts, where missing
+        values are written as empty, and extra fields are ignored; Or by index for
+        rows that are lists.
+        '''
+        def writerow(self, row):
+            try:
+                values = self.project(row)
+            except KeyError:
+                values = self.values(row)
+            return self.csvw.writerow(values)
+
+        def writerows(self, rows):
+            try:
+                values = list(map(self.project, rows))
+            except KeyError:
+                values = [ self.values(row) for row in rows ]
+            return self.csvw.writerows(values)
+
+        def values(self, row):
+            '''Project a /row/ that is missing some of the fields, the slow way.
+            '''
+            return [ row.get(xk, '') for xk in self.columns ]
+
+        def __init__(self, csvw, columns):
+            '''/columns/ is a list of keys, or column numbers in rows that are lists,
+            where None is for a column not in rows.
+            '''
+            self.csvw = csvw
+            self.columns = columns
+            if None in columns:
+                self.project = lambda row: [ '' if xn is None else row[xn] for xn in columns ]
+            elif len(columns) == 1:
+                xn = columns[0]
+                self.project = lambda row: (row[xn],)
+            else:
+                self.project = itemgetter(*columns)
 
     class Shim(object):
-        '''A shim between the csv.DictWriter and this Writer class, to
-        provide a way for csv.DictWirter to "write" to the que in this
-        Writer.
+        '''A shim between the csv.writer and this Writer class, to provide a way for
+        csv.writer to "write" to the next filter of this Writer.
         '''
         def write(self, data):
-            if data[0:8] == 'LastSeen':
-                logger.debug('{0}: Queuing {1} to {2}'.format(type(self).__name__, data, type(self.csvw).__name__))
+            if self.lines is not None:
+                self.lines.append(data)
+                return
             Filter.write(self.csvw, data)
 
         def __init__(self, writer):
             self.csvw = writer
+            self.lines = None   # A list to collect lines from a batch
+
+    def close(self):
+        '''Write out lines in the buffer before closing.
+        '''
+        self.write_buffer()
+        Filter.close(self)
+
+    def prepare(self, header, index=None):
+        '''Project the columns of the fields in the header from rows that are lists,
+        if an /index/ of columns is given; Or from rows that are dicts otherwise.
+        '''
+        self.index = index
+        columns = self.fields_out if index is None else [ index.get(xk) for xk in self.fields_out ]
+        self.csvo = self.Projection(self.csvo.csvw, columns)
 
     def write(self, data):
-        '''Run given /data/ through the csv.DictWriter to convert from
-        a dict to a CSV row with its writerow() function.
+        '''Convert given /data/ to a CSV row with the csv.writer, and write it.
         '''
         try:
             if self.header != None:
-                # TBD: To use csv.DictWriter.writeheader()
-                # SuSE has Python 2.6.x, where the function does not exist.
-                # self.csvo.writeheader()
-                self.next_filter.write(','.join(self.header)+'\r\n')
-                self.header = None
-                logger.debug('Wrote header to {0}'.format(self.next_filter))
+                self.write_header()
             self.csvo.writerow(data)
-            self.flush()
         except Exception as ex:
             logger.debug('Got Exception {1}, data={0}'.format(data, ex))
             raise
+        buf = self.buffer
+        if buf is not None:
+            self.count += 1
+            if buf.tell() >= self.block_size:
+                self.write_buffer()
+
+    def write_batch(self, rows):
+        '''Convert a list of /rows/ to CSV rows, and write them as one batch to the
+        next filter.
+        '''
+        if not rows:
+            return 0
+        if self.header != None:
+            self.write_header()
+        buf = self.buffer
+        if buf is not None:
+            pos = buf.tell()
+            try:
+                self.csvo.writerows(rows)
+                count = len(rows)
+            except Exception:
+                # Write the rows one by one, so only those in error are skipped:
+                buf.seek(pos)
+                buf.truncate()
+                count = len(self.map_rows(self.csvo.writerow, rows))
+            self.count += count
+            if buf.tell() >= self.block_size:
+                self.write_buffer()
+            return count
+        shim = self.shim
+        shim.lines = lines = []
+        try:
+            self.csvo.writerows(rows)
+        except Exception:
+            del lines[:]
+            self.map_rows(self.csvo.writerow, rows)
+        finally:
+            shim.lines = None
+        if isinstance(self.next_filter, Filter):
+            return self.send(lines)
+        self.count += len(lines)
+        self.next_filter.write(''.join(lines))
+        return len(lines)
+
+    def write_buffer(self):
+        '''Write the lines in the buffer, if any, to the next filter.
+        '''
+        buf = self.buffer
+        if buf is not None and buf.tell() > 0:
+            self.next_filter.write(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
+
+    def write_header(self):
+        '''Write the header to the next filter, only once.
+        '''
+        header = ','.join(self.header)+'\r\n'
+        if self.buffer is None:
+            self.next_filter.write(header)
+        else:
+            self.buffer.write(header)
+        self.header = None
+        logger.debug('Wrote header to {0}'.format(self.next_filter))
 
     writerow = write
     '''To give csvio.Writer a writerow() so it's may be used in place of csv.DictWriter.'''
@@ -127,12 +651,16 @@ class Writer(Filter):
         '''The CSV writer that writes data to CSV format with given
         header.
 
-        A csv.DictWriter is used to write out each row received in this writer.
+        A csv.writer is used to write out each row received in this writer.
         Extra fields in each row is ignored.
         '''
         Filter.__init__(self, next_filter)
-        self.csvo = csv.DictWriter(self.Shim(self), header, extrasaction='ignore',
-                                   dialect=(dialect or 'excel'))
+        self.shim = self.Shim(self)
+        self.buffer = None if isinstance(self.next_filter, Filter) else io.StringIO()
+        self.dialect = dialect or 'excel'
+        self.fields_out = header
+        csvw = csv.writer(self.shim if self.buffer is None else self.buffer, dialect=self.dialect)
+        self.csvo = self.Projection(csvw, header)
         self.header = header if write_header else None # Header to write
         logger.debug('write_header={0}, header={1}'.format(write_header, header))
 
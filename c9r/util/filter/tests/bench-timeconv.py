@@ -0,0 +1,33 @@
+#! /usr/bin/env python3
+'''
+Micro-benchmark of converting PI timestamps to SQL time format: CiscoPI.pi_to_sql()
+vs. strptime() and strftime().
+
+Usage: bench-timeconv.py [number-of-timestamps]
+'''
+
+import random, sys, timeit
+from time import strftime, strptime
+from c9r.util.filter.CiscoPI import pi_to_sql, pi_timeformat, sql_timeformat
+
+
+def stdlib(ts):
+    return strftime(sql_timeformat, strptime(ts, pi_timeformat))
+
+def main(count=100000):
+    # A report spans a few days of timestamps, in the same timezone.
+    rand = random.Random(0)
+    stamps = [ 'Mon Mar {0:02d} {1:02d}:{2:02d}:{3:02d} UTC 2015'.format(
+        rand.randint(10, 16), rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59))
+               for x in range(count) ]
+    assert [ pi_to_sql(ts) for ts in stamps ] == [ stdlib(ts) for ts in stamps ]
+    results = {}
+    for func in [ stdlib, pi_to_sql ]:
+        results[func.__name__] = sec = min(timeit.repeat(
+            lambda: [ func(ts) for ts in stamps ], number=1, repeat=3))
+        print('{0:>10}: {1:.3f} sec, {2:,.0f} timestamps/sec'.format(func.__name__, sec, count/sec))
+    print('   speedup: {0:.1f}x'.format(results['stdlib']/results['pi_to_sql']))
+
+
+if __name__ == '__main__':
+    main(*[ int(x) for x in sys.argv[1:2] ])
@@ -5,7 +5,7 @@ Unit tests for ../CiscoPI.py.
 
 import sys
 from Ofilter import Ofilter
-from c9r.util.filter.CiscoPI import Normalizer, Wired, Wireless, WiredSQL, WirelessSQL, WirelessGuest, WirelessUMHS
+from c9r.util.filter.CiscoPI import pi_to_sql, Normalizer, Wired, Wireless, WiredSQL, WirelessSQL, WirelessGuest, WirelessUMHS
 
 xout = Ofilter()
 
@@ -169,3 +169,85 @@ def test_5_3():
     # t51 should not fiter out "Wireless" with "MGuest-UMHS", t52 should:
     assert t51.is_filtered(apple_inc) == False
     assert t52.is_filtered(apple_inc) == True
+
+"""
+Test 6: Write in batches
+"""
+def test_6_1():
+    t61 = Wired(xout.re_init())
+    assert t61.write_batch([
+        {'MACAddress': '00:00:a1:01:a8:7b', 'ConnectionType': 'Wired', 'LastSessionLength': '1 min 2 sec'},
+        {'MACAddress': '00:00:a1:01:a8:7c', 'ConnectionType': 'Wireless'},
+        {'MACAddress': None, 'ConnectionType': 'Wired', 'EndpointType': None},
+        {'MACAddress': '0000.a101.a87d', 'ConnectionType': 'Wired', 'User': 'Domain\\User'}
+    ]) == 2
+    assert xout.readlines() == [''.join([
+        '{"MACAddress": "0000a101a87b", "ConnectionType": "Wired", "LastSessionLength": 62, "User": ""}',
+        '{"MACAddress": "0000a101a87d", "ConnectionType": "Wired", "User": "Domain/User"}'
+    ])]
+    t61.close()
+
+"""
+Test 7: Fuse a chain of filters.
+"""
+def test_7_1():
+    from c9r.util.filter import Fused, compile_chain
+    from c9r.util.filter.Trim import Trim
+    rows = [
+        {'MACAddress': '00:00:a1:01:a8:7b', 'ConnectionType': 'Wireless', 'SSID': 'MGuest-UMHS'},
+        {'MACAddress': '00:00:a1:01:a8:7c', 'ConnectionType': 'Wireless', 'SSID': 'UMHS-8021X'},
+        {'MACAddress': '00:00:a1:01:a8:7d', 'ConnectionType': 'Wired', 'SSID': ''}
+    ]
+    for klass in [ Wired, Wireless, WirelessGuest, WirelessUMHS ]:
+        expected = []
+        for data in rows:
+            klass(xout.re_init()).write(dict(data))
+            expected += xout.readlines()
+        t71 = compile_chain(Trim(klass(xout.re_init())))
+        assert isinstance(t71, Fused)
+        assert t71.names == [ 'Trim', klass.__name__ ]
+        for data in rows:
+            t71.write(dict(data))
+        assert [''.join(expected)] == xout.readlines()
+
+"""
+Test 8: Normalize data with a plan for given header.
+"""
+def test_8_1():
+    header = [ 'MACAddress', 'Vendor', 'User', 'LastSessionLength', 'CCX', 'InterfaceName' ]
+    rows = [
+        [ '00:18:fe:8a:e0:3c', 'Apple,Inc', 'Domain\\User', '1 min 2 sec', 'Not Supported', '' ],
+        [ '', 'Intel, Inc.', '', '2hrs10min 2sec', 'V4', 'Gi1/0/1' ],
+        [ '0018.fe8a.e03d', '', 'Domain'+chr(10)+'User', '', '', '' ]
+    ]
+    expected = []
+    for row in rows:
+        Normalizer(xout.re_init()).write(dict(zip(header, row)))
+        expected += xout.readlines()
+    t81 = Normalizer(xout.re_init())
+    t81.prepare(header)
+    assert len(t81.plan) == 6
+    for row in rows:
+        t81.write(dict(zip(header, row)))
+    assert [''.join(expected)] == xout.readlines()
+    assert t81.fields(header) == header + [ 'Port' ]
+
+"""
+Test 9: Convert PI timestamps to SQL time format.
+"""
+def test_9_1():
+    for ts, sql in [
+            ('Mon Mar 16 07:25:00 GMT 2015', 'Mar 16 2015 07:25:00AM'),
+            ('Mon Mar 16 07:25:59 GMT 2015', 'Mar 16 2015 07:25:59AM'),
+            ('Tue Mar 10 00:12:01 UTC 2015', 'Mar 10 2015 12:12:01AM'),
+            ('Tue Mar 10 12:12:01 UTC 2015', 'Mar 10 2015 12:12:01PM'),
+            ('Tue Mar 10 23:59:60 UTC 2015', 'Mar 10 2015 11:59:60PM'),
+            ('tue MAR 10 13:12:01 utc 2015', 'Mar 10 2015 01:12:01PM')
+    ]:
+        assert pi_to_sql(ts) == sql
+    for ts in [ 'Sun Feb 29 06:58:12 UTC 2015', 'Mon Mar 16 07:25:00 XYZ 2015', '' ]:
+        try:
+            pi_to_sql(ts)
+            assert False
+        except ValueError:
+            pass
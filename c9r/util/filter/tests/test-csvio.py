@@ -3,8 +3,8 @@
 Unit tests for ../csvio.py.
 '''
 
-import csv, io, os, sys
-from c9r.util.filter.csvio import Reader, Writer
+import csv, io, os, re, sys
+from c9r.util.filter.csvio import BlockLines, Reader, Writer, find_line
 from Ofilter import Ofilter
 
 if 'DEBUG' in os.environ:
@@ -48,3 +48,101 @@ def test_2():
     '''
     xt = Writer(Ofilter(), header, write_header=True)
     xt.close()
+
+def test_3():
+    '''Write rows in batches, with a row in error skipped.
+    '''
+    xout = Ofilter()
+    with Writer(xout, header) as xt:
+        assert xt.write_batch([]) == 0
+        assert xt.write_batch([
+            { 'MACAddress': '11:22:33:44:55:66', 'User': 'user1', 'LastSessionLength': '1 sec' },
+            { 'MACAddress': '11:22:33:44:55:67', 'User': 'user2', 'LastSessionLength': '2 sec' }
+        ]) == 2
+        xt.write_batch([ None, { 'MACAddress': '11:22:33:44:55:68', 'User': 'user3' } ])
+    assert xout.readlines() == [''.join([
+        '"MACAddress,User,LastSessionLength\\r\\n"',
+        '"11:22:33:44:55:66,user1,1 sec\\r\\n"',
+        '"11:22:33:44:55:67,user2,2 sec\\r\\n"',
+        '"11:22:33:44:55:68,user3,\\r\\n"'
+    ])]
+
+def test_4():
+    '''Write to a file in blocks, the same as a csv.DictWriter.
+    '''
+    rows = [ { 'MACAddress': '11:22:33:44:55:{0:02d}'.format(xn), 'User': 'user, {0}'.format(xn),
+               'LastSessionLength': None if xn % 3 else xn, 'Extra': 'x' } for xn in range(50) ]
+    for row in rows[::7]:
+        del row['User']
+    expected = io.StringIO()
+    csvw = csv.DictWriter(expected, header, extrasaction='ignore')
+    csvw.writeheader()
+    csvw.writerows(rows + rows)
+    fout = io.StringIO()
+    xt = Writer(fout, header)
+    xt.block_size = 100
+    for row in rows:
+        xt.write(row)
+    assert 0 < len(fout.getvalue()) < len(expected.getvalue())//2
+    assert xt.write_batch(rows[:20] + [ None ]) == 20
+    assert xt.write_batch(rows[20:]) == 30
+    xt.write_buffer()
+    assert fout.getvalue() == expected.getvalue()
+    assert xt.count == 100
+
+def test_5():
+    '''Read lines from a binary input in blocks, the same as line by line.
+    '''
+    data = ''.join([ 'line {0},é\r\n'.format(xn) for xn in range(30) ]).encode('utf-8')
+    data = data.replace(b'line 7,', b'line 7,\xff') + b'The End\r\nline 31\r\n'
+    for ends in [ '^The End', r'^The End\s*$', r'\AThe End' ]:
+        for size in [ 1, 10, 1<<20 ]:
+            BlockLines.block_size = size
+            xr = Reader(io.BytesIO(data), ends)
+            assert next(xr) == 'line 0,é\r\n'
+            xr.backup()
+            lines = [ next(xr) for xn in range(7) ]
+            try:
+                next(xr)
+                assert False
+            except UnicodeDecodeError:
+                pass
+            lines += list(xr.lines())
+            assert lines == [ 'line {0},é\r\n'.format(xn) for xn in range(30) if xn != 7 ]
+            assert xr.ended
+    BlockLines.block_size = 1<<20
+    assert find_line(data, 0, re.compile('^The End')) == data.index(b'The End')
+    assert find_line(data, 0, re.compile(r'\AThe End')) is None
+
+def test_6():
+    '''Outputs are compressed as they are written, and appended to with another
+    stream; Files are compressed in place.
+    '''
+    import tempfile, zipfile
+    from c9r.util.filter.csvio import Compressed, compress_file, compressors, is_empty
+    tmp = tempfile.mkdtemp()
+    for method, (opener, suffix) in compressors.items():
+        fnz = os.path.join(tmp, 'out.csv'+suffix)
+        with Compressed(fnz, 'w', method) as fout:
+            assert fout.tell() == 0
+        assert is_empty(fnz, method)
+        with Compressed(fnz, 'w', method) as fout:
+            fout.write('a,b\r\n1,2\r\n')
+        if opener is None:
+            with zipfile.ZipFile(fnz) as archive:
+                assert archive.namelist() == [ 'out.csv' ]
+                assert archive.read('out.csv') == b'a,b\r\n1,2\r\n'
+            continue
+        with Compressed(fnz, 'a', method) as fout:
+            assert fout.tell() > 0
+            fout.write('3,4\r\n')
+        with opener(fnz, 'rb') as fin:
+            assert fin.read() == b'a,b\r\n1,2\r\n3,4\r\n'
+        assert not is_empty(fnz, method)
+        fnr = os.path.join(tmp, 'in.csv')
+        with open(fnr, 'w') as fin:
+            fin.write('x,y\r\n'*1000)
+        assert compress_file(fnr, method) == fnr+suffix
+        assert not os.path.exists(fnr)
+        with opener(fnr+suffix, 'rb') as fin:
+            assert fin.read() == b'x,y\r\n'*1000
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+'''
+| This file is part of the c9r package
+| Copyrighted by Wei Wang <ww@9rivers.com>
+| License: https://github.com/ww9rivers/c9r/wiki/License
+
+An index of the state of input files processed by csvfix, in an SQLite database,
+so files that have not changed since they were processed may be skipped.
+
+An input file is unchanged if its inode, size and mtime are as recorded; Or, if
+only its inode or mtime differs, e.g. when it is copied again, if its content
+digest is as recorded.
+
+Input files that grow, e.g. appended to by an exporter, may be followed instead:
+The byte offset processed to and the header read are recorded for each.
+
+Files are recorded for each task, by its pattern, as they may be processed by more
+than one task.
+'''
+
+import hashlib, json, sqlite3, time
+
+schema = [ '''CREATE TABLE IF NOT EXISTS inputs (
+    pattern TEXT,               -- Pattern of the task that processed it
+    path    TEXT,               -- Input file name, relative to csvfix "path"
+    inode   INTEGER,
+    size    INTEGER,
+    mtime   REAL,
+    digest  TEXT,               -- SHA-1 digest of the file content
+    outputs TEXT,               -- JSON list of output files produced
+    fixed   REAL,               -- Time processed
+    PRIMARY KEY (pattern, path)
+)''', '''CREATE TABLE IF NOT EXISTS follows (
+    pattern TEXT,               -- Pattern of the task that processed it
+    path    TEXT,               -- Input file name, relative to csvfix "path"
+    inode   INTEGER,
+    size    INTEGER,
+    offset  INTEGER,            -- Byte offset processed to, or -1 if ended
+    header  TEXT,               -- JSON list of the header read, or null
+    output  TEXT,               -- Output file appended to
+    fixed   REAL,               -- Time processed
+    PRIMARY KEY (pattern, path)
+)''' ]
+
+
+def digest(path, bsize=1<<20):
+    '''Return the SHA-1 digest of the content of file /path/, in hex.
+    '''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(bsize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class StateIndex(object):
+    '''Index of input files processed by the task with /pattern/, in SQLite
+    database /dbfile/.
+
+    /checked/   Number of files whose digest were checked for changes.
+    '''
+    def advance(self, path, stinfo, offset, header, output):
+        '''Record that the followed input file /path/, with os.stat() result
+        /stinfo/, has been processed to byte /offset/ with /header/, into /output/.
+        '''
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO follows VALUES (?,?,?,?,?,?,?,?)',
+                            (self.pattern, path, stinfo.st_ino, stinfo.st_size, offset,
+                             json.dumps(header), output, time.time()))
+
+    def forget(self, paths):
+        '''Remove files recorded that are not in /paths/, e.g. deleted or moved
+        since.
+        '''
+        gone = 0
+        with self.db:
+            for table in ('inputs', 'follows'):
+                rows = [ (self.pattern, xp) for xp, in self.db.execute(
+                        'SELECT path FROM {0} WHERE pattern=?'.format(table), (self.pattern,))
+                         if xp not in paths ]
+                self.db.executemany('DELETE FROM {0} WHERE pattern=? AND path=?'.format(table), rows)
+                gone += len(rows)
+        return gone
+
+    def outputs(self, path):
+        '''Return the list of output files recorded for input /path/; Or None if
+        it is not recorded.
+        '''
+        row = self.db.execute('SELECT outputs FROM inputs WHERE pattern=? AND path=?',
+                              (self.pattern, path)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def position(self, path, stinfo):
+        '''Return a tuple of the byte offset and header recorded for the followed
+        input file /path/, with os.stat() result /stinfo/; Or (0, None) if it is
+        not recorded, or has been truncated or replaced, e.g. rotated, since. The
+        offset is -1 if the end of data has been met.
+        '''
+        row = self.db.execute('SELECT inode, size, offset, header FROM follows WHERE pattern=? AND path=?',
+                              (self.pattern, path)).fetchone()
+        if row is None or row[0] != stinfo.st_ino or max(row[1], row[2]) > stinfo.st_size:
+            return 0, None
+        return row[2], json.loads(row[3])
+
+    def record(self, path, stinfo, outputs):
+        '''Record that input file /path/, with os.stat() result /stinfo/, has been
+        processed into /outputs/.
+        '''
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO inputs VALUES (?,?,?,?,?,?,?,?)',
+                            (self.pattern, path, stinfo.st_ino, stinfo.st_size, stinfo.st_mtime,
+                             digest(path), json.dumps(outputs), time.time()))
+
+    def unchanged(self, path, stinfo):
+        '''Test if input file /path/, with os.stat() result /stinfo/, is unchanged
+        since it was recorded.
+        '''
+        row = self.db.execute('SELECT inode, size, mtime, digest FROM inputs WHERE pattern=? AND path=?',
+                              (self.pattern, path)).fetchone()
+        if row is None or row[1] != stinfo.st_size:
+            return False
+        if row[0] == stinfo.st_ino and row[2] == stinfo.st_mtime:
+            return True
+        self.checked += 1
+        if digest(path) != row[3]:
+            return False
+        with self.db:
+            self.db.execute('UPDATE inputs SET inode=?, mtime=? WHERE pattern=? AND path=?',
+                            (stinfo.st_ino, stinfo.st_mtime, self.pattern, path))
+        return True
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __init__(self, dbfile, pattern='', timeout=60):
+        '''Open the index in /dbfile/, and create it if it does not exist. It may be
+        shared by tasks in greenlets or processes, which may wait up to /timeout/
+        seconds for a lock on it.
+        '''
+        self.pattern = pattern
+        self.db = sqlite3.connect(dbfile, timeout=timeout, check_same_thread=False)
+        with self.db:
+            for table in schema:
+                self.db.execute(table)
+        self.checked = 0
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+'''
+| This file is part of the c9r package
+| Copyrighted by Wei Wang <ww@9rivers.com>
+| License: https://github.com/ww9rivers/c9r/wiki/License
+
+Watch folders for files that are written, e.g. for csvfix to process them as soon
+as they land: With inotify on Linux, for files closed after writing or moved in;
+Or by polling the folders, for files that have changed and then stayed the same.
+
+Waiting is done with select() and sleep(), so it may be cooperative with gevent
+when they are monkey patched.
+
+A watcher has the list of /folders/ it watches, and a flag, /missed/, set when files
+written may have been missed, e.g. when the inotify event queue overflowed: The
+folders are to be scanned for them, and the flag cleared, by the user.
+'''
+
+import ctypes, ctypes.util, os, select, struct, time
+from c9r.pylog import logger
+
+IN_CLOSE_WRITE = 0x00000008     # File opened for writing was closed
+IN_MOVED_TO = 0x00000080        # File was moved into a watched folder
+IN_Q_OVERFLOW = 0x00004000      # Event queue overflowed
+event_head = struct.Struct('iIII')      # wd, mask, cookie, len
+
+
+class PollWatcher(object):
+    '''Watch /folders/ by polling: A file is reported once its size and mtime have
+    stayed the same for one poll, after they changed, or it is new.
+
+    Files in the folders when this watcher is created are taken as seen. No file
+    written is missed.
+    '''
+    missed = False
+
+    def scan(self):
+        '''Return a dict of (size, mtime) of the files in the folders, by path.
+        '''
+        files = {}
+        for folder in self.folders:
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stinfo = entry.stat()
+                            files[os.path.join(folder, entry.name)] = (stinfo.st_size, stinfo.st_mtime)
+            except FileNotFoundError:
+                pass
+        return files
+
+    def wait(self, timeout):
+        '''Wait for /timeout/ seconds, and return a set of paths of files written.
+        '''
+        time.sleep(timeout)
+        files = self.scan()
+        ready = set(xp for xp, xs in files.items() if self.last.get(xp) == xs and self.seen.get(xp) != xs)
+        self.seen = { xp: xs for xp, xs in self.seen.items() if xp in files }
+        self.seen.update((xp, files[xp]) for xp in ready)
+        self.last = files
+        return ready
+
+    def close(self):
+        pass
+
+    def __init__(self, folders):
+        self.folders = list(folders)
+        self.seen = self.last = self.scan()
+
+
+class InotifyWatcher(object):
+    '''Watch /folders/ with inotify, for files closed after writing, or moved in.
+
+    Raises OSError if inotify is not available.
+    '''
+    missed = False
+
+    def wait(self, timeout):
+        '''Wait up to /timeout/ seconds for files written, and return a set of their
+        paths, which may be empty.
+        '''
+        ready = set()
+        if not select.select([ self.fd ], [], [], timeout)[0]:
+            return ready
+        try:
+            data = os.read(self.fd, 1<<16)
+        except BlockingIOError:
+            return ready
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = event_head.unpack_from(data, pos)
+            pos += event_head.size
+            name = data[pos:pos+size].rstrip(b'\0')
+            pos += size
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('Inotify event queue overflowed: Some files may be missed')
+                self.missed = True
+            folder = self.watches.get(wd)
+            if folder is not None and name:
+                ready.add(os.path.join(folder, os.fsdecode(name)))
+        return ready
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __init__(self, folders):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError) as ex:
+            raise OSError('Inotify is not available: {0}'.format(ex))
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        self.folders = list(folders)
+        self.watches = {}
+        for folder in self.folders:
+            wd = add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, 'Cannot watch folder "{0}": {1}'.format(folder, os.strerror(errno)))
+            self.watches[wd] = folder
+
+
+def watcher(folders, poll=False):
+    '''Return a watcher for /folders/: An InotifyWatcher if inotify is available,
+    unless to /poll/; Or a PollWatcher otherwise.
+    '''
+    if not poll:
+        try:
+            return InotifyWatcher(folders)
+        except OSError as ex:
+            logger.warning('{0}; Polling instead'.format(ex))
+    return PollWatcher(folders)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+'''
+| This file is part of the c9r package
+| Copyrighted by Wei Wang <ww@9rivers.com>
+| License: https://github.com/ww9rivers/c9r/wiki/License
+
+Bounded memos of function results, for values that repeat a lot in the data,
+e.g. MAC addresses or vendor names in reports.
+
+Memos are named, usually after a data field, and shared in a process by those who
+get them with the same name and function. Their sizes may be configured by name
+with configure().
+
+Memos may be used by filters in stages that run in threads of their own (see
+c9r.util.filter.Stage), so they are locked with locks of the operating system,
+even where gevent has monkey patched threading.
+'''
+
+from collections import Counter, OrderedDict
+from gevent.monkey import get_original
+
+allocate_lock = get_original('_thread', 'allocate_lock')
+default_size = 1<<16            # Default maximum number of results in a memo
+sizes = {}                      # Configured sizes, by name
+memos = {}                      # All memos, by name and function
+lock = allocate_lock()          # Lock to create memos
+
+
+class Memo(object):
+    '''A memo of the results of a function that takes one argument. When it is
+    full, the least recently used result is evicted.
+
+    The function is called without the lock held, so it may be called more than
+    once for a key by threads at the same time.
+
+    /hits/      Number of calls answered from the memo;
+    /misses/    Number of calls to the function.
+    '''
+    def __call__(self, key):
+        data = self.data
+        with self.lock:
+            try:
+                value = data[key]
+                self.hits += 1
+                data.move_to_end(key)
+                return value
+            except KeyError:
+                self.misses += 1
+        value = self.func(key)
+        with self.lock:
+            data[key] = value
+            if len(data) > self.size:
+                data.popitem(last=False)
+        return value
+
+    def clear(self):
+        '''Remove all results in this memo, and reset the counters.
+        '''
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = 0
+
+    def resize(self, size):
+        '''Change the maximum number of results in this memo to /size/.
+        '''
+        with self.lock:
+            self.size = size
+            while len(self.data) > size:
+                self.data.popitem(last=False)
+
+    def stats(self):
+        '''Return a dict of statistics of this memo.
+        '''
+        return dict(size=self.size, length=len(self.data), hits=self.hits, misses=self.misses)
+
+    def __init__(self, func, size=default_size):
+        self.func = func
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = allocate_lock()
+
+
+def configure(config):
+    '''Configure sizes of memos with a dict of sizes by name in /config/. A size for
+    "default" is the default for memos not named in /config/.
+    '''
+    global default_size
+    if not config:
+        return
+    sizes.update(config)
+    default_size = sizes.pop('default', default_size)
+    for (name, func), xm in memos.items():
+        xm.resize(sizes.get(name, default_size))
+
+def get(name, func):
+    '''Get the memo with given /name/ for /func/, or create one if it does not exist.
+
+    Memos are kept by function as well as by name, so that, e.g., a subclass that
+    overrides the function of a memoized method, or the class data it uses, does
+    not get the results of another: A method is bound to the class or object it is
+    got from, and so is a different function for each.
+    '''
+    key = (name, func)
+    xm = memos.get(key)
+    if xm is None:
+        with lock:
+            xm = memos.get(key)
+            if xm is None:
+                xm = memos[key] = Memo(func, sizes.get(name, default_size))
+    return xm
+
+def label(func):
+    '''Return a label for /func/ in statistics, e.g. "Normalizer.vendor".
+    '''
+    owner = getattr(func, '__self__', None)
+    if owner is None:
+        return getattr(func, '__qualname__', repr(func))
+    return '{0}.{1}'.format((owner if isinstance(owner, type) else type(owner)).__name__, func.__name__)
+
+def stats():
+    '''Return a dict of statistics for all memos, by name; Or by name and the label
+    of their function, e.g. "Vendor Normalizer.vendor", for a name of more than one.
+    '''
+    names = Counter(name for name, func in memos)
+    return { name if names[name] == 1 else '{0} {1}'.format(name, label(func)): xm.stats()
+             for (name, func), xm in list(memos.items()) }
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+'''
+| This file is part of the c9r package
+| Copyrighted by Wei Wang <ww@9rivers.com>
+| License: https://github.com/ww9rivers/c9r/wiki/License
+
+Profiles of csvfix pipelines, from the c9r.util.filter.Probe filters in them:
+The rows read and the time spent in reading, in each filter, and in writing, by
+input file and task, reported at the end of a run in JSON, or in the Prometheus
+text format, e.g. for the textfile collector of the node exporter.
+
+A profile is a dict of:
+
+    input       Name of the input file, in the profile of a file;
+    bytes       Size in bytes of the input;
+    rows        Number of rows read;
+    written     Bytes written to the output files;
+    read        Dict of the "wall" and "cpu" seconds spent in reading;
+    filters     List of the statistics of the filters, in order, by name (see
+                c9r.util.filter.probe_stats()), but for writing;
+    write       Statistics of writing, from the probes named "write".
+'''
+
+import json, os
+
+WRITE = 'write'                 # Name of the probes of csvio.Writers
+
+
+def add(total, stats):
+    '''Add the numbers in the dict /stats/ to those in /total/.
+    '''
+    for xk, xv in stats.items():
+        if isinstance(xv, (int, float)):
+            total[xk] = total.get(xk, 0)+xv
+    return total
+
+def merge(profiles):
+    '''Merge a list of /profiles/, e.g. of the runs of a pipeline for the members
+    of an input file, or of the files of a task, into one: Numbers are added up,
+    and filters of the same name are merged, in the order they are first met.
+
+    The "filters" of the profile of a run, from c9r.util.filter.probe_stats(), may
+    include the probes named "write", which are merged into "write".
+    '''
+    total = dict(bytes=0, rows=0, written=0, read=dict(wall=0.0, cpu=0.0), write={})
+    filters = {}
+    for prof in profiles:
+        add(total, prof)
+        add(total['read'], prof.get('read', {}))
+        for stats in prof.get('filters', [])+([ dict(prof['write'], name=WRITE) ] if prof.get('write') else []):
+            if stats['name'] == WRITE:
+                add(total['write'], stats)
+            else:
+                add(filters.setdefault(stats['name'], dict(name=stats['name'])), stats)
+    total['filters'] = list(filters.values())
+    return total
+
+def report(results):
+    '''Return a report of the profiles in /results/, a list of the statistics of
+    tasks (see c9r.util.csvfix.Task.stats()): A dict of a list of "tasks", each a
+    dict of its "pattern", the "files" profiled, and their "total".
+    '''
+    tasks = []
+    for stats in results:
+        files = stats.get('profile')
+        if files is not None:
+            tasks.append(dict(pattern=stats['pattern'], total=merge(files), files=files))
+    return dict(tasks=tasks)
+
+def label(value):
+    '''Quote a label /value/ for the Prometheus text format.
+    '''
+    return '"{0}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+def prometheus(results, prefix='csvfix'):
+    '''Return the totals of the profiles in /results/, as for report(), in the
+    Prometheus text format, with metric names starting with /prefix/: They are
+    gauges of the last run, rather than counters, as each run writes them anew.
+    '''
+    metrics = {}
+    def sample(name, help, value, **labels):
+        metrics.setdefault(name, (help, []))[1].append((labels, value))
+    for task in report(results)['tasks']:
+        total = task['total']
+        pattern = task['pattern']
+        sample('input_bytes', 'Bytes of input files processed.', total['bytes'], task=pattern)
+        sample('output_bytes', 'Bytes written to output files.', total['written'], task=pattern)
+        sample('rows_read', 'Rows read from input files.', total['rows'], task=pattern)
+        for clock in ('wall', 'cpu'):
+            sample('read_seconds', 'Seconds spent in reading rows.', total['read'][clock], task=pattern, clock=clock)
+            sample('write_seconds', 'Seconds spent in writing rows.', total['write'].get(clock, 0), task=pattern, clock=clock)
+        for stats in total['filters']:
+            for key, help in (('in', 'input to'), ('out', 'output from'), ('dropped', 'dropped by')):
+                sample('filter_rows_{0}'.format(key), 'Rows {0} filters.'.format(help),
+                       stats[key], task=pattern, filter=stats['name'])
+            for clock in ('wall', 'cpu'):
+                sample('filter_seconds', 'Seconds spent in filters.', stats[clock],
+                       task=pattern, filter=stats['name'], clock=clock)
+    lines = []
+    for name, (help, samples) in metrics.items():
+        name = '{0}_{1}'.format(prefix, name)
+        lines += [ '# HELP {0} {1}'.format(name, help), '# TYPE {0} gauge'.format(name) ]
+        for labels, value in samples:
+            lines.append('{0}{{{1}}} {2}'.format(name, ','.join('{0}={1}'.format(xk, label(xv))
+                                                                 for xk, xv in labels.items()), value))
+    return '\n'.join(lines)+'\n'
+
+def write_report(fname, results):
+    '''Write a report of the profiles in /results/, as for report(), to file /fname/:
+    In the Prometheus text format if its name ends with ".prom", or JSON otherwise.
+    It is written to a temporary file that is renamed, so a collector reading it
+    never sees it half written.
+    '''
+    temp = '{0}.{1}.tmp'.format(fname, os.getpid())
+    with open(temp, 'w') as fout:
+        if fname.endswith('.prom'):
+            fout.write(prometheus(results))
+        else:
+            json.dump(report(results), fout, indent=2)
+    os.replace(temp, fname)
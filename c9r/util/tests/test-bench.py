@@ -0,0 +1,51 @@
+#! /usr/bin/env pytest
+'''
+Unit tests for ../bench.
+'''
+
+import json, os, tempfile, zipfile
+from c9r.util.bench import generate, run
+from c9r.util.csvfix import Pipeline
+
+
+def test_1():
+    '''Reports generated are read as Prime reports are, with values repeated.
+    '''
+    tmp = tempfile.mkdtemp()
+    fnr = os.path.join(tmp, 'clients.csv')
+    generate.generate('clients', fnr, 500)
+    fnw = os.path.join(tmp, 'out.csv')
+    assert Pipeline(dict(run.client_config, header=run.wireless_header))(fnr, fnw) == 500
+    with open(fnw) as fin:
+        rows = fin.read().splitlines()
+    assert rows[0] == ','.join(run.wireless_header) and len(rows) == 501
+    macs = [ row.split(',')[2] for row in rows[1:] ]
+    assert len(set(macs)) < len(macs)
+    fnz = os.path.join(tmp, 'AP_Inventory.zip')
+    generate.main([ '-r', '20', '--members=3', 'inventory', fnz ])
+    with zipfile.ZipFile(fnz) as archive:
+        assert archive.namelist() == [ 'AP_Inventory_{0}.csv'.format(xn) for xn in range(3) ]
+        assert archive.read('AP_Inventory_1.csv').decode().startswith('AP Inventory\nAP Name,')
+
+def test_2():
+    '''Benchmark cases report rows/sec of the task, and of each filter, and are
+    compared with a baseline.
+    '''
+    tmp = tempfile.mkdtemp()
+    name, kind, members, config = [ case for case in run.cases if case[0] == 'clients-zip' ][0]
+    result = run.run_case(name, kind, members, config, 400, { 'batch-size': 50 }, tmp)
+    assert result['rows'] == 400 and result['errors'] == 0 and result['peak_rss_mb'] > 0
+    assert list(result['filters']) == [ 'read', 'CiscoPI.WiredSQL', 'write' ]
+    assert os.listdir(tmp) == []
+    results = dict(cases={ name: result })
+    assert run.report(results, dict(cases={ name: dict(result, rows_per_sec=result['rows_per_sec']*2) }), 20) == 1
+    assert run.report(results, {}, 20) == 0
+    assert run.compare(90, 100, True, 5) == ('-10.0%!', True)
+    assert run.compare(90, 100, False, 5) == ('-10.0% ', False)
+
+def test_3():
+    '''The baseline has results of all the cases.
+    '''
+    with open(os.path.join(os.path.dirname(run.__file__), 'baseline.json')) as fin:
+        baseline = json.load(fin)
+    assert list(baseline['cases']) == [ case[0] for case in run.cases ]
@@ -130,3 +130,395 @@ def test_6():
     fix = CSVFixerTest5()
     fix()
     assert True
+
+"""
+Test 7: Run tasks in worker processes.
+"""
+def test_7():
+    import tempfile
+    from c9r.util.csvfix import atexit_delete, run_task
+    tmpd = tempfile.mkdtemp()
+    for name in ['a', 'b']:
+        with open(os.path.join(tmpd, 'p7-{0}.csv'.format(name)), 'w') as ftemp:
+            ftemp.write('color,value\nred,ff0000\ngreen,00ff00\n')
+    stats = run_task({
+        'pattern': 'p7-*.csv',
+        'destination': os.path.join(tmpd, 'out'),
+        'delete': True,
+        'write-header': True
+    }, '', tmpd)
+    assert stats['files'] == 2
+    assert stats['lines'] == 4
+    assert stats['errors'] == []
+    assert sorted(stats['actions']) == [
+        (atexit_delete, ('p7-a.csv',)), (atexit_delete, ('p7-b.csv',))]
+    with open(os.path.join(tmpd, 'out', 'p7-a.csv'), newline='') as fout:
+        assert fout.read() == 'color,value\r\nred,ff0000\r\ngreen,00ff00\r\n'
+    stats = run_task({ 'pattern': 'p7-*.csv', 'input-format': 'bad' }, '', tmpd)
+    assert stats['files'] == 0
+    assert 'InvalidInputFormat' in stats['errors'][0]
+
+"""
+Test 8: Process a file in chunks, with the same output as processing it serially.
+"""
+def test_8():
+    import tempfile
+    tmpd = tempfile.mkdtemp()
+    fnr = os.path.join(tmpd, 'p8.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('Some text before\nthe data.\ncolor,value\n')
+        for xn in range(1000):
+            ftemp.write('c{0},"{1}\nline 2"\n'.format(xn, xn) if xn % 3 else 'c{0},{0}\n'.format(xn))
+        ftemp.write('The End\nc,0\n')
+    config = { 'skip-till': '^color,', 'end-at': '^The End', 'write-header': True }
+    assert Pipeline(config)(fnr, fnr+'.1') == 1000
+    config.update({ 'chunks': 4, 'chunk-min': 0 })
+    assert Pipeline(config)(fnr, fnr+'.2') == 1000
+    with open(fnr+'.1', 'rb') as f1, open(fnr+'.2', 'rb') as f2:
+        assert f1.read() == f2.read()
+    assert [ xf for xf in os.listdir(tmpd) if '.part' in xf ] == []
+
+"""
+Test 9: Pass rows through filters in batches.
+"""
+def test_9():
+    import tempfile
+    fnr = os.path.join(tempfile.mkdtemp(), 'p9.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('color,value\n')
+        for xn in range(100):
+            ftemp.write(' c{0} , {0}\n'.format(xn) if xn % 10 else 'short\n')
+    config = { 'filters': [ 'Trim.Trim' ], 'write-header': True }
+    assert Pipeline(config)(fnr, fnr+'.1') == 100
+    config['batch-size'] = 16
+    assert Pipeline(config)(fnr, fnr+'.2') == 100
+    with open(fnr+'.1', 'rb') as f1, open(fnr+'.2', 'rb') as f2:
+        assert f1.read() == f2.read()
+
+"""
+Test 10: Pass rows through filters as lists, in the "tuple" row mode.
+"""
+def test_10():
+    import tempfile
+    fnr = os.path.join(tempfile.mkdtemp(), 'p10.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('LastSeen,MACAddress,Vendor,ConnectionType,SSID,User,InterfaceName\n')
+        for xn in range(100):
+            ftemp.write('Mon Mar 16 06:58:{0:02d} GMT 2015,00:18:fe:8a:e0:{0:02x},"Apple, Inc",{1},{2},Domain\\User{0},Gi1/0/{0}\n'.format(
+                xn % 60, 'Wired' if xn % 3 else 'Wireless', 'MGuest-UMHS' if xn % 4 else 'Other')
+                        if xn % 10 else 'short,row\n\n')
+    # CiscoInventory.AP takes only dicts, and drops these rows:
+    for filters, lines in [ ([ 'Trim.Trim', 'CiscoPI.WiredSQL' ], 61),
+                            ([ 'Trim.Trim', 'CiscoPI.WirelessGuest' ], 24),
+                            ([ 'CiscoPI.Normalizer', 'CiscoInventory.AP' ], 0) ]:
+        config = { 'filters': filters, 'write-header': True, 'read-header': True,
+                   'header': [ 'LastSeen', 'MACAddress', 'Vendor', 'User', 'Port', 'Room' ] }
+        assert Pipeline(config)(fnr, fnr+'.1') == 100
+        config['row-mode'] = 'tuple'
+        assert Pipeline(config)(fnr, fnr+'.2') == 100
+        with open(fnr+'.1', 'rb') as f1, open(fnr+'.2', 'rb') as f2:
+            data = f1.read()
+            assert data.count(b'\n') == lines
+            assert data == f2.read()
+
+def test_11():
+    import tempfile
+    fnr = os.path.join(tempfile.mkdtemp(), 'p11.csv')
+    with open(fnr, 'w', newline='') as ftemp:
+        ftemp.write('Report\r\nGenerated today\r\ncolor,value,note\r\n')
+        for xn in range(50):
+            ftemp.write('c{0},{0},"é, {1}"\r\n'.format(xn, 'End of' if xn == 20 else 'x'))
+        ftemp.write('End of report\r\nc,1,2\r\n')
+    for extra, rows in [ ({ 'skip-till': '^color', 'end-at': '^End of' }, 51),
+                         ({ 'skip-line': 2, 'end-at': 'End.*report' }, 51),
+                         ({ 'skip-line': 3, 'end-at': '^c(10|20),' }, 10),
+                         ({ 'skip-line': 3 }, 52) ]:
+        config = dict(extra, header=[ 'color', 'value', 'note' ])
+        assert Pipeline(config)(fnr, fnr+'.1') == rows
+        config['memory-map'] = False
+        assert Pipeline(config)(fnr, fnr+'.2') == rows
+        with open(fnr+'.1', 'rb') as f1, open(fnr+'.2', 'rb') as f2:
+            assert f1.read() == f2.read()
+
+def test_12():
+    '''An interrupted run is resumed from the last checkpoint.
+    '''
+    import tempfile
+    from c9r.util.csvfix import Checkpoint
+    fnr = os.path.join(tempfile.mkdtemp(), 'p12.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('Report\ncolor,value\n')
+        for xn in range(100):
+            ftemp.write('c{0}, {0} \n'.format(xn))
+    config = { 'skip-line': 1, 'read-header': True, 'write-header': True,
+               'filters': [ 'Trim.Trim' ], 'checkpoint': 30 }
+    assert Pipeline(config)(fnr, fnr+'.1') == 100
+    assert not os.path.exists(fnr+'.1.ckpt')
+    save = Checkpoint.save
+    def interrupt(self, rows, writer, fout, head):
+        save(self, rows, writer, fout, head)
+        if rows == 60:
+            fout.write('c60,6')         # Half-written
+            raise KeyboardInterrupt
+    Checkpoint.save = interrupt
+    try:
+        Pipeline(config)(fnr, fnr+'.2')
+        assert False
+    except KeyboardInterrupt:
+        pass
+    finally:
+        Checkpoint.save = save
+    with open(fnr+'.2.ckpt') as fck:
+        assert '"rows": 60' in fck.read()
+    assert Pipeline(config)(fnr, fnr+'.2') == 100
+    assert not os.path.exists(fnr+'.2.ckpt')
+    with open(fnr+'.1', 'rb') as f1, open(fnr+'.2', 'rb') as f2:
+        data = f1.read()
+        assert data.count(b'\n') == 101
+        assert data == f2.read()
+
+def test_13():
+    '''Files are found for all patterns in one scan, as glob finds them.
+    '''
+    import glob, tempfile
+    from c9r.util.csvfix import scan_patterns
+    tmp = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmp, 'dir.csv'))
+    for fn in [ 'a1.csv', 'b1.csv', 'a2.zip', '.a3.csv', 'a[4].csv' ]:
+        open(os.path.join(tmp, fn), 'w').close()
+    patterns = [ os.path.join(tmp, pat) for pat in [ '*.csv', 'a*', '.*', '[ab]1.*', 'x*' ] ]
+    found = scan_patterns(patterns+[ os.path.join(tmp, '*', '*.csv') ])
+    for pat in patterns:
+        assert sorted(fn for fn, stinfo in found[pat]) == sorted(fn for fn in glob.glob(pat) if os.path.isfile(fn))
+        assert all(stinfo.st_size == 0 for fn, stinfo in found[pat])
+    assert len(found) == len(patterns)
+
+def test_14():
+    '''Tasks that read an input file the same way share one read of it, with the
+    same outputs as each reading it alone.
+    '''
+    import tempfile
+    from c9r.util.csvfix import Task, fix_group, share_inputs
+    tmp = tempfile.mkdtemp()
+    fnr = os.path.join(tmp, 'p14.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('Report\ncolor,value\n')
+        for xn in range(50):
+            ftemp.write('c{0}, {0} \n'.format(xn))
+    base = { 'skip-line': 1, 'read-header': True, 'write-header': True }
+    configs = [ dict(base, destination=os.path.join(tmp, 'o1'), filters=[ 'Trim.Trim' ]),
+                dict(base, destination=os.path.join(tmp, 'o2')),
+                dict(base, destination=os.path.join(tmp, 'o3'), follow=True) ]
+    jobs = [ (cfg, fnr) for cfg in configs ]
+    groups, rest = share_inputs(jobs, { fnr: [ (fnr, None) ] })
+    assert groups == [ ([ 0, 1 ], [ (fnr, None) ]) ]
+    assert rest == [ [], [], [ (fnr, None) ] ]
+    tasks = [ Task(cfg, fnr, tmp) for cfg in configs[:2] ]
+    fix_group(tasks, [ (fnr, None) ])
+    assert [ tsk.lines for tsk in tasks ] == [ 50, 50 ]
+    for xn, cfg in enumerate(configs[:2]):
+        alone = dict(cfg, destination=os.path.join(tmp, 'a{0}'.format(xn)))
+        Task(alone, fnr, tmp)()
+        with open(os.path.join(alone['destination'], 'p14.csv'), 'rb') as f1, \
+             open(os.path.join(cfg['destination'], 'p14.csv'), 'rb') as f2:
+            assert f1.read() == f2.read()
+
+def test_15():
+    '''Rows are routed and teed to the outputs of the branches of the filters, from
+    one read of the input.
+    '''
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    fnr = os.path.join(tmp, 'p15.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('User,ConnectionType,SSID\n')
+        for xn in range(30):
+            ftemp.write('u{0}, {1} ,{2}\n'.format(xn, 'Wired' if xn % 3 == 0 else 'Wireless', 'guest' if xn % 3 == 1 else 'staff'))
+    route = { 'route': [ { 'match': { 'ConnectionType': 'Wired' }, 'destination': os.path.join(tmp, 'wired') },
+                         { 'match': { 'SSID': '^guest$' }, 'rename': { '(.+)': 'guest-{0}' } },
+                         { 'filters': [ { 'tee': [ { 'destination': os.path.join(tmp, 'all') }, {} ] } ] } ] }
+    for extra in [ {}, { 'batch-size': 7 }, { 'fuse-filters': False } ]:
+        config = dict(extra, filters=[ 'Trim.Trim', route ], header=[ 'User', 'ConnectionType' ], **{ 'read-header': True, 'write-header': True })
+        pipe = Pipeline(config)
+        fnw = os.path.join(tmp, 'out.csv')
+        assert pipe(fnr, fnw) == 30
+        assert pipe.branch_outputs(fnw) == [ os.path.join(tmp, 'wired', 'out.csv'), os.path.join(tmp, 'guest-out.csv'),
+                                             os.path.join(tmp, 'all', 'out.csv') ]
+        outputs = { fw: open(fw).read().splitlines() for fw in [ fnw ]+pipe.branch_outputs(fnw) }
+        assert [ len(lines) for lines in outputs.values() ] == [ 11, 11, 11, 11 ]
+        assert outputs[fnw] == outputs[os.path.join(tmp, 'all', 'out.csv')]
+        assert outputs[fnw][0] == 'User,ConnectionType'
+        assert outputs[fnw][1:] == [ 'u{0},Wireless'.format(xn) for xn in range(2, 30, 3) ]
+        assert outputs[os.path.join(tmp, 'wired', 'out.csv')][1:] == [ 'u{0},Wired'.format(xn) for xn in range(0, 30, 3) ]
+
+def test_16():
+    '''Outputs are compressed as they are written, with the header once in a file
+    appended to; Input files are compressed by a pool of postprocess workers.
+    '''
+    import gzip, tempfile
+    from c9r.util.csvfix import Postprocessor, atexit_process
+    tmp = tempfile.mkdtemp()
+    fnr = os.path.join(tmp, 'p16.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('color,value\n')
+        for xn in range(200):
+            ftemp.write('c{0},{0}\n'.format(xn))
+    expected = 'color,value\r\n'+''.join('c{0},{0}\r\n'.format(xn) for xn in range(200))*2
+    for extra in [ {}, { 'chunks': 2, 'chunk-min': 0 } ]:
+        config = dict(extra, compress='gzip', **{ 'read-header': True, 'write-header': True, 'file-mode': 'a' })
+        fnw = os.path.join(tmp, 'p16.{0}.csv.gz'.format(len(extra)))
+        assert Pipeline(config)(fnr, fnw) == 200
+        assert Pipeline(config)(fnr, fnw) == 200
+        with gzip.open(fnw, 'rb') as fin:
+            assert fin.read().decode() == expected
+    post = Postprocessor(1, set([ fnr ]))
+    post([ (atexit_process, (fnw, 'bzip2')), (atexit_process, (fnr, 'xz')) ])
+    assert post.later == [ (atexit_process, (fnr, 'xz')) ]
+    post.close()
+    assert os.path.exists(fnw+'.bz2') and os.path.exists(fnr+'.xz')
+    assert not os.path.exists(fnw) and not os.path.exists(fnr)
+
+def test_17():
+    '''Rows are passed in order to a stage in another thread, through a bounded
+    queue, even if its output is slow.
+    '''
+    from c9r.util.filter import Stage
+    class Slow(object):
+        def write(self, data):
+            time.sleep(0.001)
+            self.rows.append(data)
+            self.most = max(self.most, stage.batches.qsize())
+        rows = []
+        most = 0
+    sink = Slow()
+    stage = Stage(sink, batch_size=3, depth=2)
+    for xn in range(50):
+        stage.write({ 'n': xn })
+    stage.write_batch([ { 'n': xn } for xn in range(50, 60) ])
+    stage.close()
+    assert sink.rows == [ { 'n': xn } for xn in range(60) ]
+    assert 0 < sink.most <= 2
+    assert stage.count == 60 and stage.thread is None
+    # Fewer rows than a batch are passed on when the stage is closed, or synced:
+    for sync in (False, True):
+        sink = Slow()
+        sink.rows = []
+        stage = Stage(sink, batch_size=100)
+        for xn in range(5):
+            stage.write({ 'n': xn })
+        if sync:
+            stage.sync()
+            assert sink.rows == [ { 'n': xn } for xn in range(5) ]
+        stage.close()
+        assert sink.rows == [ { 'n': xn } for xn in range(5) ] and stage.thread is None
+    # And files smaller than a batch are written as without stages:
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    fnr = os.path.join(tmp, 'p17.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('c,v\n'+''.join('x{0}, {0} \n'.format(xn) for xn in range(25)))
+    base = { 'read-header': True, 'write-header': True, 'filters': [ 'Trim.Trim', 'Trim.Trim' ] }
+    outputs = []
+    for extra in [ {}, { 'stages': True }, { 'filters': [ 'Trim.Trim', '|', 'Trim.Trim' ] },
+                   { 'stages': True, 'filters': [ 'Trim.Trim', '|', 'Trim.Trim' ], 'checkpoint': 10 } ]:
+        fnw = os.path.join(tmp, 'out{0}.csv'.format(len(outputs)))
+        assert Pipeline(dict(base, **extra))(fnr, fnw) == 25
+        outputs.append(open(fnw).read())
+    assert outputs[0].count('\n') == 26 and outputs[1:] == outputs[:1]*3
+
+def test_18():
+    '''Members of .zip archives processed in parallel are merged as if they were
+    processed one by one.
+    '''
+    import tempfile, zipfile
+    from c9r.util.csvfix import Task
+    tmp = tempfile.mkdtemp()
+    for xa in range(2):
+        with zipfile.ZipFile(os.path.join(tmp, 'r{0}.zip'.format(xa)), 'w') as archive:
+            for xm in range(4):
+                rows = 0 if xm == 0 else 30+xm
+                archive.writestr('m{0}-{1}.csv'.format(xa, xm), 'Report\nc,v\n'+''.join(
+                        'x{0}, {1} \n'.format(xn, xm) for xn in range(rows)))
+    for mode in [ 'a', 'w' ]:
+        outputs = []
+        for workers in [ 0, 3 ]:
+            dest = os.path.join(tmp, '{0}{1}'.format(mode, workers))
+            config = { 'destination': dest, 'skip-line': 1, 'read-header': True, 'write-header': True,
+                       'file-mode': mode, 'filters': [ 'Trim.Trim' ], 'member-workers': workers }
+            tsk = Task(config, os.path.join(tmp, 'r*.zip'), tmp)
+            tsk()
+            assert tsk.lines == 2*(31+32+33) and tsk.files == 2 and not tsk.errors
+            outputs.append({ fn: open(os.path.join(dest, fn)).read() for fn in sorted(os.listdir(dest)) })
+        assert outputs[0] == outputs[1]
+        assert len(outputs[0]) == (2 if mode == 'a' else 8)
+    assert outputs[0]['m0-1.csv'].startswith('c,v\n')
+
+def test_19():
+    '''Jobs are scheduled largest first, within the workers and bytes budget.
+    '''
+    from c9r.util.csvfix import Scheduler
+    started, running = [], []
+    def start(func, args):
+        started.append(func)
+        running.append(func)
+        return func
+    def done(handles):
+        assert len(handles) <= sched.workers
+        assert len(handles) == 1 or not sched.budget or sum(handles) <= sched.budget
+        running.remove(handles[0])
+        return [ handles[0] ]
+    sched = Scheduler(2, 100)
+    jobs = [ ('j{0}'.format(xs), xs, xs, ()) for xs in [ 10, 150, 60, 50, 30 ] ]
+    finished = [ job[0] for job, handle in sched.run(jobs, start, done) ]
+    assert started == [ 150, 60, 30, 50, 10 ]
+    assert finished == [ 'j150', 'j60', 'j30', 'j50', 'j10' ]
+    assert [ xt[0] for xt in sched.timeline ] == finished and sched.inflight == 0
+    sched = Scheduler(3)
+    assert [ job[1] for job, handle in sched.run(jobs, start, done) ] == [ 150, 60, 50, 30, 10 ]
+
+def test_20():
+    '''An error in one branch of a tee or route does not keep batches of rows from
+    the others.
+    '''
+    from c9r.util.filter import Route, Tee
+    class Bad(object):
+        def prepare(self, header, index=None):
+            pass
+        def write_batch(self, rows):
+            raise ValueError('bad')
+    class Good(Bad):
+        def __init__(self):
+            self.rows = []
+        def write_batch(self, rows):
+            self.rows += rows
+    good = Good()
+    assert Tee([ Bad(), good ]).write_batch([ { 'n': 1 }, { 'n': 2 } ]) is None
+    assert good.rows == [ { 'n': 1 }, { 'n': 2 } ]
+    good = Good()
+    route = Route([ Bad(), good ], [ { 'n': '1' }, None ])
+    route.prepare([ 'n' ])
+    try:
+        route.write_batch([ { 'n': 1 }, { 'n': 2 } ])
+        assert False
+    except ValueError:
+        pass
+    assert good.rows == [ { 'n': 2 } ]
+
+def test_21():
+    '''Outputs of members of an input that fails, processed in parallel, are not
+    left in the destination.
+    '''
+    import tempfile, zipfile
+    from c9r.util.csvfix import Task
+    tmp = tempfile.mkdtemp()
+    with zipfile.ZipFile(os.path.join(tmp, 'r.zip'), 'w') as archive:
+        for xm in range(3):
+            archive.writestr('m{0}.csv'.format(xm), 'c,v\n'+''.join('x{0},{1}\n'.format(xn, xm) for xn in range(20)))
+    for mode in [ 'a', 'w' ]:
+        dest = os.path.join(tmp, mode)
+        config = { 'destination': dest, 'read-header': True, 'write-header': True, 'file-mode': mode,
+                   'filters': [ 'Trim.Nope' ], 'member-workers': 2 }
+        tsk = Task(config, os.path.join(tmp, 'r.zip'), tmp)
+        tsk()
+        assert tsk.errors and tsk.files == 0
+        assert os.listdir(dest) == []
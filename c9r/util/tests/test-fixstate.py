@@ -0,0 +1,83 @@
+#! /usr/bin/env pytest
+'''
+Unit tests for ../fixstate.py.
+'''
+
+import os, tempfile
+from c9r.util.fixstate import StateIndex
+from c9r.util.csvfix import Task
+
+
+def test_1():
+    '''A file is unchanged until its size, or its content, changes.
+    '''
+    tmp = tempfile.mkdtemp()
+    fn = os.path.join(tmp, 'a.csv')
+    with open(fn, 'w') as fout:
+        fout.write('a,b\n1,2\n')
+    with StateIndex(os.path.join(tmp, 'state.db'), '*.csv') as state:
+        assert not state.unchanged(fn, os.stat(fn))
+        state.record(fn, os.stat(fn), [ 'out/a.csv' ])
+        assert state.unchanged(fn, os.stat(fn))
+        assert state.outputs(fn) == [ 'out/a.csv' ]
+        os.utime(fn, (0, 0))                    # Touched, same content
+        assert state.unchanged(fn, os.stat(fn)) and state.checked == 1
+        assert state.unchanged(fn, os.stat(fn)) and state.checked == 1
+        with open(fn, 'w') as fout:
+            fout.write('a,b\n1,3\n')            # Same size, new content
+        os.utime(fn, (1, 1))
+        assert not state.unchanged(fn, os.stat(fn))
+        with open(fn, 'a') as fout:
+            fout.write('4,5\n')
+        assert not state.unchanged(fn, os.stat(fn))
+        assert state.forget(set([ fn ])) == 0
+        assert state.forget(set()) == 1
+        assert state.outputs(fn) is None
+
+def test_2():
+    '''A task skips input files processed before, unless to rescan.
+    '''
+    tmp = tempfile.mkdtemp()
+    for xn in range(3):
+        with open(os.path.join(tmp, 'in{0}.csv'.format(xn)), 'w') as fout:
+            fout.write('a,b\n{0},2\n'.format(xn))
+    config = { 'destination': os.path.join(tmp, 'out'), 'read-header': True }
+    pattern = os.path.join(tmp, 'in*.csv')
+    dbfile = os.path.join(tmp, 'state.db')
+    def run(rescan=False):
+        return Task(config, pattern, tmp, dbfile, rescan)().stats()
+    stats = run()
+    assert (stats['files'], stats['skipped']) == (3, 0)
+    with open(os.path.join(tmp, 'in3.csv'), 'w') as fout:
+        fout.write('a,b\n3,2\n')
+    stats = run()
+    assert (stats['files'], stats['skipped']) == (1, 3)
+    assert sorted(os.listdir(config['destination'])) == [ 'in{0}.csv'.format(xn) for xn in range(4) ]
+    stats = run(True)
+    assert (stats['files'], stats['skipped']) == (4, 0)
+    stats = Task(config, os.path.join(tmp, 'in[12].csv'), tmp, dbfile)().stats()
+    assert (stats['files'], stats['skipped']) == (2, 0)
+    stats = Task(dict(config, delete=True), pattern, tmp, dbfile)().stats()
+    assert (stats['files'], stats['skipped']) == (4, 0)
+
+def test_3():
+    '''A task follows a growing file, and processes it anew when it is truncated.
+    '''
+    tmp = tempfile.mkdtemp()
+    fn = os.path.join(tmp, 'grow.csv')
+    config = { 'destination': os.path.join(tmp, 'out'), 'follow': True, 'skip-line': 1,
+               'read-header': True, 'write-header': True, 'end-at': '^Total' }
+    dbfile = os.path.join(tmp, 'state.db')
+    fnw = os.path.join(config['destination'], 'grow.csv')
+    def run(data, mode='a'):
+        with open(fn, mode) as fout:
+            fout.write(data)
+        stats = Task(config, fn, tmp, dbfile)().stats()
+        with open(fnw) as fin:
+            return stats['lines'], stats['skipped'], fin.read()
+    assert run('Report\na,b\n1,2\n3,', 'w') == (1, 0, 'a,b\n1,2\n')
+    assert run('4\n5,6') == (1, 0, 'a,b\n1,2\n3,4\n')
+    assert run('') == (0, 0, 'a,b\n1,2\n3,4\n')
+    assert run('\nTotal,3\n7,8\n') == (1, 0, 'a,b\n1,2\n3,4\n5,6\n')
+    assert run('9,0\n') == (0, 1, 'a,b\n1,2\n3,4\n5,6\n')
+    assert run('Report\nc,d\n1,1\n', 'w') == (1, 0, 'c,d\n1,1\n')
@@ -0,0 +1,116 @@
+#! /usr/bin/env pytest
+'''
+Unit tests for ../fswatch.py, and the csvfix --watch loop.
+'''
+
+import os, tempfile
+from c9r.util import fswatch
+from c9r.util.csvfix import Task, path_matcher, rescan, watch
+
+
+def write(path, data):
+    with open(path, 'w') as fout:
+        fout.write(data)
+
+def test_1():
+    '''Polling reports files once they stay the same for a poll.
+    '''
+    tmp = tempfile.mkdtemp()
+    write(os.path.join(tmp, 'old.csv'), 'a\n')
+    fw = fswatch.watcher([ tmp ], poll=True)
+    assert isinstance(fw, fswatch.PollWatcher)
+    assert fw.wait(0) == set()
+    fn = os.path.join(tmp, 'new.csv')
+    write(fn, 'a\n')
+    assert fw.wait(0) == set()
+    assert fw.wait(0) == set([ fn ])
+    assert fw.wait(0) == set()
+    write(fn, 'a,b\n')
+    assert fw.wait(0) == set()
+    assert fw.wait(0) == set([ fn ])
+
+def test_2():
+    '''Inotify reports files closed after writing, or moved in.
+    '''
+    tmp = tempfile.mkdtemp()
+    try:
+        fw = fswatch.InotifyWatcher([ tmp ])
+    except OSError:
+        return                  # Not available here
+    assert fw.wait(0) == set()
+    fn = os.path.join(tmp, 'new.csv')
+    write(fn, 'a\n')
+    write(os.path.join(tmp, '.part'), 'a\n')
+    os.rename(os.path.join(tmp, '.part'), os.path.join(tmp, 'moved.csv'))
+    assert fw.wait(1) == set([ fn, os.path.join(tmp, '.part'), os.path.join(tmp, 'moved.csv') ])
+    fw.close()
+
+def test_3():
+    '''Files written are fixed by the matching task, and deleted if so configured.
+    '''
+    tmp = tempfile.mkdtemp()
+    dest = os.path.join(tmp, 'out')
+    config = { 'destination': dest, 'read-header': True, 'delete': True }
+    tasks = [ Task(config, os.path.join(tmp, '*.csv'), tmp), Task(config, os.path.join(tmp, '*.txt'), tmp) ]
+    tasks[0]()
+    fw = fswatch.watcher([ tmp ], poll=True)
+    for xn in range(3):
+        write(os.path.join(tmp, 'in{0}.csv'.format(xn)), 'a,b\n{0},2\n'.format(xn))
+    watch(tasks, fw, 0, 2)
+    assert sorted(os.listdir(dest)) == [ 'in0.csv', 'in1.csv', 'in2.csv' ]
+    assert os.listdir(tmp) == [ 'out' ]
+    assert (tasks[0].files, tasks[1].files) == (3, 0)
+
+def test_4():
+    '''Paths match patterns as they do in glob, after they are normalized.
+    '''
+    matches = path_matcher('./in/*.csv')
+    assert matches('in/a.csv') and matches('./in//b.csv') and matches('x/../in/c.csv')
+    assert not matches('in/.a.csv') and not matches('in/sub/a.csv') and not matches('a.csv')
+    assert path_matcher('in*/.*.csv')('in2/.a.csv')
+
+def test_5():
+    '''Files in folders found after watching starts are fixed, and all are rescanned
+    when files may have been missed. A task that fails does not stop the others.
+    '''
+    tmp = tempfile.mkdtemp()
+    dest = os.path.join(tmp, 'out')
+    config = { 'destination': dest, 'read-header': True, 'delete': True }
+    tasks = [ Task(dict(config, filters=[ 'Trim.Nope' ]), os.path.join(tmp, 'in', '*.txt'), tmp),
+              Task(config, os.path.join(tmp, '.', 'in', '*.csv'), tmp) ]
+    write(os.path.join(tmp, 'in.csv'), 'a,b\n1,2\n')
+    rescan(tasks)
+    fw = fswatch.watcher([], poll=True)
+    os.mkdir(os.path.join(tmp, 'in'))
+    for fn in [ 'a.csv', '.b.csv', 'c.txt' ]:
+        write(os.path.join(tmp, 'in', fn), 'a,b\n1,2\n')
+    watch(tasks, fw, 0, 1)
+    assert sorted(xf for xf in os.listdir(dest) if xf.endswith('.csv')) == [ 'a.csv' ]
+    assert sorted(os.listdir(os.path.join(tmp, 'in'))) == [ '.b.csv', 'c.txt' ]
+    assert (tasks[0].files, tasks[1].files) == (0, 1)
+    fw = fswatch.watcher([ os.path.join(tmp, 'in') ], poll=True)
+    write(os.path.join(tmp, 'in', 'd.csv'), 'a,b\n1,2\n')
+    fw.seen[os.path.join(tmp, 'in', 'd.csv')] = fw.scan()[os.path.join(tmp, 'in', 'd.csv')]
+    fw.missed = True
+    watch(tasks, fw, 0, 1)
+    assert 'd.csv' in os.listdir(dest) and not fw.missed
+
+def test_6():
+    '''Profiles of each round are written to the report, and errors and profiles
+    are cleared for the next round.
+    '''
+    import json
+    tmp = tempfile.mkdtemp()
+    report = os.path.join(tmp, 'report.json')
+    os.mkdir(os.path.join(tmp, 'out'))
+    config = { 'destination': os.path.join(tmp, 'out'), 'read-header': True, 'delete': True, 'profile': True }
+    tasks = [ Task(config, os.path.join(tmp, '*.csv'), tmp) ]
+    fw = fswatch.watcher([ tmp ], poll=True)
+    for rows in (3, 5):
+        write(os.path.join(tmp, 'in{0}.csv'.format(rows)), 'a,b\n'+'1,2\n'*rows)
+        tasks[0].errors.append('failed before')
+        watch(tasks, fw, 0, 2, report)
+        with open(report) as fin:
+            task, = json.load(fin)['tasks']
+        assert task['total']['rows'] == rows
+        assert tasks[0].profiles == [] and tasks[0].errors == []
@@ -0,0 +1,77 @@
+#! /usr/bin/env pytest
+'''
+Unit tests for ../memo.py.
+'''
+
+import threading
+from c9r.util import memo
+from c9r.util.filter.CiscoPI import Normalizer
+
+
+def test_1():
+    '''A memo evicts the least recently used result when it is full.
+    '''
+    calls = []
+    def func(x):
+        calls.append(x)
+        return x.upper()
+    xm = memo.Memo(func, 2)
+    assert [ xm(x) for x in 'abab' ] == [ 'A', 'B', 'A', 'B' ]
+    assert calls == [ 'a', 'b' ]
+    xm('a')
+    xm('c')             # Evicts 'b'
+    xm('b')
+    assert calls == [ 'a', 'b', 'c', 'b' ]
+    assert xm.stats() == dict(size=2, length=2, hits=3, misses=4)
+    xm.resize(1)
+    assert list(xm.data) == [ 'b' ]
+
+def test_2():
+    '''Named memos are shared for the same function, and sized with configure().
+    '''
+    xm = memo.get('test_2', str.lower)
+    assert memo.get('test_2', str.lower) is xm
+    assert xm('AB') == 'ab'
+    memo.configure({ 'test_2': 5 })
+    assert xm.size == 5
+    assert memo.stats()['test_2']['misses'] == 1
+    xu = memo.get('test_2', str.upper)
+    assert xu is not xm and xu('ab') == 'AB' and xu.size == 5
+    assert memo.stats()['test_2 str.lower']['misses'] == 1
+
+def test_3():
+    '''Errors are raised, not memoized.
+    '''
+    xm = memo.Memo(int)
+    for x in range(2):
+        try:
+            xm('x')
+            assert False
+        except ValueError:
+            pass
+    assert xm.stats()['length'] == 0
+
+def test_4():
+    '''A subclass with its own data for a memoized method has memos of its own.
+    '''
+    class Vendors(Normalizer):
+        vendor_map = dict(Normalizer.vendor_map, unknown='Unknown')
+    assert Normalizer(None).memo('Vendor')('Unknown') == ''
+    assert Vendors(None).memo('Vendor')('Unknown') == 'Unknown'
+    assert Normalizer(None).memo('Vendor') is Normalizer(None).memo('Vendor')
+    assert Normalizer(None).memo('MAC') is Vendors(None).memo('MAC')
+
+def test_5():
+    '''A memo may be used by threads at the same time.
+    '''
+    xm = memo.Memo(lambda x: x*2, 10)
+    def run():
+        for xn in range(20000):
+            assert xm(xn % 17) == (xn % 17)*2
+    threads = [ threading.Thread(target=run) for xt in range(4) ]
+    for xt in threads:
+        xt.start()
+    for xt in threads:
+        xt.join()
+    stats = xm.stats()
+    assert stats['length'] == 10 and stats['hits']+stats['misses'] == 80000
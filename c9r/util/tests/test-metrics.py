@@ -0,0 +1,65 @@
+#! /usr/bin/env pytest
+'''
+Unit tests for ../metrics.py.
+'''
+
+import json, os, tempfile
+from c9r.util import metrics
+from c9r.util.csvfix import Task
+
+
+def test_1():
+    '''A task profiled counts the rows in and out of each filter, and the bytes
+    read and written, for each input file; And writes the same outputs.
+    '''
+    tmp = tempfile.mkdtemp()
+    fnr = os.path.join(tmp, 'p1.csv')
+    with open(fnr, 'w') as ftemp:
+        ftemp.write('User,ConnectionType,SSID\n')
+        for xn in range(30):
+            ftemp.write('u{0}, {1} ,{2}\n'.format(xn, 'Wired' if xn % 3 == 0 else 'Wireless', 'guest' if xn % 3 == 1 else 'staff'))
+    route = { 'route': [ { 'match': { 'ConnectionType': 'Wired' }, 'destination': os.path.join(tmp, 'wired') },
+                         { 'match': { 'SSID': '^guest$' } } ] }
+    outputs = []
+    for extra in [ {}, { 'profile': True }, { 'profile': True, 'batch-size': 7, 'row-mode': 'tuple' } ]:
+        dest = os.path.join(tmp, str(len(outputs)))
+        config = dict(extra, filters=[ 'Trim.Trim', route ], destination=dest, **{ 'read-header': True })
+        tsk = Task(config, fnr, tmp)()
+        outputs.append([ open(os.path.join(folder, 'p1.csv')).read() for folder in (dest, os.path.join(tmp, 'wired')) ])
+        if not extra:
+            assert tsk.profiles is None and tsk.stats()['profile'] is None
+            continue
+        prof, = tsk.profiles
+        assert prof['input'] == fnr and prof['bytes'] == os.path.getsize(fnr) and prof['rows'] == 30
+        assert prof['written'] == os.path.getsize(os.path.join(dest, 'p1.csv'))+os.path.getsize(os.path.join(tmp, 'wired', 'p1.csv'))
+        assert [ (xf['name'], xf['in'], xf['out'], xf['dropped']) for xf in prof['filters'] ] == [
+            ('Trim.Trim', 30, 30, 0), ('route', 30, 20, 10) ]
+        assert prof['write']['in'] == 20
+        assert all(prof[xk]['cpu'] >= 0 for xk in ('read', 'write'))
+    assert outputs[0] == outputs[1] == outputs[2]
+    report = os.path.join(tmp, 'report.json')
+    metrics.write_report(report, [ tsk.stats(), dict(pattern='none', profile=None) ])
+    with open(report) as fin:
+        tasks = json.load(fin)['tasks']
+    assert [ task['pattern'] for task in tasks ] == [ fnr ]
+    assert tasks[0]['total']['rows'] == 30 and len(tasks[0]['files']) == 1
+
+def test_2():
+    '''Profiles are merged by filter name, and reported in the Prometheus format.
+    '''
+    files = [ dict(input='a', bytes=10, rows=3, written=5, read=dict(wall=1.0, cpu=0.5),
+                   filters=[ dict(name='A.A', **{ 'in': 3, 'out': 2, 'dropped': 1, 'wall': 1.0, 'cpu': 1.0 }),
+                             dict(name='write', **{ 'in': 2, 'out': 2, 'dropped': 0, 'wall': 2.0, 'cpu': 1.0 }) ]),
+              dict(input='b', bytes=20, rows=4, written=6, read=dict(wall=1.0, cpu=0.5),
+                   filters=[ dict(name='B.B', **{ 'in': 4, 'out': 4, 'dropped': 0, 'wall': 1.0, 'cpu': 1.0 }),
+                             dict(name='A.A', **{ 'in': 4, 'out': 4, 'dropped': 0, 'wall': 1.0, 'cpu': 1.0 }) ]) ]
+    total = metrics.merge(files)
+    assert (total['bytes'], total['rows'], total['written'], total['read']) == (30, 7, 11, dict(wall=2.0, cpu=1.0))
+    assert [ (xf['name'], xf['in'], xf['out']) for xf in total['filters'] ] == [ ('A.A', 7, 6), ('B.B', 4, 4) ]
+    assert total['write']['wall'] == 2.0
+    assert metrics.merge([ total ])['write'] == total['write']
+    lines = metrics.prometheus([ dict(pattern='in/"x"*.csv', profile=files) ]).splitlines()
+    assert '# TYPE csvfix_rows_read gauge' in lines
+    assert 'csvfix_rows_read{task="in/\\"x\\"*.csv"} 7' in lines
+    assert 'csvfix_filter_rows_dropped{task="in/\\"x\\"*.csv",filter="A.A"} 1' in lines
+    assert 'csvfix_write_seconds{task="in/\\"x\\"*.csv",clock="cpu"} 1.0' in lines